@@ -8,6 +8,14 @@ import traceback
 import datetime
 import json
 import copy
+import os
+import queue
+import multiprocessing
+
+try:
+    import orjson  # faster encoder for listFormat=json, the json module is used without it
+except ImportError:
+    orjson = None
 
 # Import required classes from fivetran_connector_sdk
 from fivetran_connector_sdk import Connector # For supporting Connector operations like Update() and Schema()
@@ -50,7 +58,10 @@ def schema(configuration: dict):
 # The state dictionary is empty for the first sync or for any full re-sync
 def update(configuration: dict, state: dict):
 
+    global list_to_string
     try:
+        # lists are written as str() of the list unless listFormat is "json"
+        list_to_string = json_list if configuration.get("listFormat", "python").lower() == "json" else str
         domain = configuration["domain"]
         base_url = f"https://{domain}"
 
@@ -73,8 +84,15 @@ def update(configuration: dict, state: dict):
 
         headers = make_headers(configuration, base_url)
 
+        # number of worker processes the restaurants are split across, "auto" uses every core.
+        # 1 runs everything in this process
+        processes = configuration.get("processes", "1")
+        processes = os.cpu_count() if processes == "auto" else int(processes)
+        pool = {"processes": processes, "start_method": configuration.get("startMethod", default_start_method),
+                "list_format": configuration.get("listFormat", "python").lower()}
+
         # Yield a checkpoint operation to save the new state.
-        yield from sync_items(base_url, headers, from_ts, to_ts, new_state)
+        yield from sync_items(base_url, headers, from_ts, to_ts, new_state, pool)
 
     except Exception as e:
         # Return error response
@@ -84,13 +102,15 @@ def update(configuration: dict, state: dict):
         raise RuntimeError(detailed_message)
 
 
-# The function takes five parameters:
+# The function takes six parameters:
 # - base_url: The URL to the API endpoint.
 # - headers: Authentication headers
+# - ts_from: starting timestamp
+# - ts_to: ending timestamp
 # - state: State dictionary
-# - topic: current topic to search
-# - params: A dictionary of query parameters to be sent with the API request.
-def sync_items(base_url, headers, ts_from, ts_to, state):
+# - pool: processes, start_method and list_format for the worker processes, see pooled_rows
+def sync_items(base_url, headers, ts_from, ts_to, state, pool=None):
+    pool = pool or {"processes": 1}
     more_data = True
     timerange_params = {"startDate": ts_from, "endDate": ts_to}
     log.fine(str(timerange_params))
@@ -107,24 +127,149 @@ def sync_items(base_url, headers, ts_from, ts_to, state):
 
         # Iterate over each user in the 'items' list and yield an upsert operation.
         # The 'upsert' operation inserts the data into the destination.
-        restaurant_count = len(response_page)
-        for index, r in enumerate(response_page):
-            guid = r["restaurantGuid"]
-            log.info(f"***** starting restaurant {guid}, {index + 1} of {restaurant_count} ***** ")
+        for r in response_page:
             yield op.upsert(table="restaurant", data=r)
 
-            process_restaurant()
+        # the endpoints of each restaurant are fetched and transformed here or in worker processes,
+        # and only this process makes upsert and checkpoint operations
+        guids = [r["restaurantGuid"] for r in response_page]
+        if pool["processes"] > 1:
+            rows = pooled_rows(base_url, headers, guids, config_params, timerange_params, **pool)
+        else:
+            rows = restaurant_rows(base_url, headers, guids, config_params, timerange_params)
+        for table_name, row in rows:
+            yield op.upsert(table=table_name, data=row)
 
         # Save the progress by checkpointing the state. This is important for ensuring that the sync process can resume
         # from the correct position in case of interruptions.
         yield op.checkpoint(state)
 
-        # Determine if we should continue pagination based on the total items and the current offset.
-        #more_data, params = should_continue_pagination(params, response_page)
-        #more_data = False
+        # the restaurants endpoint returns every restaurant in one response
+        more_data = False
+
+# The restaurant_rows function yields the rows of every endpoint for a list of restaurants, in order
+#
+# The function takes five parameters:
+# - base_url: The URL to the API endpoint.
+# - headers: Authentication headers
+# - guids: restaurant guids
+# - config_params: parameters for config endpoints
+# - timerange_params: startDate/endDate parameters
+#
+# Returns:
+# - A generator of (table name, row) pairs
+def restaurant_rows(base_url, headers, guids, config_params, timerange_params):
+    for index, guid in enumerate(guids):
+        log.info(f"***** starting restaurant {guid}, {index + 1} of {len(guids)} ***** ")
+        yield from process_restaurant(base_url, headers, guid, config_params, timerange_params)
+
+# Workers are not forked from this process by default: forking a process that runs threads, such as the SDK's,
+# can copy locks they hold into the workers. A fork server is started once per process instead, with this module
+# already imported so workers start quickly. Windows only has spawn, which starts a new interpreter for every worker
+default_start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+
+# The pooled_rows function runs restaurant_rows in worker processes and yields the rows they send back.
+# Restaurants are split round-robin across the workers, so the fetching and transforms of each endpoint use every core.
+# Workers send rows in batches of batch_size rows of one table through a bounded queue: when the parent falls behind,
+# workers wait, which keeps memory bounded. Rows of different workers interleave.
+#
+# The function takes nine parameters:
+# - base_url, headers, guids, config_params, timerange_params: as for restaurant_rows
+# - processes: number of worker processes
+# - start_method: multiprocessing start method, default_start_method by default. None uses the platform default
+# - list_format: listFormat for stringify_lists in the workers
+# - batch_size: maximum number of rows per batch
+#
+# Returns:
+# - A generator of (table name, row) pairs
+def pooled_rows(base_url, headers, guids, config_params, timerange_params, processes, start_method=default_start_method,
+                list_format="python", batch_size=500):
+    context = multiprocessing.get_context(start_method)
+    if start_method == "forkserver":
+        # only takes effect before the fork server has started, which is once per process
+        context.set_forkserver_preload([__name__])
+    rows_queue = context.Queue(maxsize=processes * 4)
+    partitions = [guids[i::processes] for i in range(processes) if guids[i::processes]]
+    workers = [context.Process(target=restaurant_worker, daemon=True,
+                               args=(rows_queue, index, base_url, headers, partition, config_params, timerange_params,
+                                     list_format, batch_size))
+               for index, partition in enumerate(partitions)]
+    log.info(f"fetching {len(guids)} restaurants in {len(workers)} worker processes")
+    for worker in workers:
+        worker.start()
+
+    finished = set()
+    exited = set()  # unfinished workers found to have exited the last time the queue was empty
+    try:
+        while len(finished) < len(workers):
+            try:
+                kind, key, value = rows_queue.get(timeout=1 if exited else 5)
+            except queue.Empty:
+                # a worker killed before it could report, e.g. by running out of memory.
+                # A worker may also have sent its last messages and exited after the queue was found empty, so it only
+                # counts as failed if it has still not reported once the messages sent before it exited are read
+                failed = exited - finished
+                if failed:
+                    index = min(failed)
+                    raise RuntimeError(f"worker process {index} exited with code {workers[index].exitcode} "
+                                       f"without reporting")
+                exited = {index for index, worker in enumerate(workers)
+                          if index not in finished and not worker.is_alive()}
+                continue
+            if kind == "rows":
+                for row in value:
+                    yield key, row
+            elif kind == "done":
+                finished.add(key)
+            else:
+                raise RuntimeError(f"worker process {key} failed:\n{value}")
+        for worker in workers:
+            worker.join()
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+                worker.join()
+
+# The restaurant_worker function is the body of a worker process of pooled_rows.
+# It sends ("rows", table name, rows) batches, then ("done", index, None), or ("error", index, stack trace) if it fails.
+#
+# The function takes nine parameters:
+# - rows_queue: queue to the parent process
+# - index: worker number
+# - base_url, headers, guids, config_params, timerange_params: as for restaurant_rows
+# - list_format: listFormat for stringify_lists
+# - batch_size: maximum number of rows per batch
+def restaurant_worker(rows_queue, index, base_url, headers, guids, config_params, timerange_params, list_format,
+                      batch_size):
+    global list_to_string
+    # set here as well, since a spawned process does not inherit it from update()
+    list_to_string = json_list if list_format == "json" else str
+    try:
+        batches = {}
+        for table_name, row in restaurant_rows(base_url, headers, guids, config_params, timerange_params):
+            batch = batches.setdefault(table_name, [])
+            batch.append(row)
+            if len(batch) >= batch_size:
+                rows_queue.put(("rows", table_name, batches.pop(table_name)))
+        for table_name, batch in batches.items():
+            rows_queue.put(("rows", table_name, batch))
+        rows_queue.put(("done", index, None))
+    except Exception:
+        rows_queue.put(("error", index, traceback.format_exc()))
 
 # all of the endpoints to process for a restaurant
-def process_restaurant():
+#
+# The function takes five parameters:
+# - base_url: The URL to the API endpoint.
+# - headers: Authentication headers
+# - guid: restaurant guid
+# - config_params: parameters for config endpoints
+# - timerange_params: startDate/endDate parameters
+#
+# Returns:
+# - A generator of (table name, row) pairs
+def process_restaurant(base_url, headers, guid, config_params, timerange_params):
 
     # cash management endpoints
     # cashmgmt/v1/deposits
@@ -158,7 +303,7 @@ def process_restaurant():
 # timerange dictionary needs to be passed as data
 # they use token pagination, which needs to be passed as params
 def process_config(base_url, headers, endpoint, table_name, rst_guid, data):
-    headers["Toast-Restaurant-External-ID"] = rst_guid
+    headers = {**headers, "Toast-Restaurant-External-ID": rst_guid}
     more_data = True
     pagination = {}
 
@@ -179,7 +324,7 @@ def process_config(base_url, headers, endpoint, table_name, rst_guid, data):
                 else:
                     yield op.upsert(table=table_name, data=o)
                 """
-                yield op.upsert(table=table_name, data=o)
+                yield table_name, o
 
             if next_token:
                 pagination["pageToken"] = next_token
@@ -199,17 +344,18 @@ def process_config(base_url, headers, endpoint, table_name, rst_guid, data):
 # they do not use pagination
 # dictionary of time ranges is optional for breaks, shifts, and time entries
 def process_labor(base_url, headers, endpoint, table_name, rst_guid, **kwargs):
-    headers["Toast-Restaurant-External-ID"] = rst_guid
+    headers = {**headers, "Toast-Restaurant-External-ID": rst_guid}
 
     try:
         response_page, next_token = get_api_response(base_url + endpoint, headers, **kwargs)
         log.fine(f"restaurant {rst_guid}: response_page has {len(response_page)} items for {endpoint}")
         for o in response_page:
+            # breaks are read before stringify_lists turns them into a string
+            if endpoint == "/labor/v1/timeEntries" and "breaks" in o and len(o["breaks"]) > 0:
+                yield from process_break(o)
             o = stringify_lists(o)
             # can labor records be deleted? Is this needed?
-            if endpoint == "/labor/v1/timeEntries" and "breaks" in o and len(o["breaks"]) > 0:
-                process_break(o)
-            yield op.upsert(table=table_name, data=o)
+            yield table_name, o
 
     except Exception as e:
         # Return error response
@@ -222,7 +368,7 @@ def process_break (time_entry):
     breaks = time_entry["breaks"]
     for b in breaks:
         b["time_entry_id"] = time_entry["guid"]
-        yield op.upsert(table="break", data=b)
+        yield "break", b
 
 def make_headers(conf, base_url):
     payload = {"clientId": conf["clientId"],
@@ -266,7 +412,7 @@ def get_api_response(endpoint_path, headers, **kwargs):
     next_page_token = response_headers["Toast-Next-Page-Token"] if "Toast-Next-Page-Token" in response_headers else None
     return response_page, next_page_token
 
-# The stringify_lists function changes lists to strings
+# The stringify_lists function changes lists to strings, in the format set by the listFormat configuration value
 #
 # The function takes one parameter:
 # - d: a dictionary
@@ -277,12 +423,62 @@ def stringify_lists(d):
     new_dict = {}
     for key, value in d.items():
         if isinstance(value, list):
-            new_dict[key] = str(value)
+            new_dict[key] = list_to_string(value)
         else:
             new_dict[key] = value
 
     return new_dict
 
+# list_to_string converts a list value to the string written to the destination.
+# It is str() by default, and json_list when the listFormat configuration value is "json". Set in update()
+list_to_string = str
+
+# json_list_cache, encode_json and json_list are copied from toast/connector.py, the canonical version.
+# This connector deploys on its own and cannot import it, so keep the code of the copies identical to it.
+# compact JSON of short lists of strings, e.g. tags and feature flags repeated on every row
+json_list_cache = {}
+json_list_cache_size = 4096
+json_list_cache_length = 8
+json_encoder = json.JSONEncoder(separators=(",", ":"), ensure_ascii=False)
+
+# The encode_json function encodes a value as compact JSON, with orjson if it is installed
+#
+# The function takes one parameter:
+# - value: any JSON value
+#
+# Returns:
+# - A JSON string
+def encode_json(value):
+    if orjson is not None:
+        try:
+            return orjson.dumps(value).decode()
+        except TypeError:
+            pass  # e.g. integers over 64 bits, which the json module handles
+    return json_encoder.encode(value)
+
+# The json_list function converts a list to compact JSON, the listFormat=json replacement for str()
+# Short lists of strings are cached, since the same few values repeat across rows
+#
+# The function takes one parameter:
+# - value: a list
+#
+# Returns:
+# - A JSON string
+def json_list(value):
+    if not value:
+        return "[]"
+    if len(value) <= json_list_cache_length:
+        key = tuple(value)
+        # only strings, so that e.g. [1] and [True], which are equal as keys, are not confused
+        if all(type(item) is str for item in key):
+            encoded = json_list_cache.get(key)
+            if encoded is None:
+                if len(json_list_cache) >= json_list_cache_size:
+                    json_list_cache.clear()
+                encoded = json_list_cache[key] = encode_json(value)
+            return encoded
+    return encode_json(value)
+
 def is_older_than_30_days(date_to_check):
 
     today = datetime.date.today()
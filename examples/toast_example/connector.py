@@ -12,6 +12,11 @@ import datetime
 import json
 import copy
 
+try:
+    import orjson  # faster encoder for listFormat=json, the json module is used without it
+except ImportError:
+    orjson = None
+
 # Import required classes from fivetran_connector_sdk
 
 from fivetran_connector_sdk import Connector  # For supporting Connector operations like Update() and Schema()
@@ -48,7 +53,10 @@ def schema(configuration: dict):
 def update(configuration: dict, state: dict):
     log.warning("Examples: Source Example - Toast")
 
+    global list_to_string
     try:
+        # lists are written as str() of the list unless listFormat is "json"
+        list_to_string = json_list if configuration.get("listFormat", "python").lower() == "json" else str
         domain = configuration["domain"]
         base_url = f"https://{domain}"
         current_utc_timestamp = datetime.datetime.now(datetime.timezone.utc).isoformat("T", "milliseconds")
@@ -182,7 +190,7 @@ def get_api_response(endpoint_path, headers, params):
     return response_page, next_page_token
 
 
-# The stringify_lists function changes lists to strings
+# The stringify_lists function changes lists to strings, in the format set by the listFormat configuration value
 #
 # The function takes one parameter:
 # - d: a dictionary
@@ -194,13 +202,69 @@ def stringify_lists(d):
     new_dict = {}
     for key, value in d.items():
         if isinstance(value, list):
-            new_dict[key] = str(value)
+            new_dict[key] = list_to_string(value)
         else:
             new_dict[key] = value
 
     return new_dict
 
 
+# list_to_string converts a list value to the string written to the destination.
+# It is str() by default, and json_list when the listFormat configuration value is "json". Set in update()
+list_to_string = str
+
+
+# json_list_cache, encode_json and json_list are copied from toast/connector.py, the canonical version.
+# This connector deploys on its own and cannot import it, so keep the code of the copies identical to it.
+# compact JSON of short lists of strings, e.g. tags and feature flags repeated on every row
+json_list_cache = {}
+json_list_cache_size = 4096
+json_list_cache_length = 8
+json_encoder = json.JSONEncoder(separators=(",", ":"), ensure_ascii=False)
+
+
+# The encode_json function encodes a value as compact JSON, with orjson if it is installed
+#
+# The function takes one parameter:
+# - value: any JSON value
+#
+# Returns:
+# - A JSON string
+
+def encode_json(value):
+    if orjson is not None:
+        try:
+            return orjson.dumps(value).decode()
+        except TypeError:
+            pass  # e.g. integers over 64 bits, which the json module handles
+    return json_encoder.encode(value)
+
+
+# The json_list function converts a list to compact JSON, the listFormat=json replacement for str()
+# Short lists of strings are cached, since the same few values repeat across rows
+#
+# The function takes one parameter:
+# - value: a list
+#
+# Returns:
+# - A JSON string
+
+def json_list(value):
+    if not value:
+        return "[]"
+    if len(value) <= json_list_cache_length:
+        key = tuple(value)
+        # only strings, so that e.g. [1] and [True], which are equal as keys, are not confused
+        if all(type(item) is str for item in key):
+            encoded = json_list_cache.get(key)
+            if encoded is None:
+                if len(json_list_cache) >= json_list_cache_size:
+                    json_list_cache.clear()
+                encoded = json_list_cache[key] = encode_json(value)
+            return encoded
+    return encode_json(value)
+
+
 # This creates the connector object that will use the update function defined in this connector.py file.
 # This example does not use the schema() function. If it did, it would need to be included in the connector object definition. 
 
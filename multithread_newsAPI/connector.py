@@ -7,11 +7,16 @@ import requests as rq
 import traceback
 import datetime
 import json
+import hashlib
+import queue
+import threading
 import concurrent.futures
 
 
+# default number of topics fetched at the same time, set with maxWorkers in configuration.json
 max_workers = 3
-#executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+# pages of articles waiting for update() to yield them, per worker. Workers wait while the queue is full
+pages_per_worker = 2
 
 # Import required classes from fivetran_connector_sdk
 from fivetran_connector_sdk import Connector
@@ -38,6 +43,16 @@ def schema(configuration: dict):
                 "author": "STRING",
                 "title": "STRING"
             }
+        },
+        {
+            # the topics each article was found for, see article_operations
+            "table": "article_topic",
+            "primary_key": ["source", "published_at", "topic"],
+            "columns": {
+                "source": "STRING",
+                "published_at": "UTC_DATETIME",
+                "topic": "STRING"
+            }
         }
     ]
 
@@ -53,7 +68,8 @@ def update(configuration: dict, state: dict):
     try:
         conf = configuration
         base_url = "https://newsapi.org/v2/everything"
-        from_ts = state['to_ts'] if 'to_ts' in state else datetime.datetime.now() - datetime.timedelta(days=1)
+        from_ts = state['to_ts'] if 'to_ts' in state else \
+            (datetime.datetime.now() - datetime.timedelta(days=1)).strftime("%Y-%m-%dT%H:%M:%S")
         now = datetime.datetime.now()
         to_ts = now.strftime("%Y-%m-%dT%H:%M:%S")
         headers = {"Authorization": "Bearer "+conf["API_KEY"], "accept": "application/json"}
@@ -67,25 +83,40 @@ def update(configuration: dict, state: dict):
              "pageSize": conf["pageSize"]}
 
         topics = json.loads(conf["topic"])
-
-        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-            future_to_topic = {
-                executor.submit(sync_items, base_url, headers, {**base_params, "q": topic, "page": "1"}, state, topic): topic
-                for topic in topics
-            }
-
-            for future in concurrent.futures.as_completed(future_to_topic):
-                topic = future_to_topic[future]
-                log.info(topic)
-                try:
-                    for record in future.result():
-                        log.info(str(record))
-                except Exception as e:
-                    log.warning(f"Error syncing topic '{topic}': {str(e)}")
+        workers = int(conf.get("maxWorkers", max_workers))
+
+        # each topic is fetched from the latest publishedAt synced for it, see topic_cursors
+        cursors = topic_cursors(state)
+        topic_params = {t: {**base_params, "q": t, "page": "1", "from": cursors.get(t, from_ts)} for t in topics}
+        failed = []
+        # articles already upserted in this sync, see article_operations
+        seen = {}
+
+        for kind, topic, value in fetch_topics(base_url, headers, topic_params, workers):
+            if kind == "articles":
+                for row in value:
+                    yield from article_operations(row, topic, seen)
+            elif kind == "done":
+                if value:
+                    cursors[topic] = value
+                new_state = {"topics": dict(cursors)}
+                if "to_ts" in state:
+                    new_state["to_ts"] = state["to_ts"]
+                # Save the progress by checkpointing the state, so a restarted sync asks only for newer articles
+                # of the finished topics.
+                yield op.checkpoint(state=new_state)
+            else:
+                log.warning(f"Error syncing topic '{topic}': {value}")
+                failed.append(topic)
+
+        if failed:
+            # keep to_ts, so the next sync fetches the failed topics again
+            raise RuntimeError(f"Could not sync topics {failed}")
 
         # Update the state with the new cursor position, incremented by 1.
         new_state = {
-            "to_ts": to_ts
+            "to_ts": to_ts,
+            "topics": cursors
         }
         log.fine(f"state updated, new state: {repr(new_state)}")
 
@@ -100,13 +131,71 @@ def update(configuration: dict, state: dict):
         raise RuntimeError(detailed_message)
 
 
-# The function takes five parameters:
+# The fetch_topics function fetches topics in worker threads and yields what they fetch as it arrives.
+# Each worker pages through one topic at a time and puts every page of article rows in a bounded queue.
+# When the queue is full, workers wait for update() to yield the rows already fetched,
+# so no more than a few pages per worker are held in memory.
+#
+# The function takes four parameters:
+# - base_url: The URL to the API endpoint.
+# - headers: Authentication headers
+# - topic_params: query parameters of the first page of each topic to fetch
+# - workers: number of topics fetched at the same time
+#
+# Returns:
+# - A generator of ("articles", topic, rows) for every page, then ("done", topic, latest publishedAt) when a topic is
+#   complete, or ("error", topic, message) when it failed
+def fetch_topics(base_url, headers, topic_params, workers):
+    results = queue.Queue(maxsize=workers * pages_per_worker)
+    stop = threading.Event()
+
+    def put(item):
+        # waits for room in the queue, unless update() stopped reading it
+        while not stop.is_set():
+            try:
+                results.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def fetch(topic):
+        try:
+            latest = None
+            for rows in topic_pages(base_url, headers, topic_params[topic], topic):
+                if stop.is_set():
+                    return
+                latest = latest_published(latest, rows)
+                put(("articles", topic, rows))
+            put(("done", topic, latest))
+        except Exception as e:
+            put(("error", topic, str(e)))
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+    try:
+        for topic in topic_params:
+            executor.submit(fetch, topic)
+        for _ in topic_params:
+            item = results.get()
+            while item[0] == "articles":
+                yield item
+                item = results.get()
+            yield item
+    finally:
+        stop.set()
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+# The topic_pages function pages through the articles of one topic.
+#
+# The function takes four parameters:
 # - base_url: The URL to the API endpoint.
 # - headers: Authentication headers
-# - state: State dictionary
-# - topic: current topic to search
 # - params: A dictionary of query parameters to be sent with the API request.
-def sync_items(base_url, headers, params, state, topic):
+# - topic: current topic to search
+#
+# Returns:
+# - A generator of lists of article rows, one list per page
+def topic_pages(base_url, headers, params, topic):
     more_data = True
 
     while more_data:
@@ -120,29 +209,71 @@ def sync_items(base_url, headers, params, state, topic):
         if not items:
             break  # End pagination if there are no records in response.
 
-        # Iterate over each user in the 'items' list and yield an upsert operation.
-        # The 'upsert' operation inserts the data into the destination.
-        # Update the state with the 'updatedAt' timestamp of the current item.
-        summary_first_item = {'title': items[0]['title'], 'source': items[0]['source']}
-
-        for a in items:
-            yield op.upsert(table="article", data={
-                "topic": topic,
-                "source": a["source"]["name"],
-                "published_at": a["publishedAt"],
-                "author": a["author"],
-                "title": a["title"],
-                "description": a["description"],
-                "content": a["content"],
-                "url": a["url"]})
-
-        # Save the progress by checkpointing the state. This is important for ensuring that the sync process can resume
-        # from the correct position in case of interruptions.
-        yield op.checkpoint(state)
+        yield [article_row(a) for a in items]
 
         # Determine if we should continue pagination based on the total items and the current offset.
         more_data, params = should_continue_pagination(params, response_page)
 
+# The topic_cursors function returns the latest publishedAt synced for each topic, from the state.
+# A topic's next request asks for articles published from its cursor on, so topics without new articles
+# do not fetch the whole window again. The cursor is inclusive, so the articles at the cursor are upserted again.
+# Topics without a cursor start from to_ts.
+#
+# The function takes one parameter:
+# - state: State dictionary
+#
+# Returns:
+# - A dictionary of topic to publishedAt
+def topic_cursors(state):
+    return dict(state.get("topics", {}))
+
+# The latest_published function returns the latest published_at of the cursor and a page of article rows.
+# publishedAt is an ISO 8601 UTC timestamp, so the latest is the largest string.
+def latest_published(cursor, rows):
+    published = [r["published_at"] for r in rows if r.get("published_at")]
+    if cursor:
+        published.append(cursor)
+    return max(published) if published else None
+
+# The article_row function converts an article from the API into a row of the article table.
+def article_row(a):
+    return {
+        "source": a["source"]["name"],
+        "published_at": a["publishedAt"],
+        "author": a["author"],
+        "title": a["title"],
+        "description": a["description"],
+        "content": a["content"],
+        "url": a["url"]}
+
+# The article_operations function yields the operations for an article found for a topic.
+# Articles often match several topics. The article row is upserted only the first time the article is found in a sync,
+# and an article_topic row links it to every topic it was found for.
+# The same article can come back with another published_at, so links use the primary key of the row that was upserted.
+#
+# The function takes three parameters:
+# - row: article row, see article_row
+# - topic: topic the article was found for
+# - seen: dictionary of article_key to the primary key of the upserted article row and the topics it was found for
+#   in this sync, updated here
+def article_operations(row, topic, seen):
+    key = article_key(row)
+    if key not in seen:
+        seen[key] = ({"source": row["source"], "published_at": row["published_at"]}, set())
+        yield op.upsert(table="article", data=row)
+    article, topics = seen[key]
+    if topic not in topics:
+        topics.add(topic)
+        yield op.upsert(table="article_topic", data={**article, "topic": topic})
+
+# The article_key function identifies an article across topics: by its URL, or by a hash of its text
+# when it has no URL.
+def article_key(row):
+    if row.get("url"):
+        return row["url"]
+    text = json.dumps([row["source"], row["title"], row["description"], row["content"]])
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
 # The get_api_response function sends an HTTP GET request to the provided URL with the specified parameters.
 # It performs the following tasks:
 # 1. Logs the URL and query parameters used for the API call for debugging and tracking purposes.
@@ -7,6 +7,7 @@ import requests as rq
 import traceback
 import datetime
 import json
+import hashlib
 
 # Import required classes from fivetran_connector_sdk
 from fivetran_connector_sdk import Connector
@@ -33,6 +34,16 @@ def schema(configuration: dict):
                 "author": "STRING",
                 "title": "STRING"
             }
+        },
+        {
+            # the topics each article was found for, see article_operations
+            "table": "article_topic",
+            "primary_key": ["source", "published_at", "topic"],
+            "columns": {
+                "source": "STRING",
+                "published_at": "UTC_DATETIME",
+                "topic": "STRING"
+            }
         }
     ]
 
@@ -48,7 +59,8 @@ def update(configuration: dict, state: dict):
     try:
         conf = configuration
         base_url = "https://newsapi.org/v2/everything"
-        from_ts = state['to_ts'] if 'to_ts' in state else datetime.datetime.now() - datetime.timedelta(days=1)
+        from_ts = state['to_ts'] if 'to_ts' in state else \
+            (datetime.datetime.now() - datetime.timedelta(days=1)).strftime("%Y-%m-%dT%H:%M:%S")
         now = datetime.datetime.now()
         to_ts = now.strftime("%Y-%m-%dT%H:%M:%S")
         headers = {"Authorization": "Bearer "+conf["API_KEY"], "accept": "application/json"}
@@ -63,15 +75,24 @@ def update(configuration: dict, state: dict):
 
         topics = json.loads(conf["topic"])
 
+        # each topic is fetched from the latest publishedAt synced for it, see topic_cursors
+        topic_state = {"topics": topic_cursors(state)}
+        # articles already upserted in this sync, see article_operations
+        seen = {}
+        if "to_ts" in state:
+            topic_state["to_ts"] = state["to_ts"]
+
         for t in topics:
             params["q"] = t
             params["page"] = "1"
-            yield from sync_items(base_url, headers, params, state, t)
+            params["from"] = topic_state["topics"].get(t, from_ts)
+            yield from sync_items(base_url, headers, params, topic_state, t, seen)
 
 
         # Update the state with the new cursor position, incremented by 1.
         new_state = {
-            "to_ts": to_ts
+            "to_ts": to_ts,
+            "topics": topic_state["topics"]
         }
         log.fine(f"state updated, new state: {repr(new_state)}")
 
@@ -86,14 +107,17 @@ def update(configuration: dict, state: dict):
         raise RuntimeError(detailed_message)
 
 
-# The function takes five parameters:
+# The function takes six parameters:
 # - base_url: The URL to the API endpoint.
 # - headers: Authentication headers
-# - state: State dictionary
+# - state: State dictionary, its cursor for the topic is updated once every page of the topic is synced
 # - topic: current topic to search
 # - params: A dictionary of query parameters to be sent with the API request.
-def sync_items(base_url, headers, params, state, topic):
+# - seen: articles already upserted in this sync, see article_operations
+def sync_items(base_url, headers, params, state, topic, seen):
     more_data = True
+    # pages are sorted by publishedAt, newest first, so the cursor can only move once all of them are synced
+    latest = state["topics"].get(topic)
 
     while more_data:
         # Get response from API call.
@@ -106,21 +130,12 @@ def sync_items(base_url, headers, params, state, topic):
         if not items:
             break  # End pagination if there are no records in response.
 
-        # Iterate over each user in the 'items' list and yield an upsert operation.
+        # Iterate over each article in the 'items' list and yield its operations.
         # The 'upsert' operation inserts the data into the destination.
-        # Update the state with the 'updatedAt' timestamp of the current item.
-        summary_first_item = {'title': items[0]['title'], 'source': items[0]['source']}
+        latest = latest_published(latest, items)
 
         for a in items:
-            yield op.upsert(table="article", data={
-                "topic": topic,
-                "source": a["source"]["name"],
-                "published_at": a["publishedAt"],
-                "author": a["author"],
-                "title": a["title"],
-                "description": a["description"],
-                "content": a["content"],
-                "url": a["url"]})
+            yield from article_operations(article_row(a), topic, seen)
 
         # Save the progress by checkpointing the state. This is important for ensuring that the sync process can resume
         # from the correct position in case of interruptions.
@@ -129,6 +144,70 @@ def sync_items(base_url, headers, params, state, topic):
         # Determine if we should continue pagination based on the total items and the current offset.
         more_data, params = should_continue_pagination(params, response_page)
 
+    if latest:
+        state["topics"][topic] = latest
+        yield op.checkpoint(state)
+
+# The topic_cursors function returns the latest publishedAt synced for each topic, from the state.
+# A topic's next request asks for articles published from its cursor on, so topics without new articles
+# do not fetch the whole window again. The cursor is inclusive, so the articles at the cursor are upserted again.
+# Topics without a cursor start from to_ts.
+#
+# The function takes one parameter:
+# - state: State dictionary
+#
+# Returns:
+# - A dictionary of topic to publishedAt
+def topic_cursors(state):
+    return dict(state.get("topics", {}))
+
+# The latest_published function returns the latest publishedAt of the cursor and a page of articles.
+# publishedAt is an ISO 8601 UTC timestamp, so the latest is the largest string.
+def latest_published(cursor, articles):
+    published = [a["publishedAt"] for a in articles if a.get("publishedAt")]
+    if cursor:
+        published.append(cursor)
+    return max(published) if published else None
+
+# The article_row function converts an article from the API into a row of the article table.
+def article_row(a):
+    return {
+        "source": a["source"]["name"],
+        "published_at": a["publishedAt"],
+        "author": a["author"],
+        "title": a["title"],
+        "description": a["description"],
+        "content": a["content"],
+        "url": a["url"]}
+
+# The article_operations function yields the operations for an article found for a topic.
+# Articles often match several topics. The article row is upserted only the first time the article is found in a sync,
+# and an article_topic row links it to every topic it was found for.
+# The same article can come back with another published_at, so links use the primary key of the row that was upserted.
+#
+# The function takes three parameters:
+# - row: article row, see article_row
+# - topic: topic the article was found for
+# - seen: dictionary of article_key to the primary key of the upserted article row and the topics it was found for
+#   in this sync, updated here
+def article_operations(row, topic, seen):
+    key = article_key(row)
+    if key not in seen:
+        seen[key] = ({"source": row["source"], "published_at": row["published_at"]}, set())
+        yield op.upsert(table="article", data=row)
+    article, topics = seen[key]
+    if topic not in topics:
+        topics.add(topic)
+        yield op.upsert(table="article_topic", data={**article, "topic": topic})
+
+# The article_key function identifies an article across topics: by its URL, or by a hash of its text
+# when it has no URL.
+def article_key(row):
+    if row.get("url"):
+        return row["url"]
+    text = json.dumps([row["source"], row["title"], row["description"], row["content"]])
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
 # The get_api_response function sends an HTTP GET request to the provided URL with the specified parameters.
 # It performs the following tasks:
 # 1. Logs the URL and query parameters used for the API call for debugging and tracking purposes.
@@ -0,0 +1,113 @@
+"""
+Scaling benchmark for the ordersBulk transforms (order_operations, process_payments, process_child, process_void_info).
+Sweeps order width (selections per check) and depth (nested modifier levels) with synthetic orders from
+benchmarks/order_trees.py, and reports payload size, rows/sec and peak memory of the transform at each point.
+
+Run from the toast directory:
+    python benchmarks/order_tree_scaling.py [--orders 50] [--seed 1] [--csv results.csv] [--plot results.png]
+--plot needs matplotlib.
+"""
+
+import sys
+import os
+import csv
+import json
+import time
+import argparse
+import tracemalloc
+from dataclasses import replace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import connector
+from order_trees import OrderShape, generate_orders
+
+# (sweep name, OrderShape field, values)
+sweeps = [("width", "selections", [1, 5, 20, 50, 100, 200]),
+          ("depth", "modifier_depth", [1, 2, 3, 4, 5])]
+
+class CountingOp:
+    """Stands in for the SDK operations, so only the transform is measured."""
+    @staticmethod
+    def upsert(table, data):
+        return data
+
+    @staticmethod
+    def delete(table, keys):
+        return keys
+
+def transform(orders):
+    rows = 0
+    for order in orders:
+        for _ in connector.order_operations("orders", "restaurant", order):
+            rows += 1
+    return rows
+
+def measure(shape, order_count, seed):
+    """
+    :return: dictionary of payload size, rows, rows/sec and peak memory for one shape
+    """
+    # the transform modifies orders in place, so the timed and traced runs each get freshly generated orders
+    orders = generate_orders(order_count, shape, seed)
+    payload_bytes = len(json.dumps(orders))
+    start = time.perf_counter()
+    rows = transform(orders)
+    elapsed = time.perf_counter() - start
+
+    orders = generate_orders(order_count, shape, seed)
+    tracemalloc.start()
+    transform(orders)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {"payload_kb": round(payload_bytes / 1024, 1), "rows": rows, "rows_per_sec": round(rows / elapsed),
+            "kb_per_order": round(payload_bytes / 1024 / order_count, 1),
+            "transform_peak_mb": round(peak / 1024 / 1024, 2)}
+
+def plot(results, path):
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    figure, axes = plt.subplots(1, 2, figsize=(11, 4))
+    for sweep, _, _ in sweeps:
+        points = [r for r in results if r["sweep"] == sweep]
+        axes[0].plot([p["kb_per_order"] for p in points], [p["rows_per_sec"] for p in points], marker="o", label=sweep)
+        axes[1].plot([p["payload_kb"] for p in points], [p["transform_peak_mb"] for p in points], marker="o", label=sweep)
+    axes[0].set(xlabel="KB per order", ylabel="rows/sec", xscale="log")
+    axes[1].set(xlabel="page payload (KB)", ylabel="transform peak memory (MB)", xscale="log")
+    for ax in axes:
+        ax.legend()
+    figure.tight_layout()
+    figure.savefig(path)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--orders", type=int, default=50, help="orders per measurement")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--csv", help="write the results to this CSV file")
+    parser.add_argument("--plot", help="plot the results to this image file")
+    args = parser.parse_args()
+    connector.op = CountingOp
+
+    results = []
+    columns = ["sweep", "value", "payload_kb", "kb_per_order", "rows", "rows_per_sec", "transform_peak_mb"]
+    print("  ".join(f"{c:>17}" for c in columns))
+    for sweep, field, values in sweeps:
+        for value in values:
+            result = {"sweep": sweep, "value": value,
+                      **measure(replace(OrderShape(), **{field: value}), args.orders, args.seed)}
+            results.append(result)
+            print("  ".join(f"{result[c]:>17}" for c in columns))
+
+    if args.csv:
+        with open(args.csv, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=columns)
+            writer.writeheader()
+            writer.writerows(results)
+    if args.plot:
+        plot(results, args.plot)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""
+Deterministic generator of synthetic Toast ordersBulk orders, for scaling tests of the order transforms.
+Child lists follow child_relationships and nested dictionaries follow child_fields_to_flatten in connector.py,
+so every table process_child writes gets rows, and the shape can be made much wider and deeper than real pages.
+
+    shape = OrderShape(selections=200, modifier_depth=3)
+    orders = generate_orders(100, shape, seed=1)
+"""
+
+import os
+import sys
+import uuid
+import random
+from dataclasses import dataclass
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from connector import child_relationships, child_fields_to_flatten
+
+@dataclass
+class OrderShape:
+    """
+    Number of children at each level of an order tree
+    :param checks: checks per order
+    :param selections: selections per check, the main width knob
+    :param modifiers: modifiers per selection, and per modifier at each nested level
+    :param modifier_depth: levels of modifiers nested inside modifiers
+    :param applied_taxes: applied taxes per selection
+    :param applied_discounts: applied discounts per check and per selection
+    :param discount_depth: combo items and triggers per applied discount
+    :param service_charges: applied service charges per check
+    :param payments: payments per check
+    :param pricing_features: pricing features per order
+    """
+    checks: int = 2
+    selections: int = 4
+    modifiers: int = 2
+    modifier_depth: int = 1
+    applied_taxes: int = 2
+    applied_discounts: int = 1
+    discount_depth: int = 1
+    service_charges: int = 1
+    payments: int = 1
+    pricing_features: int = 2
+
+    def child_count(self, field):
+        """Number of rows generated for a child list field of child_relationships."""
+        return {"selections": self.selections, "appliedDiscounts": self.applied_discounts,
+                "appliedServiceCharges": self.service_charges, "appliedTax": 1,
+                "appliedTaxes": self.applied_taxes, "modifiers": self.modifiers,
+                "comboItems": self.discount_depth, "triggers": self.discount_depth}[field]
+
+class OrderGenerator:
+    """
+    Builds orders from a seeded random number generator, the same seed and shape give the same orders
+    :param shape: OrderShape
+    :param seed: random seed
+    """
+
+    def __init__(self, shape=None, seed=0):
+        self.shape = shape or OrderShape()
+        self.rng = random.Random(seed)
+
+    def guid(self):
+        return str(uuid.UUID(int=self.rng.getrandbits(128), version=4))
+
+    def reference(self, entity_type):
+        return {"guid": self.guid(), "entityType": entity_type, "externalId": None}
+
+    def amount(self):
+        return round(self.rng.uniform(0.5, 60.0), 2)
+
+    def order(self, business_date=20250326):
+        order_guid = self.guid()
+        checks = [self.row("orders_check") for _ in range(self.shape.checks)]
+        for check in checks:
+            check["payments"] = [self.payment(business_date) for _ in range(self.shape.payments)]
+        return {"guid": order_guid, "entityType": "Order", "externalId": None,
+                "openedDate": "2025-03-26T21:06:31.880+0000", "modifiedDate": "2025-03-26T21:32:12.059+0000",
+                "businessDate": business_date, "numberOfGuests": self.rng.randint(1, 8),
+                "diningOption": self.reference("DiningOption"), "table": self.reference("Table"),
+                "serviceArea": self.reference("ServiceArea"), "revenueCenter": self.reference("RevenueCenter"),
+                "restaurantService": self.reference("RestaurantService"), "server": self.reference("RestaurantUser"),
+                "createdDevice": {"id": str(self.rng.randint(1000, 9999))},
+                "lastModifiedDevice": {"id": str(self.rng.randint(1000, 9999))},
+                "source": "In Store", "voided": False, "deleted": False, "deletedDate": None,
+                "pricingFeatures": [f"FEATURE_{i}" for i in range(self.shape.pricing_features)],
+                "appliedPackagingInfo": None, "displayNumber": str(self.rng.randint(1, 999)),
+                "checks": checks}
+
+    def row(self, table, depth=0):
+        """
+        A child row for table, with a dictionary for each of its child_fields_to_flatten
+        and a list for each of its child_relationships
+        :param table: connector table name
+        :param depth: nesting level of modifiers inside modifiers
+        """
+        row = {"guid": self.guid(), "entityType": table, "externalId": None, "displayName": f"{table} item",
+               "quantity": self.rng.randint(1, 3), "price": self.amount(), "tax": self.amount(),
+               "voided": False, "createdDate": "2025-03-26T21:06:31.880+0000"}
+        for field in child_fields_to_flatten.get(table, []):
+            row[field] = self.reference(field[0].upper() + field[1:])
+        for field, child_table in child_relationships.get(table, []):
+            row[field] = [self.row(child_table) for _ in range(self.shape.child_count(field))]
+        if table == "orders_check_selection_modifier" and depth < self.shape.modifier_depth - 1:
+            # nested modifiers stay a list in the modifier row, which stringify_lists turns into JSON
+            row["modifiers"] = [self.row(table, depth + 1) for _ in range(self.shape.modifiers)]
+        elif table == "orders_check_selection_modifier":
+            row["modifiers"] = []
+        return row
+
+    def payment(self, business_date):
+        voided = self.rng.random() < 0.1
+        return {"guid": self.guid(), "entityType": "OrderPayment", "type": self.rng.choice(["CASH", "CREDIT"]),
+                "amount": self.amount(), "tipAmount": self.amount(), "paidBusinessDate": business_date,
+                "cashDrawer": self.reference("CashDrawer"), "createdDevice": {"id": "1"},
+                "lastModifiedDevice": {"id": "1"}, "otherPayment": None, "server": self.reference("RestaurantUser"),
+                "refund": {"refundAmount": 0.0, "tipRefundAmount": 0.0, "refundDate": None},
+                "voidInfo": {"voidUser": self.reference("RestaurantUser"), "voidApprover": self.reference("RestaurantUser"),
+                             "voidDate": "2025-03-26T21:40:00.000+0000", "voidBusinessDate": business_date,
+                             "voidReason": self.reference("VoidReason")} if voided else None}
+
+def generate_orders(count, shape=None, seed=0):
+    """
+    :param count: number of orders
+    :param shape: OrderShape, defaults to a small realistic order
+    :param seed: random seed
+    :return: list of orders, the same for the same arguments
+    """
+    generator = OrderGenerator(shape, seed)
+    return [generator.order() for _ in range(count)]
+
+def rows_per_order(shape):
+    """Number of rows process_orders writes for one order of this shape, excluding the order row itself."""
+    discount_rows = 1 + 2 * shape.discount_depth
+    selection_rows = 1 + shape.applied_taxes + shape.modifiers + shape.applied_discounts * discount_rows
+    check_rows = (1 + shape.selections * selection_rows + shape.applied_discounts * discount_rows
+                  + shape.service_charges * 2 + shape.payments * 2)
+    return shape.checks * check_rows + shape.pricing_features
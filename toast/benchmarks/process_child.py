@@ -0,0 +1,91 @@
+"""
+Microbenchmark for process_child on a sample ordersBulk page (benchmarks/fixtures).
+Compares the precompiled per-table plans with the previous generic
+flatten_fields/stringify_lists/replace_guid_with_id passes, and reports rows/sec for each.
+Both versions hand their rows over with connector.upsert() and are sent by connector.send_rows(), as within update().
+Run from the toast directory: python benchmarks/process_child.py [--rounds N]
+"""
+
+import sys
+import argparse
+import os
+import gzip
+import json
+import copy
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import connector
+from connector import flatten_fields, stringify_lists, replace_guid_with_id, child_relationships, child_fields_to_flatten
+
+FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "orders_bulk_page.json.gz")
+
+class CountingOp:
+    """Stands in for the SDK operations, so the destination is not measured."""
+    @staticmethod
+    def upsert(table, data):
+        return data
+
+    @staticmethod
+    def delete(table, keys):
+        return keys
+
+def legacy_process_child(parent, table_name, id_field_name, id_field):
+    """process_child before the tables were compiled into plans"""
+    for p in parent:
+        p[id_field_name] = id_field
+        if table_name in child_relationships:
+            for child_key, child_table_name in child_relationships[table_name]:
+                if len(p.get(child_key, [])) > 0:
+                    yield from legacy_process_child(p[child_key], child_table_name, table_name + "_id", p["guid"])
+                p.pop(child_key, None)
+        if table_name in child_fields_to_flatten:
+            p = flatten_fields(child_fields_to_flatten[table_name], p)
+        if table_name == "orders_check":
+            p.pop("payments", None)
+        p = stringify_lists(p)
+        p = replace_guid_with_id(p)
+        yield from connector.upsert(table_name, p)
+
+def load_page():
+    with gzip.open(FIXTURE, "rt") as f:
+        return json.load(f)
+
+def run(process, pages):
+    """
+    :return: rows per page, and the time taken by the fastest page
+    """
+    fastest = None
+    for page in pages:
+        rows = 0
+        start = time.perf_counter()
+        for order in page:
+            for _ in connector.send_rows(process(order["checks"], "orders_check", "orders_id", order["guid"])):
+                rows += 1
+        elapsed = time.perf_counter() - start
+        fastest = elapsed if fastest is None else min(fastest, elapsed)
+    return rows, fastest
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rounds", type=int, default=20, help="rounds measured, the fastest is reported")
+    args = parser.parse_args()
+    rounds = args.rounds
+    connector.op = CountingOp
+    # rows are handed over as PendingRows, as within update()
+    connector.pending_rows = True
+    page = load_page()
+
+    results = {}
+    for name, process in [("generic passes", legacy_process_child), ("compiled plans", connector.process_child)]:
+        # both versions modify their input, so each round gets a fresh copy made outside the timer
+        pages = [copy.deepcopy(page) for _ in range(rounds)]
+        rows, elapsed = run(process, pages)
+        results[name] = rows / elapsed
+        print(f"{name:>15}: {rows} rows in {elapsed:.3f}s (fastest of {rounds}), {rows / elapsed:,.0f} rows/sec")
+
+    print(f"speedup: {results['compiled plans'] / results['generic passes']:.2f}x")
+
+if __name__ == "__main__":
+    main()
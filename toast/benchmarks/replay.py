@@ -0,0 +1,317 @@
+"""
+Local stand-in for the Toast API, for running the connector offline in benchmarks and tests.
+ReplayServer serves a response source over HTTP on 127.0.0.1, with optional latency and injected 429 and 409 responses.
+Point the connector at it with the domain setting, e.g. {"domain": server.base_url}.
+
+Response sources:
+- SyntheticToast generates restaurants, config, labor, cash and ordersBulk responses. Orders are copies of the
+  sample page in benchmarks/fixtures with fresh guids, so every order has a realistic check tree,
+  or come from benchmarks/order_trees.py when an OrderShape is given.
+- RecordedToast replays responses saved by Recorder.
+- Recorder forwards requests to the real Toast API and saves the responses to a JSON lines file.
+  Authentication requests are forwarded but never saved.
+"""
+
+import os
+import sys
+import gzip
+import json
+import math
+import time
+import hashlib
+import threading
+from datetime import datetime, timedelta
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qsl
+
+import requests as rq
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from order_trees import generate_orders
+
+FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "orders_bulk_page.json.gz")
+
+# query parameters that change between syncs, left out of the key responses are recorded under
+time_parameters = {"startDate", "endDate", "modifiedStartDate", "modifiedEndDate", "lastModified"}
+
+def json_response(body, headers=None, status=200):
+    return status, headers or {}, json.dumps(body).encode()
+
+class Faults:
+    """
+    Latency and error responses added by ReplayServer in front of the response source
+    :param latency: seconds added to every response
+    :param rate_limit_every: answer every nth request with a 429, 0 disables
+    :param retry_after: Retry-After value sent with the 429s
+    :param conflict_every: answer every nth request that carries a pageToken with a 409, 0 disables.
+        The connector restarts the endpoint without a token, so keep this above the number of pages per endpoint.
+    """
+
+    def __init__(self, latency=0.0, rate_limit_every=0, retry_after=0, conflict_every=0):
+        self.latency = latency
+        self.rate_limit_every = rate_limit_every
+        self.retry_after = retry_after
+        self.conflict_every = conflict_every
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.token_requests = 0
+
+    def inject(self, query):
+        """
+        :param query: query parameters of the request
+        :return: error response to send instead of the real one, or None
+        """
+        with self.lock:
+            self.requests += 1
+            rate_limited = self.rate_limit_every and self.requests % self.rate_limit_every == 0
+            conflict = False
+            if "pageToken" in query:
+                self.token_requests += 1
+                conflict = self.conflict_every and self.token_requests % self.conflict_every == 0
+        if rate_limited:
+            return json_response({"message": "rate limited"}, {"Retry-After": str(self.retry_after)}, 429)
+        if conflict:
+            return json_response({"message": "page token expired"}, status=409)
+        return None
+
+class ReplayServer:
+    """
+    Threaded HTTP server for a response source, used as a context manager
+    :param source: object with a handle(method, path, query, headers, body) method returning (status, headers, payload)
+    :param faults: Faults to apply, or None
+    """
+
+    def __init__(self, source, faults=None):
+        self.source = source
+        self.faults = faults or Faults()
+        self.lock = threading.Lock()
+        self.stats = {"requests": 0, "bytes": 0, "errors_injected": 0}
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self.handler_class())
+        self.server.daemon_threads = True
+        self.base_url = f"http://127.0.0.1:{self.server.server_port}"
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def record(self, payload, injected):
+        with self.lock:
+            self.stats["requests"] += 1
+            self.stats["bytes"] += len(payload)
+            self.stats["errors_injected"] += injected
+
+    def handler_class(self):
+        replay = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # HTTP/1.1 keeps connections open, like the real API
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                self.respond("GET")
+
+            def do_POST(self):
+                self.respond("POST")
+
+            def respond(self, method):
+                url = urlsplit(self.path)
+                query = dict(parse_qsl(url.query))
+                body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                if replay.faults.latency:
+                    time.sleep(replay.faults.latency)
+                injected = replay.faults.inject(query) if method == "GET" else None
+                status, headers, payload = injected or replay.source.handle(method, url.path, query, self.headers, body)
+                replay.record(payload, injected is not None)
+
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+class SyntheticToast:
+    """
+    Generated Toast responses. Output depends only on the request, so repeated syncs see the same data.
+    :param restaurants: number of restaurants
+    :param orders_per_day: orders per restaurant per day of the requested range
+    :param config_pages: pages per config endpoint, linked with Toast-Next-Page-Token
+    :param config_items: records per config page
+    :param employees: employees and jobs per restaurant, and shifts and time entries per day
+    :param cash_entries: cash entries and deposits per business date
+    :param order_shape: OrderShape for generated orders, None serves copies of the sample page
+    """
+
+    def __init__(self, restaurants=3, orders_per_day=50, config_pages=2, config_items=20, employees=10, cash_entries=5,
+                 order_shape=None):
+        self.restaurants = restaurants
+        self.orders_per_day = orders_per_day
+        self.config_pages = config_pages
+        self.config_items = config_items
+        self.employees = employees
+        self.cash_entries = cash_entries
+        self.order_shape = order_shape
+        with gzip.open(FIXTURE, "rt") as f:
+            self.order_templates = [json.dumps(order) for order in json.load(f)]
+
+    def handle(self, method, path, query, headers, body):
+        restaurant = headers.get("Toast-Restaurant-External-ID", "")
+        if path == "/authentication/v1/authentication/login":
+            return json_response({"token": {"accessToken": "replay-token", "expiresIn": 86400}})
+        if path == "/partners/v1/restaurants":
+            return json_response([{"restaurantGuid": f"restaurant-{i}", "restaurantName": f"Restaurant {i}",
+                                   "deleted": False} for i in range(self.restaurants)])
+        if path == "/orders/v2/ordersBulk":
+            return self.orders(restaurant, query)
+        if path.startswith("/config/"):
+            return self.config(restaurant, path, query)
+        if path.startswith("/labor/"):
+            return json_response(self.labor(restaurant, path, query))
+        if path.startswith("/cashmgmt/"):
+            return json_response(self.cash(restaurant, path, query))
+        return json_response({"message": f"no synthetic data for {path}"}, status=404)
+
+    def orders(self, restaurant, query):
+        # a businessDate request returns one day of orders, otherwise every day the range touches
+        if "businessDate" in query:
+            days, start = 1, query["businessDate"]
+        else:
+            days, start = days_between(query.get("startDate"), query.get("endDate")), query.get("startDate")
+        total = self.orders_per_day * days
+        page, page_size = int(query.get("page", 1)), int(query.get("pageSize", 100))
+        first = (page - 1) * page_size
+        count = max(0, min(page_size, total - first))
+        if self.order_shape:
+            seed = f"{restaurant}-{start}-{page}"
+            return json_response(generate_orders(count, self.order_shape, seed))
+        # guids get a prefix that is unique to the restaurant, range and position, references inside an order stay consistent
+        orders = []
+        for i in range(first, first + count):
+            prefix = f"{restaurant}-{start}-{i}-"
+            orders.append(self.order_templates[i % len(self.order_templates)].replace('"guid": "', f'"guid": "{prefix}'))
+        return 200, {}, ("[" + ", ".join(orders) + "]").encode()
+
+    def config(self, restaurant, path, query):
+        page = int(query.get("pageToken", 0))
+        items = [{"guid": f"{restaurant}{path}-{page}-{i}", "entityType": path.rsplit("/", 1)[-1],
+                  "name": f"item {i}", "menu": {"guid": "menu-1"}, "revenueCenter": {"guid": "revenue-center-1"},
+                  "serviceArea": {"guid": "service-area-1"}, "tags": ["a", "b"], "modifiedDate": query.get("lastModified")}
+                 for i in range(self.config_items)]
+        headers = {"Toast-Next-Page-Token": str(page + 1)} if page + 1 < self.config_pages else {}
+        return json_response(items, headers)
+
+    def labor(self, restaurant, path, query):
+        reference = lambda kind, i: {"guid": f"{restaurant}-{kind}-{i}", "entityType": kind}
+        if path == "/labor/v1/jobs":
+            return [{"guid": f"{restaurant}-job-{i}", "title": f"job {i}", "wageFrequency": "HOURLY"}
+                    for i in range(self.employees)]
+        if path == "/labor/v1/employees":
+            return [{"guid": f"{restaurant}-employee-{i}", "firstName": "First", "lastName": f"Last {i}",
+                     "jobReferences": [reference("job", i)],
+                     "wageOverrides": [{"wage": 20.0, "jobReference": reference("job", i)}]}
+                    for i in range(self.employees)]
+        start = query.get("startDate") or query.get("modifiedStartDate")
+        days = days_between(start, query.get("endDate") or query.get("modifiedEndDate"))
+        if path == "/labor/v1/shifts":
+            return [{"guid": f"{restaurant}-{start}-shift-{i}", "employeeReference": reference("employee", i),
+                     "jobReference": reference("job", i), "scheduleConfig": {"guid": "schedule", "type": "weekly"}}
+                    for i in range(self.employees * days)]
+        return [{"guid": f"{restaurant}-{start}-time-entry-{i}", "employeeReference": reference("employee", i),
+                 "jobReference": reference("job", i), "shiftReference": reference("shift", i),
+                 "breaks": [{"guid": f"{restaurant}-{start}-break-{i}", "breakType": reference("breakType", 0)}]}
+                for i in range(self.employees * days)]
+
+    def cash(self, restaurant, path, query):
+        date = query.get("businessDate")
+        person = {"guid": f"{restaurant}-employee-0", "entityType": "RestaurantUser"}
+        if path == "/cashmgmt/v1/deposits":
+            return [{"guid": f"{restaurant}-{date}-deposit-{i}", "amount": 100.0, "employee": person,
+                     "creator": person} for i in range(self.cash_entries)]
+        return [{"guid": f"{restaurant}-{date}-entry-{i}", "amount": 5.0, "type": "CASH_IN",
+                 "approverOrShiftReviewSubject": person, "creatorOrShiftReviewSubject": person,
+                 "cashDrawer": {"guid": "drawer"}, "employee1": person, "employee2": None,
+                 "payoutReason": None, "noSaleReason": None} for i in range(self.cash_entries)]
+
+def days_between(start, end):
+    """Number of days a request range touches, at least 1."""
+    if not start or not end:
+        return 1
+    start = datetime.fromisoformat(start.replace("Z", "+00:00"))
+    end = datetime.fromisoformat(end.replace("Z", "+00:00"))
+    return max(1, math.ceil((end - start) / timedelta(days=1)))
+
+def recording_key(path, query, headers):
+    """Key a response is recorded under: the path, restaurant and query without the sync's time range."""
+    params = sorted((k, v) for k, v in query.items() if k not in time_parameters)
+    key = json.dumps([path, headers.get("Toast-Restaurant-External-ID", ""), params])
+    return hashlib.sha1(key.encode()).hexdigest()
+
+class Recorder:
+    """
+    Forwards requests to the real Toast API and appends every GET response to a JSON lines file
+    :param upstream: Toast API URL, e.g. https://ws-api.toasttab.com
+    :param path: recording file
+    """
+
+    def __init__(self, upstream, path):
+        self.upstream = upstream.rstrip("/")
+        self.path = path
+        self.lock = threading.Lock()
+        self.session = rq.Session()
+
+    def handle(self, method, path, query, headers, body):
+        forward = {name: headers[name] for name in ["Authorization", "Content-Type", "Toast-Restaurant-External-ID"]
+                   if headers.get(name)}
+        response = self.session.request(method, self.upstream + path, params=query, headers=forward, data=body)
+        response_headers = {name: response.headers[name] for name in ["Toast-Next-Page-Token", "Retry-After"]
+                            if name in response.headers}
+        if method == "GET":
+            line = json.dumps({"key": recording_key(path, query, headers), "path": path, "status": response.status_code,
+                               "headers": response_headers, "body": response.content.decode("utf-8")})
+            with self.lock, open(self.path, "a") as f:
+                f.write(line + "\n")
+        return response.status_code, response_headers, response.content
+
+class RecordedToast:
+    """
+    Replays a file written by Recorder. Responses are matched on path, restaurant and query parameters,
+    ignoring the time range, since that moves with every sync. Several responses under the same key are served in
+    recorded order, wrapping around. Requests without a recording get an empty list.
+    :param path: recording file
+    """
+
+    def __init__(self, path):
+        self.responses = {}
+        self.served = {}
+        self.lock = threading.Lock()
+        self.missing = 0
+        with open(path) as f:
+            for line in f:
+                recorded = json.loads(line)
+                self.responses.setdefault(recorded["key"], []).append(
+                    (recorded["status"], recorded["headers"], recorded["body"].encode("utf-8")))
+
+    def handle(self, method, path, query, headers, body):
+        if path == "/authentication/v1/authentication/login":
+            return json_response({"token": {"accessToken": "replay-token", "expiresIn": 86400}})
+        key = recording_key(path, query, headers)
+        with self.lock:
+            responses = self.responses.get(key)
+            if not responses:
+                self.missing += 1
+                return json_response([])
+            index = self.served.get(key, 0)
+            self.served[key] = index + 1
+        return responses[index % len(responses)]
@@ -0,0 +1,71 @@
+"""
+Benchmark for the shared HTTP session used by the Toast connector.
+Starts a local stub server and compares per-request latency of one-off rq.get calls,
+which open a new connection for every request, with get_api_response on the pooled keep-alive session.
+Run from the toast directory: python benchmarks/session_pooling.py [--requests N]
+"""
+
+import sys
+import argparse
+import os
+import time
+import json
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import requests as rq
+import connector
+from fivetran_connector_sdk import Logging as log
+
+class StubHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 so the server keeps connections open between requests
+    protocol_version = "HTTP/1.1"
+    # headers and body go out in separate writes, avoid the Nagle/delayed-ACK stall on kept-alive sockets
+    disable_nagle_algorithm = True
+    body = json.dumps([{"guid": "stub", "name": "stub"}]).encode()
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, format, *args):
+        pass
+
+def time_requests(fetch, url, count):
+    start = time.perf_counter()
+    for _ in range(count):
+        fetch(url)
+    return (time.perf_counter() - start) / count
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=500, help="requests per measurement")
+    args = parser.parse_args()
+    count = args.requests
+    log.LOG_LEVEL = log.Level.WARNING
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}/config/v2/menus"
+
+    try:
+        unpooled = time_requests(lambda u: rq.get(u, headers={}).json(), url, count)
+        connector.configure_session({})
+        # the shared rate limiter would otherwise pace the pooled requests to Toast's 20 per second
+        connector.rate_limiter.configure(1e9)
+        pooled = time_requests(lambda u: connector.get_api_response(u, {}), url, count)
+    finally:
+        server.shutdown()
+
+    print(f"{count} requests against {url}")
+    print(f"new connection per request: {unpooled * 1000:.3f} ms/request")
+    print(f"pooled keep-alive session:  {pooled * 1000:.3f} ms/request")
+    print(f"latency drop: {(1 - pooled / unpooled) * 100:.1f}%")
+
+if __name__ == "__main__":
+    main()
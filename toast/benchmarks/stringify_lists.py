@@ -0,0 +1,98 @@
+"""
+Throughput benchmark for list serialization: the str() lists are written with by default against listFormat=json.
+Two inputs are measured:
+- page: every list the order transforms stringify on the sample page in benchmarks/fixtures, recorded by running
+  order_operations over it, so mostly short lists such as pricingFeatures repeated on every row
+- nested: the checks lists of synthetic orders from benchmarks/order_trees.py, the big nested lists a connector
+  that does not split orders into child tables (e.g. examples/toast_example) writes as one value
+and each is converted with:
+- str: the default, Python repr of the list
+- json: json_list, the listFormat=json path, cached and with orjson when it is installed
+- json uncached: encode_json without the small-list cache
+- json module: the standard library encoder only, as json_list runs without orjson
+Run from the toast directory: python benchmarks/stringify_lists.py [--rounds N]
+"""
+
+import sys
+import argparse
+import os
+import gzip
+import json
+import copy
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import connector
+from order_trees import OrderShape, generate_orders
+
+FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "orders_bulk_page.json.gz")
+
+class CountingOp:
+    """Stands in for the SDK operations, so only the transform runs."""
+    @staticmethod
+    def upsert(table, data):
+        return data
+
+    @staticmethod
+    def delete(table, keys):
+        return keys
+
+def page_lists():
+    """Lists stringified while the order transforms run over the sample page, in the order they are stringified."""
+    with gzip.open(FIXTURE, "rt") as f:
+        orders = json.load(f)
+    lists = []
+    def record(value):
+        lists.append(copy.deepcopy(value))
+        return str(value)
+    connector.op = CountingOp
+    connector.list_to_string = record
+    try:
+        for order in orders:
+            for _ in connector.order_operations("orders", "restaurant", order):
+                pass
+    finally:
+        connector.list_to_string = str
+    return lists
+
+def nested_lists():
+    orders = generate_orders(50, OrderShape(selections=20, modifier_depth=2), seed=1)
+    return [order["checks"] for order in orders]
+
+def json_module(value):
+    return connector.json_encoder.encode(value)
+
+def measure(convert, lists, rounds):
+    """
+    :return: seconds for the fastest round, and characters produced per round
+    """
+    elapsed = float("inf")
+    for _ in range(rounds):
+        connector.json_list_cache.clear()  # every round starts cold, as a sync does
+        start = time.perf_counter()
+        for value in lists:
+            convert(value)
+        elapsed = min(elapsed, time.perf_counter() - start)  # best round, the least disturbed by other processes
+    return elapsed, sum(len(convert(value)) for value in lists)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rounds", type=int, default=20, help="rounds measured, the fastest is reported")
+    args = parser.parse_args()
+    rounds = args.rounds
+    converters = [("str", str), ("json", connector.json_list), ("json uncached", connector.encode_json),
+                  ("json module", json_module)]
+    print(f"orjson {'installed' if connector.orjson else 'not installed'}")
+    print(f"{'':>7}  {'':>13}  {'lists/sec':>10}  {'MB/sec':>8}  {'KB out':>8}  {'vs str':>7}")
+    for name, lists in [("page", page_lists()), ("nested", nested_lists())]:
+        baseline = None
+        for converter, convert in converters:
+            elapsed, chars = measure(convert, lists, rounds)
+            baseline = baseline or elapsed
+            print(f"{name:>7}  {converter:>13}  {len(lists) / elapsed:>10.0f}  {chars / elapsed / 1e6:>8.1f}  "
+                  f"{chars / 1024:>8.1f}  {baseline / elapsed:>6.2f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+"""
+End-to-end throughput benchmark for the Toast connector.
+Runs the full update() generator against the local replay server in benchmarks/replay.py and reports rows/sec,
+requests/sec and peak RSS for a set of connector configurations. Each scenario runs in its own process,
+so peak RSS is measured per scenario.
+
+Run from the toast directory:
+    python benchmarks/sync_throughput.py                         synthetic data, every scenario
+    python benchmarks/sync_throughput.py --scenario async        a single scenario
+    python benchmarks/sync_throughput.py --latency 0.02 --restaurants 10 --days 7
+    python benchmarks/sync_throughput.py --order-shape '{"selections": 50, "modifier_depth": 3}'
+    python benchmarks/sync_throughput.py --record https://ws-api.toasttab.com --recording toast.jsonl \\
+        --configuration configuration.json                     record a real sync, needs real credentials
+    python benchmarks/sync_throughput.py --recording toast.jsonl replay a recording
+"""
+
+import sys
+import os
+import json
+import time
+import resource
+import argparse
+import subprocess
+from collections import Counter
+from datetime import datetime, timezone, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from cryptography.fernet import Fernet
+from fivetran_connector_sdk import Logging as log
+
+import connector
+from replay import ReplayServer, SyntheticToast, RecordedToast, Recorder, Faults
+from order_trees import OrderShape
+
+# connector settings and injected faults for each scenario
+scenarios = {
+    "serial": ({}, {}),
+    "threads": ({"maxConcurrency": "8"}, {}),
+    "threads+prefetch": ({"maxConcurrency": "8", "prefetchPages": "2"}, {}),
+    "async": ({"engine": "async", "maxConcurrency": "100"}, {}),
+    "threads+batching": ({"maxConcurrency": "8", "batchRows": "5000"}, {}),
+    "threads+business-dates": ({"maxConcurrency": "8", "ordersByBusinessDate": "true"}, {}),
+    "threads+faults": ({"maxConcurrency": "8"}, {"rate_limit_every": 50, "conflict_every": 7}),
+}
+
+class CountingOp:
+    """Stands in for the SDK operations and counts them, so the benchmark does not need a running SDK."""
+    counts = Counter()
+
+    @staticmethod
+    def upsert(table, data):
+        CountingOp.counts["upsert"] += 1
+
+    @staticmethod
+    def delete(table, keys):
+        CountingOp.counts["delete"] += 1
+
+    @staticmethod
+    def checkpoint(state):
+        CountingOp.counts["checkpoint"] += 1
+
+def run_scenario(name, args):
+    """
+    Runs one sync in this process
+    :return: dictionary of results
+    """
+    settings, faults = scenarios[name]
+    if args.record:
+        source = Recorder(args.record, args.recording)
+    elif args.recording:
+        source = RecordedToast(args.recording)
+    else:
+        shape = OrderShape(**json.loads(args.order_shape)) if args.order_shape else None
+        source = SyntheticToast(restaurants=args.restaurants, orders_per_day=args.orders_per_day, order_shape=shape)
+
+    configuration = {"key": Fernet.generate_key().decode(), "clientId": "replay", "clientSecret": "replay",
+                     "userAccessType": "TOAST_MACHINE_CLIENT", "requestsPerSecond": str(args.requests_per_second),
+                     "initialSyncStart": (datetime.now(timezone.utc) - timedelta(days=args.days))
+                     .isoformat(timespec="milliseconds").replace("+00:00", "Z")}
+    if args.configuration:
+        with open(args.configuration) as f:
+            configuration.update(json.load(f))
+    configuration.update(settings)
+
+    connector.op = CountingOp
+    with ReplayServer(source, Faults(latency=args.latency, **faults)) as server:
+        configuration["domain"] = server.base_url
+        start = time.perf_counter()
+        for _ in connector.update(configuration, {}):
+            pass
+        elapsed = time.perf_counter() - start
+
+    rows = CountingOp.counts["upsert"] + CountingOp.counts["delete"]
+    return {"scenario": name, "seconds": round(elapsed, 3), "rows": rows,
+            "requests": server.stats["requests"], "errors_injected": server.stats["errors_injected"],
+            "rows_per_sec": round(rows / elapsed), "requests_per_sec": round(server.stats["requests"] / elapsed, 1),
+            # ru_maxrss is in kilobytes on Linux
+            "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenario", choices=list(scenarios), help="run a single scenario in this process")
+    parser.add_argument("--restaurants", type=int, default=3)
+    parser.add_argument("--orders-per-day", type=int, default=100)
+    parser.add_argument("--order-shape", help="JSON of OrderShape fields, generates orders instead of copying the sample page")
+    parser.add_argument("--days", type=int, default=3, help="days between initialSyncStart and now")
+    parser.add_argument("--latency", type=float, default=0.005, help="seconds added to every response")
+    parser.add_argument("--requests-per-second", type=float, default=1000)
+    parser.add_argument("--recording", help="replay responses from this file, or record to it with --record")
+    parser.add_argument("--record", metavar="UPSTREAM", help="forward to this Toast API URL and record the responses")
+    parser.add_argument("--configuration", help="JSON file of connector configuration, e.g. real credentials")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+    log.LOG_LEVEL = log.Level.WARNING
+
+    if args.scenario or args.record:
+        # recording only needs to happen once
+        result = run_scenario(args.scenario or "serial", args)
+        print(json.dumps(result) if args.json else result)
+        return
+
+    results = []
+    for name in scenarios:
+        command = [sys.executable, os.path.abspath(__file__), "--scenario", name, "--json"] + sys.argv[1:]
+        output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+
+    if args.json:
+        print(json.dumps(results))
+        return
+    columns = ["scenario", "seconds", "rows", "requests", "errors_injected", "rows_per_sec", "requests_per_sec",
+               "peak_rss_mb"]
+    print("  ".join(f"{c:>16}" for c in columns))
+    for result in results:
+        print("  ".join(f"{result[c]:>16}" for c in columns))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+"""
+Allocation benchmark for the row helpers used on ordersBulk pages: flatten_fields, flatten_dict and stringify_lists.
+Runs the order and payment transforms of order_operations/process_payments over the sample page in benchmarks/fixtures
+three ways, and reports time and tracemalloc figures for each:
+- legacy: the helpers before interned key names, copying every row
+- copy: the current helpers in their default, copying mode
+- in place: in_place=True, which mutates the rows instead of copying them
+Run from the toast directory: python benchmarks/transform_allocations.py [--rounds N]
+"""
+
+import sys
+import argparse
+import os
+import gzip
+import json
+import copy
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from connector import flatten_fields, stringify_lists, replace_guid_with_id
+
+FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "orders_bulk_page.json.gz")
+
+# the fields order_operations and process_payments flatten
+order_fields = ["server", "createdDevice", "lastModifiedDevice"]
+payment_fields = ["cashDrawer", "createdDevice", "lastModifiedDevice", "otherPayment", "refund", "server"]
+
+def legacy_stringify_lists(d):
+    new_dict = {}
+    for key, value in d.items():
+        new_dict[key] = str(value) if isinstance(value, list) else value
+    return new_dict
+
+def legacy_flatten_dict(parent_row, dict_field, prefix):
+    """flatten_dict before key names were interned, building every prefixed name again for every row"""
+    if not dict_field:
+        return parent_row
+    dict_field = replace_guid_with_id(dict_field)
+    for key, value in dict_field.items():
+        if key.startswith(prefix):
+            new_key = key
+        elif key == "tipRefundAmount" and prefix == "refund":
+            new_key = "refund_tip_amount"
+        elif prefix in ["refundDetails", "jobReference"]:
+            new_key = key
+        else:
+            new_key = f"{prefix}_{key}"
+        if isinstance(value, dict):
+            legacy_flatten_dict(parent_row, value, new_key)
+        else:
+            parent_row[new_key] = value
+    return parent_row
+
+def legacy_flatten_fields(fields, row):
+    row = replace_guid_with_id({**row})
+    for field in fields:
+        value = row.get(field)
+        if value is not None:
+            row = legacy_flatten_dict(row, value, field)
+        row.pop(field, None)
+    return row
+
+def legacy(order):
+    for check in order.get("checks") or []:
+        for payment in check.get("payments") or []:
+            replace_guid_with_id(legacy_flatten_fields(payment_fields, payment))
+    order = legacy_flatten_fields(order_fields, order)
+    order.pop("checks", None)
+    return replace_guid_with_id(legacy_stringify_lists(order))
+
+def copying(order):
+    for check in order.get("checks") or []:
+        for payment in check.get("payments") or []:
+            replace_guid_with_id(flatten_fields(payment_fields, payment))
+    order = flatten_fields(order_fields, order)
+    order.pop("checks", None)
+    return replace_guid_with_id(stringify_lists(order))
+
+def in_place(order):
+    for check in order.get("checks") or []:
+        for payment in check.get("payments") or []:
+            replace_guid_with_id(flatten_fields(payment_fields, payment, in_place=True))
+    order = flatten_fields(order_fields, order, in_place=True)
+    order.pop("checks", None)
+    return replace_guid_with_id(stringify_lists(order, in_place=True))
+
+def measure(transform, page, rounds):
+    """
+    :return: seconds for the fastest round, and the sum and largest of the per-order tracemalloc peaks,
+        which approximate the short-lived allocations the transform makes
+    """
+    # every variant modifies its input somewhere, so each round gets a fresh copy made outside the timer
+    pages = [copy.deepcopy(page) for _ in range(rounds)]
+    # in place, popping checks drops the last reference to the check trees; keep them so every variant frees them
+    # outside the timer, as the connector frees them after the order's children are processed
+    checks = [order.get("checks") for orders in pages for order in orders]
+    elapsed = float("inf")
+    for orders in pages:
+        start = time.perf_counter()
+        for order in orders:
+            transform(order)
+        elapsed = min(elapsed, time.perf_counter() - start)  # best round, the least disturbed by other processes
+
+    orders = copy.deepcopy(page)
+    checks = [order.get("checks") for order in orders]
+    tracemalloc.start()
+    transient = largest = 0
+    for order in orders:
+        before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        row = transform(order)
+        peak = tracemalloc.get_traced_memory()[1] - before
+        transient += peak
+        largest = max(largest, peak)
+        del row
+    tracemalloc.stop()
+    return elapsed, transient, largest
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rounds", type=int, default=20, help="rounds measured, the fastest is reported")
+    args = parser.parse_args()
+    rounds = args.rounds
+    with gzip.open(FIXTURE, "rt") as f:
+        page = json.load(f)
+
+    results = {}
+    print(f"{'':>9}  {'ms/page':>9}  {'transient KB/page':>18}  {'largest order KB':>17}")
+    for name, transform in [("legacy", legacy), ("copy", copying), ("in place", in_place)]:
+        elapsed, transient, largest = measure(transform, page, rounds)
+        results[name] = (elapsed, transient)
+        print(f"{name:>9}  {elapsed * 1000:>9.3f}  {transient / 1024:>18.1f}  {largest / 1024:>17.1f}")
+
+    print(f"in place vs legacy: {results['legacy'][0] / results['in place'][0]:.2f}x faster, "
+          f"{(1 - results['in place'][1] / results['legacy'][1]) * 100:.0f}% fewer transient bytes")
+
+if __name__ == "__main__":
+    main()
@@ -11,14 +11,42 @@ import traceback
 from datetime import datetime, timezone, timedelta
 import time
 import json
+import codecs
+import hashlib
 import copy
 import uuid
+import sqlite3
+import queue
+import sys
+import threading
+import asyncio
+import inspect
+from collections import deque, namedtuple, Counter
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from requests.adapters import HTTPAdapter
 from cryptography.fernet import Fernet
 
+try:
+    import aiohttp  # only needed for the async engine, see read_settings
+except ImportError:
+    aiohttp = None
+
+try:
+    import orjson  # faster encoder for listFormat=json, the json module is used without it
+except ImportError:
+    orjson = None
+
 from fivetran_connector_sdk import Connector # For supporting Connector operations like Update() and Schema()
 from fivetran_connector_sdk import Operations as op # For supporting Data operations like Upsert(), Update(), Delete() and checkpoint()
 from fivetran_connector_sdk import Logging as log # For enabling Logs in your connector code
 
+# Shared HTTP session, so every Toast request reuses pooled keep-alive connections
+# instead of paying a new TCP+TLS handshake. Created lazily by get_session() or configure_session().
+session = None
+session_lock = threading.Lock()
+
 def update(configuration: dict, state: dict):
     """
     # Define the update function, which is a required function, and is called by Fivetran during each sync.
@@ -29,17 +57,22 @@ def update(configuration: dict, state: dict):
     :param state: a dictionary contains whatever state you have chosen to checkpoint during the prior sync
     """
 
-    try:
-        domain = configuration["domain"]
-        base_url = f"https://{domain}"
-        key = configuration["key"]
-        headers, state = make_headers(configuration, base_url, state, key)
-
-        start_timestamp = datetime.now(timezone.utc).isoformat("T", "milliseconds").replace("+00:00", "Z")
-        from_ts, to_ts = set_timeranges(state, configuration, start_timestamp)
+    global pending_rows, list_to_string
+    metrics.reset()
+    settings = read_settings(configuration)
 
-        # start the sync
-        yield from sync_items(base_url, headers, from_ts, to_ts, start_timestamp, state)
+    try:
+        if settings["list_format"] == "json":
+            list_to_string = json_list
+        # tasks on worker threads and the event loop only yield PendingRows, which become operations here,
+        # in the thread that yields them to the SDK
+        pending_rows = True
+        operations = sync(configuration, state, settings)
+        if settings["batch_rows"]:
+            operations = batch_by_table(operations, settings["batch_rows"], settings["batch_bytes"])
+        else:
+            operations = send_rows(operations)
+        yield from operations
 
     except Exception as e:
         # Return error response
@@ -48,39 +81,125 @@ def update(configuration: dict, state: dict):
         detailed_message = f"Error Message: {exception_message}\nStack Trace:\n{stack_trace}"
         raise RuntimeError(detailed_message)
 
-def sync_items(base_url, headers, ts_from, ts_to, start_timestamp, state):
+    finally:
+        pending_rows = False
+        list_to_string = str
+        close_fingerprint_index()
+        # reported on failures too, since slow or failing syncs are when the numbers matter most
+        log.info(metrics.summary())
+        if settings["metrics_export_path"]:
+            metrics.export(settings["metrics_export_path"])
+
+def sync(configuration, state, settings):
+    """
+    Generator of all operations for a sync, called by update()
+    :param configuration: a dictionary that holds the configuration settings for the connector.
+    :param state: connector state
+    :param settings: performance settings from read_settings()
+    :return:
+    """
+    domain = configuration["domain"]
+    # a domain with a scheme is used as is, e.g. http://127.0.0.1:8080 for the replay server in benchmarks/replay.py
+    base_url = domain if "://" in domain else f"https://{domain}"
+    key = configuration["key"]
+
+    # each backfill shard runs its own max_workers tasks
+    configure_session(configuration, settings["max_workers"] * settings["backfill_workers"])
+    # Toast allows 20 requests per second per client, shared by all workers
+    rate_limiter.configure(float(configuration.get("requestsPerSecond", 20)))
+    headers, state = make_headers(configuration, base_url, state, key)
+    if settings["fingerprint_index_path"]:
+        open_fingerprint_index(settings["fingerprint_index_path"], schema(configuration), state)
+
+    start_timestamp = datetime.now(timezone.utc).isoformat("T", "milliseconds").replace("+00:00", "Z")
+    from_ts, to_ts = set_timeranges(state, configuration, start_timestamp)
+
+    # an unfinished backfill is always resumed, even if backfillConcurrency has since been lowered.
+    # An unfinished window of sync_items is finished first
+    if "backfill" in state or ("window" not in state and settings["backfill_workers"] > 1
+                               and is_older_than_30_days(from_ts)):
+        yield from sync_backfill(base_url, headers, from_ts, start_timestamp, state, settings)
+        from_ts, to_ts = set_timeranges(state, configuration, start_timestamp)
+
+    # start the sync, unless a backfill has already caught up to the start of this sync
+    if from_ts < start_timestamp:
+        yield from sync_items(base_url, headers, from_ts, to_ts, start_timestamp, state, settings)
+    yield from commit_fingerprint_index(state)
+
+def read_settings(configuration):
+    """
+    Reads the optional performance settings from the configuration.
+    Configuration values are strings, missing settings fall back to the serial defaults.
+    :param configuration: a dictionary that holds the configuration settings for the connector.
+    :return: dictionary of settings
+    """
+    # "threads" runs endpoint units on a thread pool, "async" runs them as coroutines on one event loop
+    engine = str(configuration.get("engine", "threads")).lower()
+    return {
+        "engine": engine,
+        # number of restaurant/endpoint units fetched in parallel, 1 keeps the sync fully serial.
+        # With the async engine these are coroutines rather than threads, so hundreds are cheap
+        "max_workers": int(configuration.get("maxConcurrency", 100 if engine == "async" else 1)),
+        # number of 30-day shards processed in parallel during a historical backfill
+        "backfill_workers": int(configuration.get("backfillConcurrency", 1)),
+        # number of pages fetched ahead of the page being processed, 0 disables prefetching
+        "prefetch_pages": int(configuration.get("prefetchPages", 0)),
+        # skip re-upserting config, job and employee pages that are unchanged since the last sync
+        "config_cache": str(configuration.get("configCache", "false")).lower() == "true",
+        # SQLite file of row fingerprints kept between syncs, empty disables row-level change detection
+        "fingerprint_index_path": configuration.get("fingerprintIndexPath", ""),
+        # file the sync metrics are exported to, .prom for Prometheus text format, otherwise JSON lines
+        "metrics_export_path": configuration.get("metricsExportPath", ""),
+        # rows buffered per sync and grouped by destination table before they are sent, 0 sends every row as it is made
+        "batch_rows": int(configuration.get("batchRows", 0)),
+        # approximate size limit of the buffered rows
+        "batch_bytes": int(configuration.get("batchBytes", 8 * 1024 * 1024)),
+        # how list values are written: "python" keeps str() of the list, "json" writes compact JSON
+        "list_format": str(configuration.get("listFormat", "python")).lower(),
+        # fetch ordersBulk one business date at a time instead of one startDate/endDate range per restaurant.
+        # Days are separate units, fetched in parallel and checkpointed as they complete. Orders are then selected by
+        # business date rather than by modification time, so changes to orders of earlier business dates are not picked up
+        "orders_by_business_date": str(configuration.get("ordersByBusinessDate", "false")).lower() == "true",
+        # minimum time between the checkpoints that record completed restaurant endpoints, 0 checkpoints after every one.
+        # The end of each window is always checkpointed
+        "checkpoint_seconds": float(configuration.get("checkpointSeconds", 30)),
+    }
+
+def sync_items(base_url, headers, ts_from, ts_to, start_timestamp, state, settings=None):
     """
     This is the main generator function for the connector.
     It yields from other functions that are specific to the endpoint type.
+    Each timerange is a window in state["window"], which records the restaurant endpoints completed in it.
+    Endpoints complete in the order restaurant_tasks lists them, so the window records the number completed per restaurant.
+    Completed endpoints are checkpointed at most every settings["checkpoint_seconds"], and a resumed sync fetches
+    only the endpoints that were not checkpointed. state["to_ts"] moves to the end of the window once all of them have.
     :param base_url: Toast API URL
     :param headers: authentication headers
     :param ts_from: Timestamp to start the current iteration
     :param ts_to: Timestamp to end the current iteration
     :param start_timestamp: timestamp that the sync was started
+    :param settings: performance settings from read_settings()
     :return:
     """
+    settings = settings or read_settings({})
     more_data = True
-    first_pass = False   # indicates whether to call endpoints that don't have an end timestamp
-
-    # config endpoint is a list of tuples ("endpoint", "destination_table_name")
-    config_endpoints = [("/config/v2/alternatePaymentTypes", "alternate_payment_types"),
-                        ("/config/v2/diningOptions", "dining_option"),
-                        ("/config/v2/discounts", "discounts"),
-                        ("/config/v2/menus", "menu"),
-                        ("/config/v2/menuGroups", "menu_group"),
-                        ("/config/v2/menuItems", "menu_item"),
-                        ("/config/v2/restaurantServices", "restaurant_service"),
-                        ("/config/v2/revenueCenters", "revenue_center"),
-                        ("/config/v2/salesCategories", "sale_category"),
-                        ("/config/v2/serviceAreas", "service_area"),
-                        ("/config/v2/tables", "tables")]
+    # indicates whether to call endpoints that don't have an end timestamp, kept when an unfinished window is resumed
+    first_pass = state.get("window", {}).get("first_pass", True)
+    # page hashes and high-water marks of config endpoints, see process_config
+    cache = state.setdefault("config_cache", {}) if settings["config_cache"] else None
 
     while more_data:
         # set timerange dicts
         timerange_params = {"startDate": ts_from, "endDate": ts_to}
         modified_params = {"modifiedStartDate": ts_from, "modifiedEndDate": ts_to}
         config_params = {"lastModified": ts_from}
-        state["to_ts"] = ts_to
+        window = state.setdefault("window", {"from": ts_from, "to": ts_to, "first_pass": first_pass,
+                                             "orders_by_business_date": settings["orders_by_business_date"],
+                                             "completed": {}})
+        completed = window["completed"]
+        # the endpoints of a restaurant depend on ordersByBusinessDate, so an unfinished window keeps the value it started with
+        window_settings = dict(settings, orders_by_business_date=window.get("orders_by_business_date",
+                                                                            settings["orders_by_business_date"]))
         log.fine(f"state updated, new state: {repr(state)}")
 
         # Get response from API call.
@@ -94,44 +213,33 @@ def sync_items(base_url, headers, ts_from, ts_to, start_timestamp, state):
         # The 'upsert' operation inserts the data into the destination.
         restaurant_count = len(response_page)
         log.info(f"***** timerange is from {ts_from} to {ts_to} ***** ")
+        tasks = []
         for index, r in enumerate(response_page):
-            id = r["restaurantGuid"]
-            #rename some fields in response
-            rename_fields = [("restaurantGuid", "id"), ("restaurantName", "name")]
-            for old_name, new_name in rename_fields:
-                r[new_name] = r.pop(old_name)
-            log.info(f"***** starting restaurant {id}, {index + 1} of {restaurant_count} ***** ")
-            yield op.upsert(table="restaurant", data=r)
-
-            if r.get("deleted") and "id" in r:
-                yield op.delete(table="restaurant", keys={"id": r["id"]})
-
-            # config endpoints
-            # only process these on the first pass since they don't have an end timestamp
-            if first_pass:
-                for endpoint, table_name in config_endpoints:
-                    yield from process_config(base_url, headers, endpoint,table_name, id, config_params)
-
-                # no timerange_params, only sync during first pass
-                for endpoint, table_name in [("/labor/v1/jobs", "job"),("/labor/v1/employees", "employee")]:
-                    yield from process_labor(base_url, headers, endpoint, table_name, id)
-
-            # cash management endpoints
-            yield from process_cash(base_url, headers, "/cashmgmt/v1/entries", "cash_entry", id, timerange_params)
-            yield from process_cash(base_url, headers, "/cashmgmt/v1/deposits", "cash_deposit", id, timerange_params)
-
-            # orders
-            yield from process_orders(base_url, headers, "/orders/v2/ordersBulk", "orders", id, timerange_params)
-
-            # labor endpoints
-            # these two endpoints can only retrieve 30 days at a time
-            yield from process_labor(base_url, headers, "/labor/v1/shifts", "shift", id, params=timerange_params)
-            yield from process_labor(base_url, headers, "/labor/v1/timeEntries", "time_entry", id, params=modified_params)
+            rst_id = r["restaurantGuid"]
+            tasks.extend(restaurant_tasks(base_url, headers, r, index, restaurant_count, first_pass,
+                                          config_params, timerange_params, modified_params, window_settings, cache,
+                                          completed=completed.get(rst_id, 0)))
+
+        # tasks run on a bounded worker pool but are yielded in the order listed above,
+        # so every operation of an endpoint is emitted before the checkpoint that records it as completed
+        last_checkpoint = time.monotonic()
+        for item in run_tasks(tasks, window_settings):
+            if isinstance(item, UnitDone):
+                completed[item.restaurant] = item.position + 1
+                # cache entries reach the state only with the checkpoint that records their unit as completed
+                if item.cache:
+                    cache.update(item.cache)
+                if time.monotonic() - last_checkpoint >= settings["checkpoint_seconds"]:
+                    last_checkpoint = time.monotonic()
+                    yield op.checkpoint(state)
+            else:
+                yield item
 
         # Save the progress by checkpointing the state. This is important for ensuring that the sync process can resume
         # from the correct position in case of interruptions.
-        # checkpointing every 30 days for convenience,
-        # since we can only ask for 30 days of shifts and time entries at a time
+        # windows are 30 days at most, since we can only ask for 30 days of shifts and time entries at a time
+        state["to_ts"] = ts_to
+        state.pop("window")
         yield op.checkpoint(state)
         first_pass = False
 
@@ -142,20 +250,828 @@ def sync_items(base_url, headers, ts_from, ts_to, start_timestamp, state):
         else:
             more_data = False
 
-def process_config(base_url, headers, endpoint, table_name, rst_id, timerange):
+def sync_backfill(base_url, headers, from_ts, end_ts, state, settings):
+    """
+    Generator for historical backfills.
+    The range from from_ts to end_ts is split into independent 30-day shards, and up to
+    settings["backfill_workers"] shards are processed at once. Operations within a shard keep their serial order, but shards emit
+    as they go, so operations from different shards interleave. A shard is recorded as completed in
+    state["backfill"] and checkpointed only after all of its operations have been yielded, so a resumed
+    sync redoes unfinished shards only. Once every shard is done, state["to_ts"] is set to the end of the range.
+    The endpoints without an end timestamp, which sync_items calls on its first pass, run once alongside the shards
+    with lastModified at the start of the range, and are recorded as completed as "first_pass".
+    :param base_url: Toast API URL
+    :param headers: authentication headers
+    :param from_ts: start of the range, used when no backfill is in progress
+    :param end_ts: end of the range, used when no backfill is in progress
+    :param state: connector state
+    :param settings: performance settings from read_settings()
+    :return:
+    """
+    backfill = state.setdefault("backfill", {"start": from_ts, "end": end_ts, "completed": []})
+    completed = set(backfill["completed"])
+    shards = [shard for shard in generate_shards(backfill["start"], backfill["end"]) if shard[0] not in completed]
+    log.info(f"backfill from {backfill['start']} to {backfill['end']}: "
+             f"{len(shards)} shards left, {len(completed)} completed")
+
+    response_page, next_token = get_api_response(base_url + "/partners/v1/restaurants", headers)
+    restaurants = response_page or []
+    restaurant_count = len(restaurants)
+    for index, r in enumerate(restaurants):
+        yield from process_restaurant(r, index, restaurant_count)
+
+    shard_tasks = [partial(process_shard, base_url, headers, restaurants, shard_from, shard_to, settings)
+                   for shard_from, shard_to in shards]
+    # the backfill ends at the start of this sync, so sync_items does not run and would not fetch these
+    if restaurants and "first_pass" not in completed:
+        shards.insert(0, ("first_pass", None))
+        shard_tasks.insert(0, partial(process_first_pass, base_url, headers, restaurants, backfill["start"], settings))
+
+    for index, item in yield_as_completed(shard_tasks, settings["backfill_workers"]):
+        if item is not TASK_DONE:
+            yield item
+            continue
+        shard_from, shard_to = shards[index]
+        backfill["completed"].append(shard_from)
+        if shard_to is None:
+            log.info("***** backfill of config, jobs and employees completed ***** ")
+        else:
+            log.info(f"***** backfill shard {shard_from} to {shard_to} completed ***** ")
+        yield op.checkpoint(state)
+
+    state["to_ts"] = backfill["end"]
+    state.pop("backfill")
+    yield op.checkpoint(state)
+
+def process_shard(base_url, headers, restaurants, ts_from, ts_to, settings):
+    """
+    This is the generating function for a single backfill shard across all restaurants
+    :param base_url: Toast API URL
+    :param headers: authentication headers
+    :param restaurants: restaurant records, already processed by process_restaurant
+    :param ts_from: Timestamp to start the shard
+    :param ts_to: Timestamp to end the shard
+    :param settings: performance settings from read_settings()
+    :return:
+    """
+    timerange_params = {"startDate": ts_from, "endDate": ts_to}
+    modified_params = {"modifiedStartDate": ts_from, "modifiedEndDate": ts_to}
+    config_params = {"lastModified": ts_from}
+    restaurant_count = len(restaurants)
+    log.info(f"***** backfill shard is from {ts_from} to {ts_to} ***** ")
+
+    tasks = []
+    for index, r in enumerate(restaurants):
+        tasks.extend(restaurant_tasks(base_url, headers, r, index, restaurant_count, False,
+                                      config_params, timerange_params, modified_params, settings,
+                                      include_restaurant=False))
+    yield from run_tasks(tasks, settings)
+
+def process_first_pass(base_url, headers, restaurants, ts_from, settings):
+    """
+    This is the generating function for the endpoints without an end timestamp across all restaurants, during a backfill
+    :param base_url: Toast API URL
+    :param headers: authentication headers
+    :param restaurants: restaurant records, already processed by process_restaurant
+    :param ts_from: Timestamp to start from, the start of the backfill
+    :param settings: performance settings from read_settings()
+    :return:
+    """
+    config_params = {"lastModified": ts_from}
+    log.info(f"***** backfill of config, jobs and employees modified since {ts_from} ***** ")
+
+    tasks = []
+    for r in restaurants:
+        for unit, task in first_pass_units(base_url, headers, r["id"], config_params, settings):
+            tasks.append(async_task(task) if settings["engine"] == "async" else task)
+    yield from run_tasks(tasks, settings)
+
+def first_pass_units(base_url, headers, id, config_params, settings, cache=None, staging=None):
+    """
+    Builds the units of a restaurant for the endpoints that don't have an end timestamp:
+    config endpoints, jobs and employees
+    :param base_url: Toast API URL
+    :param headers: authentication headers
+    :param id: restaurant id
+    :param config_params: parameters for config endpoints
+    :param settings: performance settings from read_settings()
+    :param cache: config endpoint cache from state, or None to fetch and upsert everything
+    :param staging: dictionary the cache entries of each unit are collected in, by unit, instead of in cache
+    :return: list of (unit, task)
+    """
+    # config endpoint is a list of tuples ("endpoint", "destination_table_name")
+    config_endpoints = [("/config/v2/alternatePaymentTypes", "alternate_payment_types"),
+                        ("/config/v2/diningOptions", "dining_option"),
+                        ("/config/v2/discounts", "discounts"),
+                        ("/config/v2/menus", "menu"),
+                        ("/config/v2/menuGroups", "menu_group"),
+                        ("/config/v2/menuItems", "menu_item"),
+                        ("/config/v2/restaurantServices", "restaurant_service"),
+                        ("/config/v2/revenueCenters", "revenue_center"),
+                        ("/config/v2/salesCategories", "sale_category"),
+                        ("/config/v2/serviceAreas", "service_area"),
+                        ("/config/v2/tables", "tables")]
+
+    def cache_updates(unit):
+        return staging.setdefault(unit, {}) if staging is not None else None
+
+    units = []
+    for endpoint, table_name in config_endpoints:
+        units.append((table_name, partial(process_config, base_url, headers, endpoint, table_name, id,
+                                          config_params, prefetch_pages=settings["prefetch_pages"], cache=cache,
+                                          cache_updates=cache_updates(table_name))))
+
+    # no timerange_params
+    for endpoint, table_name in [("/labor/v1/jobs", "job"),("/labor/v1/employees", "employee")]:
+        units.append((table_name, partial(process_labor, base_url, headers, endpoint, table_name, id, cache=cache,
+                                          cache_updates=cache_updates(table_name))))
+    return units
+
+def restaurant_tasks(base_url, headers, r, index, restaurant_count, first_pass,
+                     config_params, timerange_params, modified_params, settings, cache=None,
+                     include_restaurant=True, completed=None):
+    """
+    Builds the list of independent units of work for a single restaurant.
+    Each task is a zero-argument callable that returns a generator of operations,
+    listed in the order a serial sync would run them.
+    A unit is named after its destination table, with ordersByBusinessDate orders units are "orders:YYYYMMDD".
+    With completed, that many leading units are left out, and every other task ends by yielding a UnitDone for its unit.
+    Cache entries written by a tracked unit are staged in its UnitDone rather than written to cache by the task.
+    :param base_url: Toast API URL
+    :param headers: authentication headers
+    :param r: restaurant record from /partners/v1/restaurants
+    :param index: position of the restaurant in the restaurant list
+    :param restaurant_count: number of restaurants in the restaurant list
+    :param first_pass: whether to call endpoints that don't have an end timestamp
+    :param config_params: parameters for config endpoints
+    :param timerange_params: startDate/endDate parameters
+    :param modified_params: modifiedStartDate/modifiedEndDate parameters
+    :param settings: performance settings from read_settings()
+    :param cache: config endpoint cache from state, or None to fetch and upsert everything
+    :param include_restaurant: whether to emit the restaurant record itself, which renames its fields
+    :param completed: number of leading units already completed for this restaurant, or None to run every unit untracked
+    :return: list of callables
+    """
+    # (unit, task) in the order a serial sync would run them
+    if not include_restaurant:
+        id = r["id"]
+        units = []
+    else:
+        id = r["restaurantGuid"]
+        units = [("restaurant", partial(process_restaurant, r, index, restaurant_count))]
+
+    # config endpoints, jobs and employees
+    # only process these on the first pass since they don't have an end timestamp
+    staging = {} if cache is not None and completed is not None else None
+    if first_pass:
+        units.extend(first_pass_units(base_url, headers, id, config_params, settings, cache, staging))
+
+    # cash management endpoints
+    units.append(("cash_entry", partial(process_cash, base_url, headers, "/cashmgmt/v1/entries", "cash_entry", id,
+                                        timerange_params)))
+    units.append(("cash_deposit", partial(process_cash, base_url, headers, "/cashmgmt/v1/deposits", "cash_deposit", id,
+                                          timerange_params)))
+
+    # orders
+    if settings["orders_by_business_date"]:
+        # one unit per business date, so days are fetched in parallel, paginate less deeply,
+        # and only the days that did not complete are fetched again
+        for business_date in generate_business_dates(timerange_params["startDate"], timerange_params["endDate"]):
+            units.append((f"orders:{business_date}", partial(process_orders, base_url, headers, "/orders/v2/ordersBulk",
+                                                             "orders", id, {"businessDate": business_date},
+                                                             prefetch_pages=settings["prefetch_pages"])))
+    else:
+        units.append(("orders", partial(process_orders, base_url, headers, "/orders/v2/ordersBulk", "orders", id,
+                                        timerange_params, prefetch_pages=settings["prefetch_pages"])))
+
+    # labor endpoints
+    # these two endpoints can only retrieve 30 days at a time
+    units.append(("shift", partial(process_labor, base_url, headers, "/labor/v1/shifts", "shift", id,
+                                   params=timerange_params)))
+    units.append(("time_entry", partial(process_labor, base_url, headers, "/labor/v1/timeEntries", "time_entry", id,
+                                        params=modified_params)))
+
+    tasks = []
+    for position, (unit, task) in enumerate(units):
+        if completed is not None and position < completed:
+            continue
+        if settings["engine"] == "async":
+            task = async_task(task)
+        if completed is not None:
+            task = track_unit(task, UnitDone(id, unit, position, staging.get(unit) if staging is not None else None))
+        tasks.append(task)
+    return tasks
+
+# UnitDone follows the operations of a restaurant endpoint in the output of tasks from restaurant_tasks:
+# restaurant: restaurant id
+# unit: the endpoint's destination table
+# position: index of the unit among the restaurant's units
+# cache: config cache entries of the unit, for sync_items to copy into the state, or None
+UnitDone = namedtuple("UnitDone", ["restaurant", "unit", "position", "cache"], defaults=[None])
+
+def track_unit(task, marker):
+    """
+    Wraps a task so that it yields marker after its last operation
+    :param task: task from restaurant_tasks, a generator function or a coroutine function for the async engine
+    :param marker: UnitDone
+    :return: task of the same kind
+    """
+    if inspect.iscoroutinefunction(task):
+        return partial(finish_unit_async, task, marker)
+    return partial(finish_unit, task, marker)
+
+def finish_unit(task, marker):
+    yield from task()
+    yield marker
+
+async def finish_unit_async(task, marker, *, client, emit):
+    await task(client=client, emit=emit)
+    await emit([marker])
+
+def run_tasks(tasks, settings):
+    """
+    Runs the tasks from restaurant_tasks on the configured engine and yields their operations in task order
+    :param tasks: list of tasks from restaurant_tasks
+    :param settings: performance settings from read_settings()
+    :return: generator of operations
+    """
+    if settings["engine"] == "async":
+        return yield_async_in_order(tasks, settings["max_workers"])
+    return yield_in_order(tasks, settings["max_workers"])
+
+def upsert(table, data):
+    """
+    Yields the upsert operation for a row.
+    With a fingerprint index open, rows whose content is unchanged since the last sync are not sent.
+    PendingRows are checked against the index when they are sent, in the thread that yields them to the SDK,
+    so tasks on the event loop don't wait on SQLite.
+    :param table: destination table name
+    :param data: row
+    :return:
+    """
+    row = PendingRow("upsert", table, data)
+    if pending_rows:
+        yield row
+    elif not suppressed(row):
+        yield send(row)
+
+def delete(table, keys):
+    """
+    Yields the delete operation for a row
+    :param table: destination table name
+    :param keys: primary key values of the row
+    :return:
+    """
+    row = PendingRow("delete", table, keys)
+    yield row if pending_rows else send(row)
+
+# PendingRow is an upsert or delete that has not been sent yet:
+# kind: "upsert" or "delete"
+# table: destination table name
+# data: the row for an upsert, its primary key values for a delete
+PendingRow = namedtuple("PendingRow", ["kind", "table", "data"])
+
+# whether upsert() and delete() yield PendingRows instead of operations, set for the whole of update().
+# Called on their own, as in tests, they yield operations
+pending_rows = False
+
+def send(row):
+    """
+    Makes the SDK operation for a row
+    :param row: PendingRow
+    :return: operation
+    """
+    if row.kind == "delete":
+        metrics.add_table(row.table, deletes=1)
+        return op.delete(table=row.table, keys=row.data)
+    started = time.perf_counter()
+    operation = op.upsert(table=row.table, data=row.data)
+    metrics.add_table(row.table, upserts=1, upsert_seconds=time.perf_counter() - started)
+    return operation
+
+def suppressed(row):
+    """
+    Checks a row against the fingerprint index, if one is open
+    :param row: PendingRow
+    :return: True if the row is an upsert of a row unchanged since the last sync, which is not sent
+    """
+    return row.kind == "upsert" and fingerprint_index is not None and fingerprint_index.unchanged(row.table, row.data)
+
+def send_run(table, rows):
+    """
+    Makes the SDK operations for a run of rows of one table, in order.
+    The run is timed and added to the sync metrics as a whole, instead of row by row
+    :param table: destination table name
+    :param rows: PendingRows of the table
+    :return: list of operations
+    """
+    started = time.perf_counter()
+    operations = [op.upsert(table=table, data=row.data) if row.kind == "upsert" else op.delete(table=table, keys=row.data)
+                  for row in rows]
+    upserts = sum(1 for row in rows if row.kind == "upsert")
+    metrics.add_table(table, upserts=upserts, deletes=len(rows) - upserts, upsert_seconds=time.perf_counter() - started)
+    return operations
+
+def send_rows(operations):
+    """
+    Makes the SDK operation for every PendingRow of an operation stream, in stream order.
+    Upserts suppressed by the fingerprint index are dropped.
+    Rows are counted per table here and added to the sync metrics before each other operation passes through,
+    so the metrics lock is not taken for every row
+    :param operations: generator of operations and PendingRows
+    :return: generator of operations
+    """
+    sent = {}  # table name: [upserts, deletes, upsert seconds]
+    try:
+        for item in operations:
+            if not isinstance(item, PendingRow):
+                add_sent_rows(sent)
+                yield item
+                continue
+            table = item.table
+            counts = sent.get(table)
+            if counts is None:
+                counts = sent[table] = [0, 0, 0.0]
+            if item.kind == "delete":
+                counts[1] += 1
+                yield op.delete(table=table, keys=item.data)
+            elif fingerprint_index is None or not fingerprint_index.unchanged(table, item.data):
+                started = time.perf_counter()
+                operation = op.upsert(table=table, data=item.data)
+                counts[2] += time.perf_counter() - started
+                counts[0] += 1
+                yield operation
+    finally:
+        add_sent_rows(sent)
+
+def add_sent_rows(sent):
+    """
+    Adds the rows counted by send_rows to the sync metrics, and clears the counts
+    :param sent: dictionary of table name: [upserts, deletes, upsert seconds]
+    """
+    for table, (upserts, deletes, seconds) in sent.items():
+        metrics.add_table(table, upserts=upserts, deletes=deletes, upsert_seconds=seconds)
+    sent.clear()
+
+def batch_by_table(operations, max_rows, max_bytes):
+    """
+    Regroups the rows of an operation stream by destination table, so the destination receives runs of rows
+    for the same table instead of the row-by-row interleaving of order trees.
+    PendingRows are buffered per table. Once more than max_rows rows or about max_bytes are buffered,
+    the table holding the most bytes is sent as one run. Everything buffered is sent before any other operation
+    is passed through, so every row reaches the destination before the checkpoint that follows it.
+    Rows of one table keep their order, so a delete still follows the upsert it belongs to.
+    Upserts suppressed by the fingerprint index are dropped before they are buffered.
+    :param operations: generator of operations and PendingRows
+    :param max_rows: maximum number of buffered rows
+    :param max_bytes: maximum approximate size of the buffered rows
+    :return: generator of operations
+    """
+    tables = {}  # table name: [rows, approximate bytes], in order of first buffered row
+    buffered_rows = 0
+    buffered_bytes = 0
+
+    def flush(table):
+        nonlocal buffered_rows, buffered_bytes
+        rows, size = tables.pop(table)
+        buffered_rows -= len(rows)
+        buffered_bytes -= size
+        yield from send_run(table, rows)
+
+    for item in operations:
+        if not isinstance(item, PendingRow):
+            for table in list(tables):
+                yield from flush(table)
+            yield item
+            continue
+        if suppressed(item):
+            continue
+
+        size = row_size(item.data)
+        buffer = tables.setdefault(item.table, [[], 0])
+        buffer[0].append(item)
+        buffer[1] += size
+        buffered_rows += 1
+        buffered_bytes += size
+        if buffered_rows > max_rows or buffered_bytes > max_bytes:
+            yield from flush(max(tables, key=lambda table: tables[table][1]))
+
+    for table in list(tables):
+        yield from flush(table)
+
+def row_size(data):
+    """
+    Cheap estimate of a row's serialized size, string lengths plus a fixed size for other values
+    :param data: row or primary key values
+    :return: approximate size in bytes
+    """
+    return sum(len(key) + (len(value) if isinstance(value, str) else 8) for key, value in data.items())
+
+class FingerprintIndex:
+    """
+    On-disk index from a hash of each row's primary key to a hash of its content, kept in a SQLite file between syncs.
+    Both hashes are 64-bit, so the index stays compact and lookups go through SQLite's B-tree
+    instead of an in-memory dictionary. Changes are committed only once the sync has checkpointed.
+    The file stores a generation token that is also kept in state; if they don't match, e.g. after a
+    re-sync cleared the state, the index is discarded so no rows are wrongly suppressed.
+    """
+
+    def __init__(self, path, tables, generation=None):
+        """
+        :param path: SQLite file path
+        :param tables: table definitions from schema(), used for primary keys
+        :param generation: generation token from state
+        """
+        self.lock = threading.Lock()
+        self.primary_keys = {t["table"]: t["primary_key"] for t in tables if t.get("primary_key")}
+        self.suppressed = Counter()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS fingerprint (key INTEGER PRIMARY KEY, hash INTEGER NOT NULL)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)")
+        stored = self.connection.execute("SELECT value FROM meta WHERE name = 'generation'").fetchone()
+        if generation is None or stored is None or stored[0] != generation:
+            log.info("fingerprint index does not match state, starting a new index")
+            self.connection.execute("DELETE FROM fingerprint")
+            self.connection.execute("DELETE FROM meta")
+            self.connection.commit()
+
+    @staticmethod
+    def digest(value):
+        payload = json.dumps(value, sort_keys=True, separators=(",", ":"), default=str).encode()
+        return int.from_bytes(hashlib.blake2b(payload, digest_size=8).digest(), "big", signed=True)
+
+    def unchanged(self, table, data):
+        """
+        Checks a row against the index and records its new fingerprint if it has changed
+        :param table: destination table name
+        :param data: row
+        :return: True if the same row was delivered by a previous sync
+        """
+        primary_key = self.primary_keys.get(table)
+        if not primary_key or any(k not in data for k in primary_key):
+            return False
+        key = self.digest([table] + [data[k] for k in primary_key])
+        row_hash = self.digest(data)
+
+        with self.lock:
+            stored = self.connection.execute("SELECT hash FROM fingerprint WHERE key = ?", (key,)).fetchone()
+            if stored is not None and stored[0] == row_hash:
+                self.suppressed[table] += 1
+                return True
+            self.connection.execute("INSERT OR REPLACE INTO fingerprint (key, hash) VALUES (?, ?)", (key, row_hash))
+            return False
+
+    def new_generation(self):
+        """
+        :return: a new generation token, written to the index with the pending changes
+        """
+        generation = uuid.uuid4().hex
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('generation', ?)", (generation,))
+        return generation
+
+    def commit(self):
+        with self.lock:
+            self.connection.commit()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+# fingerprint index for the running sync, None when row-level change detection is disabled
+fingerprint_index = None
+
+def open_fingerprint_index(path, tables, state):
+    """
+    Opens the fingerprint index used by upsert()
+    :param path: SQLite file path
+    :param tables: table definitions from schema()
+    :param state: connector state holding the index generation
+    """
+    global fingerprint_index
+    fingerprint_index = FingerprintIndex(path, tables, state.get("fingerprint_generation"))
+
+def commit_fingerprint_index(state):
+    """
+    Records a new index generation in state, checkpoints it and then commits the index,
+    so the index never holds rows that the destination has not received.
+    If the sync stops between the checkpoint and the commit, the generations differ and the index is discarded.
+    :param state: connector state
+    :return:
+    """
+    if fingerprint_index is None:
+        return
+    state["fingerprint_generation"] = fingerprint_index.new_generation()
+    yield op.checkpoint(state)
+    fingerprint_index.commit()
+    log.info(f"upserts suppressed by fingerprint index: {dict(fingerprint_index.suppressed)}")
+
+def close_fingerprint_index():
+    """
+    Closes the fingerprint index, discarding any uncommitted changes
+    """
+    global fingerprint_index
+    if fingerprint_index is not None:
+        fingerprint_index.close()
+        fingerprint_index = None
+
+def process_restaurant(r, index, restaurant_count):
+    """
+    This is the generating function for a single restaurant record
+    :param r: restaurant record from /partners/v1/restaurants
+    :param index: position of the restaurant in the restaurant list
+    :param restaurant_count: number of restaurants in the restaurant list
+    :return:
+    """
+    #rename some fields in response
+    rename_fields = [("restaurantGuid", "id"), ("restaurantName", "name")]
+    for old_name, new_name in rename_fields:
+        r[new_name] = r.pop(old_name)
+    log.info(f"***** starting restaurant {r['id']}, {index + 1} of {restaurant_count} ***** ")
+    yield from upsert("restaurant", r)
+
+    if r.get("deleted") and "id" in r:
+        yield from delete("restaurant", {"id": r["id"]})
+
+def yield_in_order(tasks, max_workers, buffer_size=1000):
+    """
+    Runs generator tasks on a bounded thread pool and yields their items in task order.
+    Up to max_workers tasks run at once, and each one buffers at most buffer_size items ahead of
+    the consumer, so memory stays bounded and the output matches running the tasks one after another.
+    With max_workers of 1 the tasks run serially in the calling thread.
+    :param tasks: iterable of zero-argument callables that return generators
+    :param max_workers: maximum number of tasks running at once
+    :param buffer_size: maximum number of items buffered per running task
+    :return:
+    """
+    if max_workers <= 1:
+        for task in tasks:
+            yield from task()
+        return
+
+    stop = threading.Event()
+
+    def put(buffer, item):
+        # blocks while the buffer is full, gives up once the consumer has gone away
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def drain(task, buffer):
+        try:
+            for item in task():
+                if not put(buffer, ("item", item)):
+                    return
+            put(buffer, ("done", None))
+        except Exception as e:
+            put(buffer, ("error", e))
+
+    tasks = iter(tasks)
+    pending = deque()
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def submit_next():
+        for task in tasks:
+            buffer = queue.Queue(maxsize=buffer_size)
+            executor.submit(drain, task, buffer)
+            pending.append(buffer)
+            return
+
+    try:
+        for _ in range(max_workers):
+            submit_next()
+
+        while pending:
+            buffer = pending.popleft()
+            while True:
+                kind, item = buffer.get()
+                if kind == "item":
+                    yield item
+                elif kind == "error":
+                    raise item
+                else:
+                    break
+            submit_next()
+    finally:
+        stop.set()
+        executor.shutdown(wait=True, cancel_futures=True)
+
+# marks the end of a task in the output of yield_as_completed
+TASK_DONE = object()
+
+def yield_as_completed(tasks, max_workers, buffer_size=1000):
+    """
+    Runs generator tasks on a bounded thread pool and yields their items as they are produced.
+    Items of one task keep their order, but items of different tasks interleave.
+    Yields (task index, item) pairs, and (task index, TASK_DONE) once every item of that task has been yielded.
+    Workers block once buffer_size items are waiting, which keeps memory bounded.
+    :param tasks: list of zero-argument callables that return generators
+    :param max_workers: maximum number of tasks running at once
+    :param buffer_size: maximum number of items waiting to be yielded
+    :return:
+    """
+    stop = threading.Event()
+    buffer = queue.Queue(maxsize=buffer_size)
+
+    def put(item):
+        # blocks while the buffer is full, gives up once the consumer has gone away
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def drain(index, task):
+        try:
+            for item in task():
+                if not put(("item", index, item)):
+                    return
+            put(("done", index, TASK_DONE))
+        except Exception as e:
+            put(("error", index, e))
+
+    executor = ThreadPoolExecutor(max_workers=max(1, max_workers))
+    try:
+        for index, task in enumerate(tasks):
+            executor.submit(drain, index, task)
+
+        remaining = len(tasks)
+        while remaining:
+            kind, index, item = buffer.get()
+            if kind == "error":
+                raise item
+            if kind == "done":
+                remaining -= 1
+            yield index, item
+    finally:
+        stop.set()
+        executor.shutdown(wait=True, cancel_futures=True)
+
+def yield_async_in_order(tasks, concurrency, buffer_size=2):
+    """
+    Async engine counterpart of yield_in_order.
+    Coroutine tasks run on an event loop in a background thread, up to concurrency at once, sharing one
+    aiohttp session. Each one passes lists of operations to its emit callback, and the calling thread yields them
+    in task order. A task waits in emit while buffer_size lists are queued, so memory stays bounded.
+    Tasks that are not coroutine functions return generators and run in the calling thread when their turn comes.
+    :param tasks: list of zero-argument callables, coroutine functions are called with client and emit keyword arguments
+    :param concurrency: maximum number of coroutine tasks running at once, and of open connections
+    :param buffer_size: maximum number of operation lists queued per running task
+    :return:
+    """
+    if aiohttp is None:
+        raise ImportError("The async engine requires the optional aiohttp package, see requirements.txt")
+
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, name="toast-event-loop", daemon=True)
+    thread.start()
+
+    def call(coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, loop).result()
+
+    async def start():
+        channels = [asyncio.Queue(maxsize=buffer_size) if inspect.iscoroutinefunction(task) else None
+                    for task in tasks]
+        return channels, asyncio.ensure_future(run_async_tasks(tasks, channels, concurrency))
+
+    async def stop(runner):
+        runner.cancel()
+        await asyncio.gather(runner, return_exceptions=True)
+
+    channels, runner = call(start())
+    try:
+        for task, channel in zip(tasks, channels):
+            if channel is None:
+                yield from task()
+                continue
+            while True:
+                kind, operations = call(channel.get())
+                if kind == "item":
+                    yield from operations
+                elif kind == "error":
+                    raise operations
+                else:
+                    break
+    finally:
+        call(stop(runner))
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+
+async def run_async_tasks(tasks, channels, concurrency):
+    """
+    Starts the coroutine tasks of yield_async_in_order in order, with at most concurrency running at once
+    :param tasks: list of tasks
+    :param channels: queue per task for its operations, None for tasks that run in the calling thread
+    :param concurrency: maximum number of tasks running at once
+    :return:
+    """
+    slots = asyncio.Semaphore(concurrency)
+    running = []
+
+    async def drain(task, channel, client):
+        try:
+            await task(client=client, emit=lambda operations: channel.put(("item", operations)))
+            await channel.put(("done", None))
+        except Exception as e:
+            await channel.put(("error", e))
+        finally:
+            slots.release()
+
+    try:
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=concurrency)) as client:
+            try:
+                for task, channel in zip(tasks, channels):
+                    if channel is not None:
+                        await slots.acquire()
+                        running.append(asyncio.ensure_future(drain(task, channel, client)))
+                await asyncio.gather(*running)
+            finally:
+                for future in running:
+                    future.cancel()
+                await asyncio.gather(*running, return_exceptions=True)
+    except Exception as e:
+        # the session could not be set up, fail every task that has not reported yet
+        for channel in channels:
+            if channel is not None and channel.empty():
+                channel.put_nowait(("error", e))
+
+def process_config(base_url, headers, endpoint, table_name, rst_id, timerange, prefetch_pages=0, cache=None,
+                   cache_updates=None):
     """
     This is the generating function for configuration endpoints for a restaurant and timerange
+    With a cache, lastModified starts from the endpoint's high-water mark if that is later than the timerange,
+    and pages whose content hash matches a page from the previous fetch are not upserted again.
     :param base_url: Toast API URL
     :param headers: authentication headers
     :param endpoint: Toast API endpoint
     :param table_name: table name to store data in destination
     :param rst_id: id for restaurant to query
     :param timerange: time range to query
+    :param prefetch_pages: number of pages to fetch ahead of the page being processed
+    :param cache: config endpoint cache from state, or None to fetch and upsert everything
+    :param cache_updates: dictionary the new cache entry is written to, cache itself by default.
+        Tasks of a sync write to a staging dictionary, since other threads read and checkpoint the state
+    :return:
+    """
+    headers = {**headers, "Toast-Restaurant-External-ID": rst_id}
+    fetched_at = datetime.now(timezone.utc).isoformat("T", "milliseconds").replace("+00:00", "Z")
+    cache_key = f"{rst_id}{endpoint}"
+    timerange, previous_pages = cached_timerange(cache, cache_key, timerange)
+    page_hashes = []
+
+    param_string = "&".join(f"{key}={value}" for key, value in timerange.items())
+    pages = partial(token_pages, base_url + endpoint + "?" + param_string, headers)
+
+    try:
+        for response_page, page_hash, page_index in prefetch(pages, prefetch_pages):
+            log.fine(f"restaurant {rst_id}: response_page has {len(response_page)} items for {endpoint}")
+            # a page that changed when it was replayed after an expired page token replaces its earlier hash
+            page_hashes[page_index:page_index + 1] = [page_hash]
+            if page_hash in previous_pages:
+                log.fine(f"restaurant {rst_id}: page unchanged for {endpoint}, skipping upserts")
+                continue
+            yield from config_operations(table_name, rst_id, response_page)
+
+        if cache is not None:
+            (cache if cache_updates is None else cache_updates)[cache_key] = {"last_modified": fetched_at,
+                                                                             "pages": page_hashes}
+
+    except Exception as e:
+        # Return error response
+        exception_message = str(e)
+        stack_trace = traceback.format_exc()
+        detailed_message = f"Error Message: {exception_message}\nStack Trace:\n{stack_trace}"
+        raise RuntimeError(detailed_message)
+
+def cached_timerange(cache, cache_key, timerange):
+    """
+    Looks up a config endpoint in the config cache
+    :param cache: config endpoint cache from state, or None
+    :param cache_key: restaurant id followed by the endpoint
+    :param timerange: lastModified parameter for the endpoint
+    :return: timerange starting from the endpoint's high-water mark if that is later,
+        and the set of page hashes from the previous fetch
+    """
+    entry = cache.get(cache_key) if cache is not None else None
+    if entry and timestamp_after(entry["last_modified"], timerange["lastModified"]):
+        timerange = {**timerange, "lastModified": entry["last_modified"]}
+    return timerange, set(entry["pages"]) if entry else set()
+
+def config_operations(table_name, rst_id, response_page):
+    """
+    This is the generating function for one page of a configuration endpoint
+    :param table_name: table name to store data in destination
+    :param rst_id: id for restaurant the page belongs to
+    :param response_page: list of records
     :return:
     """
-    headers["Toast-Restaurant-External-ID"] = rst_id
-    more_data = True
-    pagination = {}
     # fields_to_extract is a mapping of fields to extract from source data.
     # Keys represent table names, and values are lists of tuples.
     # Each tuple defines a mapping for one or more fields in the table:
@@ -164,50 +1080,78 @@ def process_config(base_url, headers, endpoint, table_name, rst_id, timerange):
                          "service_area": [("revenueCenter", "guid", "revenue_center_guid")],
                          "tables": [("revenueCenter", "guid", "revenue_center_guid"),
                                     ("serviceArea", "guid", "service_area_guid")]}
-
-    while more_data:
-        try:
-            next_token = None
-            param_string = "&".join(f"{key}={value}" for key, value in timerange.items())
-            response_page, next_token = get_api_response(base_url + endpoint + "?" + param_string, headers, params=pagination)
-            log.fine(f"restaurant {rst_id}: response_page has {len(response_page)} items for {endpoint}")
-            for o in response_page:
-                if fields_to_extract.get(table_name):
-                    o = extract_fields(fields_to_extract[table_name], o)
-                o = stringify_lists(o)
-                o["restaurant_id"] = rst_id
-                o = replace_guid_with_id(o)
-                yield op.upsert(table=table_name, data=o)
-
-            if next_token:
-                pagination["pageToken"] = next_token
-            else:
-                more_data = False
-
-        except Exception as e:
-            # Return error response
-            exception_message = str(e)
-            stack_trace = traceback.format_exc()
-            detailed_message = f"Error Message: {exception_message}\nStack Trace:\n{stack_trace}"
-            raise RuntimeError(detailed_message)
-
-def process_labor(base_url, headers, endpoint, table_name, rst_id, params=None):
+    for o in response_page:
+        if fields_to_extract.get(table_name):
+            o = extract_fields(fields_to_extract[table_name], o)
+        o = stringify_lists(o)
+        o["restaurant_id"] = rst_id
+        o = replace_guid_with_id(o)
+        yield from upsert(table_name, o)
+
+def process_labor(base_url, headers, endpoint, table_name, rst_id, params=None, cache=None, cache_updates=None):
     """
     This is the generating function for labor endpoints, for a restaurant and a timerange
     Labor endpoints do not use pagination
     Time range parameters are optional for breaks, shifts, and time entries.
-    Time range parameters are not accepted for jobs and employees
+    Time range parameters are not accepted for jobs and employees, so with a cache their response
+    is skipped when its content hash is the same as on the previous fetch.
     :param base_url: Toast API URL
     :param headers: authentication headers
     :param endpoint: Toast API endpoint
     :param table_name: table name to store data in destination
     :param rst_id: id for restaurant to query
     :param params: This is a dictionary of timerange parameters which can vary by endpoint
+    :param cache: config endpoint cache from state, or None to upsert everything
+    :param cache_updates: dictionary the new cache entry is written to, cache itself by default
     :return:
     """
     params = params or {}
-    headers["Toast-Restaurant-External-ID"] = rst_id
+    headers = {**headers, "Toast-Restaurant-External-ID": rst_id}
+    fetched_at = datetime.now(timezone.utc).isoformat("T", "milliseconds").replace("+00:00", "Z")
+
+    try:
+        response_page, next_token = get_api_response(base_url + endpoint, headers, params=params)
+        log.fine(f"restaurant {rst_id}: response_page has {len(response_page)} items for {endpoint}")
+
+        if cache is not None and labor_response_unchanged(cache, f"{rst_id}{endpoint}", response_page, fetched_at,
+                                                          cache_updates):
+            log.fine(f"restaurant {rst_id}: response unchanged for {endpoint}, skipping upserts")
+            return
+
+        yield from labor_operations(endpoint, table_name, rst_id, response_page)
+
+    except Exception as e:
+        # Return error response
+        exception_message = str(e)
+        stack_trace = traceback.format_exc()
+        detailed_message = f"Error Message: {exception_message}\nStack Trace:\n{stack_trace}"
+        raise RuntimeError(detailed_message)
+
+def labor_response_unchanged(cache, cache_key, response_page, fetched_at, cache_updates=None):
+    """
+    Records the content hash of a jobs or employees response in the config cache
+    :param cache: config endpoint cache from state
+    :param cache_key: restaurant id followed by the endpoint
+    :param response_page: list of records
+    :param fetched_at: timestamp the response was requested at
+    :param cache_updates: dictionary the new entry is written to, cache itself by default
+    :return: True if the response is the same as on the previous fetch
+    """
+    page_hash = page_digest(response_page)
+    entry = cache.get(cache_key)
+    (cache if cache_updates is None else cache_updates)[cache_key] = {"last_modified": fetched_at,
+                                                                      "pages": [page_hash]}
+    return bool(entry) and page_hash in entry["pages"]
 
+def labor_operations(endpoint, table_name, rst_id, response_page):
+    """
+    This is the generating function for the response of a labor endpoint
+    :param endpoint: Toast API endpoint
+    :param table_name: table name to store data in destination
+    :param rst_id: id for restaurant the response belongs to
+    :param response_page: list of records
+    :return:
+    """
     # fields_to_extract is a mapping of fields to extract from source data.
     # Keys represent table names, and values are lists of tuples.
     # Each tuple defines a mapping for one or more fields in the table:
@@ -220,36 +1164,25 @@ def process_labor(base_url, headers, endpoint, table_name, rst_id, params=None):
                        ("shiftReference", "guid", "shift_reference_id")]
     }
 
-    try:
-        response_page, next_token = get_api_response(base_url + endpoint, headers, params=params)
-        log.fine(f"restaurant {rst_id}: response_page has {len(response_page)} items for {endpoint}")
-
-        for o in response_page:
-            if endpoint == "/labor/v1/timeEntries" and o.get("breaks"):
-                yield from process_child(o["breaks"], "break", "time_entry_id", o["guid"])
-            elif endpoint == "/labor/v1/employees":
-                yield from process_child(o.get("jobReferences", []), "employee_job_reference", "employee_id", o["guid"])
-                yield from process_child(o.get("wageOverrides", []), "employee_wage_override", "employee_id", o["guid"])
-            elif endpoint == "/labor/v1/shifts":
-                o = flatten_fields(["scheduleConfig"], o)
+    for o in response_page:
+        if endpoint == "/labor/v1/timeEntries" and o.get("breaks"):
+            yield from process_child(o["breaks"], "break", "time_entry_id", o["guid"])
+        elif endpoint == "/labor/v1/employees":
+            yield from process_child(o.get("jobReferences", []), "employee_job_reference", "employee_id", o["guid"])
+            yield from process_child(o.get("wageOverrides", []), "employee_wage_override", "employee_id", o["guid"])
+        elif endpoint == "/labor/v1/shifts":
+            o = flatten_fields(["scheduleConfig"], o)
 
-            if table_name in fields_to_extract:
-                o = extract_fields(fields_to_extract[table_name], o)
+        if table_name in fields_to_extract:
+            o = extract_fields(fields_to_extract[table_name], o)
 
-            o = stringify_lists(o)
-            o["restaurant_id"] = rst_id
-            o = replace_guid_with_id(o)
-            yield op.upsert(table=table_name, data=o)
+        o = stringify_lists(o)
+        o["restaurant_id"] = rst_id
+        o = replace_guid_with_id(o)
+        yield from upsert(table_name, o)
 
-            if o.get("deleted") and "id" in o:
-                yield op.delete(table=table_name, keys={"id": o["id"]})
-
-    except Exception as e:
-        # Return error response
-        exception_message = str(e)
-        stack_trace = traceback.format_exc()
-        detailed_message = f"Error Message: {exception_message}\nStack Trace:\n{stack_trace}"
-        raise RuntimeError(detailed_message)
+        if o.get("deleted") and "id" in o:
+            yield from delete(table_name, {"id": o["id"]})
 
 def process_cash(base_url, headers, endpoint, table_name, rst_id, params):
     """
@@ -265,27 +1198,14 @@ def process_cash(base_url, headers, endpoint, table_name, rst_id, params):
     :param params: This is a dictionary of timerange parameters
     :return:
     """
-    headers["Toast-Restaurant-External-ID"] = rst_id
-    # fields_to_flatten is a mapping of fields to flatten from source data.
-    # Keys represent table names, and values are lists of field names.
-    # The dictionary in each field should be used to create new fields, prefixed by the original field name.
-    # e.g. "info": {"id": 1, "type": "foo"}
-    # would become {"info_id": 1, "info_type": "foo} and the "info" key will be popped
-    fields_to_flatten = {
-        "cash_deposit": ["employee", "creator"],
-        "cash_entry": ["approverOrShiftReviewSubject", "creatorOrShiftReviewSubject", "cashDrawer",
-                       "employee1", "employee2", "payoutReason", "noSaleReason"]}
+    headers = {**headers, "Toast-Restaurant-External-ID": rst_id}
     try:
         date_range = generate_business_dates(params["startDate"], params["endDate"])
 
         for d in date_range:
             response_page, next_token = get_api_response(base_url + endpoint + "?businessDate=" + d, headers)
             # log.fine(f"restaurant {rst_id}: response_page has {len(response_page)} items for {endpoint}")
-            for o in response_page:
-                o = flatten_fields(fields_to_flatten[table_name], o)
-                o["restaurant_id"] = rst_id
-                o = replace_guid_with_id(o)
-                yield op.upsert(table=table_name, data=o)
+            yield from cash_operations(table_name, rst_id, response_page)
 
     except Exception as e:
         # Return error response
@@ -294,7 +1214,30 @@ def process_cash(base_url, headers, endpoint, table_name, rst_id, params):
         detailed_message = f"Error Message: {exception_message}\nStack Trace:\n{stack_trace}"
         raise RuntimeError(detailed_message)
 
-def process_orders(base_url, headers, endpoint, table_name, rst_id, params):
+def cash_operations(table_name, rst_id, response_page):
+    """
+    This is the generating function for one business date of a cash management endpoint
+    :param table_name: table name to store data in destination
+    :param rst_id: id for restaurant the page belongs to
+    :param response_page: list of records
+    :return:
+    """
+    # fields_to_flatten is a mapping of fields to flatten from source data.
+    # Keys represent table names, and values are lists of field names.
+    # The dictionary in each field should be used to create new fields, prefixed by the original field name.
+    # e.g. "info": {"id": 1, "type": "foo"}
+    # would become {"info_id": 1, "info_type": "foo} and the "info" key will be popped
+    fields_to_flatten = {
+        "cash_deposit": ["employee", "creator"],
+        "cash_entry": ["approverOrShiftReviewSubject", "creatorOrShiftReviewSubject", "cashDrawer",
+                       "employee1", "employee2", "payoutReason", "noSaleReason"]}
+    for o in response_page:
+        o = flatten_fields(fields_to_flatten[table_name], o)
+        o["restaurant_id"] = rst_id
+        o = replace_guid_with_id(o)
+        yield from upsert(table_name, o)
+
+def process_orders(base_url, headers, endpoint, table_name, rst_id, params, prefetch_pages=0):
     """
     This is the main generating function for the bulkOrders endpoint.
     This function upserts/deletes the orders table only.
@@ -304,48 +1247,335 @@ def process_orders(base_url, headers, endpoint, table_name, rst_id, params):
     :param endpoint: Toast API endpoint
     :param table_name: table name to store data in destination
     :param rst_id: id for restaurant to query
-    :param params: This is a dictionary of timerange parameters which can vary by endpoint
+    :param params: This is a dictionary of timerange parameters, startDate and endDate or a single businessDate
+    :param prefetch_pages: number of pages to fetch speculatively ahead of the page being processed.
+        Prefetched pages are parsed in full, without prefetching orders are parsed one at a time from each response.
     """
-
-
-    headers["Toast-Restaurant-External-ID"] = rst_id  # Move outside loop for efficiency
+    headers = {**headers, "Toast-Restaurant-External-ID": rst_id}  # copy so concurrent workers don't share it
     params = params.copy()  # Avoid modifying original params
     params.update({"pageSize": 100, "page": 1})  # Set pagination defaults
 
+    if prefetch_pages > 0:
+        pages = prefetch_numbered_pages(partial(numbered_page, base_url + endpoint, headers, params),
+                                        prefetch_pages, params["pageSize"])
+    else:
+        # pages can be many megabytes, so orders are parsed from the response body one at a time
+        pages = (numbered_page(base_url + endpoint, headers, params, page_num, stream=True)
+                 for page_num in range(1, 1_000_000))  # Prevent infinite loops; max reasonable pages
+
+    try:
+        for response_page in pages:
+            order_count = 0
+            for order in response_page:
+                order_count += 1
+                yield from order_operations(table_name, rst_id, order)
+
+            log.fine(f"restaurant {rst_id}: response_page has {order_count} items for {endpoint}")
+            if order_count < params["pageSize"]:
+                break  # No more pages available
+        pages.close()  # stops any speculative fetches past the last page
+
+    except Exception as e:
+        # Return error response
+        exception_message = str(e)
+        stack_trace = traceback.format_exc()
+        detailed_message = f"Error Message: {exception_message}\nStack Trace:\n{stack_trace}"
+        raise RuntimeError(detailed_message)
+
+def order_operations(table_name, rst_id, order):
+    """
+    This is the generating function for one order from the bulkOrders endpoint,
+    the order itself and its payment and pricing feature children
+    :param table_name: table name to store data in destination
+    :param rst_id: id for restaurant the order belongs to
+    :param order: order record
+    :return:
+    """
     # flatten these fields, e.g. "info": {"id": 1, "type": "foo"}
     # would become {"info_id": 1, "info_type": "foo} and the "info" key will be popped
     fields_to_flatten = ["server", "createdDevice", "lastModifiedDevice"]
     # extract guids from these fields, make a new field ending in _guid, and pop the original
     fields_extract_ids = ["diningOption", "table", "serviceArea", "revenueCenter"]
 
+    order["restaurant_id"] = rst_id
+    yield from process_payments(order)
+    yield from process_pricing_features(order)
+
+    order = flatten_fields(fields_to_flatten, order, in_place=True)
+
+    for field in fields_extract_ids:
+        if order.get(field) and "guid" in order[field]:
+            order[f"{field}_guid"] = order[field]["guid"]
+            order.pop(field, None)
+
+    order.pop("checks", None)
+    order = stringify_lists(order, in_place=True)
+    order = replace_guid_with_id(order)
+    yield from upsert(table_name, order)
+
+    if order.get("deleted") and "id" in order:
+        yield from delete(table_name, {"id": order["id"]})
+
+def token_pages(url, headers):
+    """
+    Generator of response pages for an endpoint paginated with the Toast-Next-Page-Token header.
+    A page token that has expired is handled by TokenPagination: pages already yielded are replayed, not yielded again.
+    :param url: endpoint URL, including query parameters
+    :param headers: request headers
+    :return: generator of (response page, page digest, page index) triples
+    """
+    pagination = TokenPagination(urlsplit(url).path)
+    while pagination.params is not None:
+        try:
+            response_page, next_token = get_api_response(url, headers, params=pagination.params,
+                                                         restart_on_conflict=False)
+        except PageTokenExpired:
+            pagination.conflict()
+            continue
+        page = pagination.page(response_page or [], next_token)
+        if page is not None:
+            yield page
+
+class PageTokenExpired(Exception):
+    """Raised by get_api_response for a 409 to a request with a pageToken, when the caller handles restarts"""
+
+class TokenPagination:
+    """
+    Position in an endpoint paginated with Toast-Next-Page-Token, across 409s for expired page tokens.
+    Toast cannot resume from an expired token, so pagination starts again from the first page. The pages of the new
+    pass are matched against the digests of the pages confirmed so far: an unchanged page is dropped, a changed one is
+    processed again, and pages past the last confirmed one are new. The conflicts and the refetched pages are counted
+    in the sync metrics, whose amplification shows the extra requests they caused.
+    :param endpoint: endpoint path for the metrics
+    :param max_restarts: number of expired tokens after which the endpoint fails
+    """
+
+    def __init__(self, endpoint, max_restarts=10):
+        self.endpoint = endpoint
+        self.max_restarts = max_restarts
+        self.confirmed = []  # digests of the pages processed, in page order
+        self.position = 0  # page of the current pass being fetched
+        self.restarts = 0
+        self.params = {}  # parameters of the next request, None once the last page has been fetched
+
+    def conflict(self):
+        """Starts a new pass from the first page after a 409"""
+        self.restarts += 1
+        metrics.add_endpoint(self.endpoint, conflicts=1)
+        if self.restarts > self.max_restarts:
+            raise RuntimeError(f"Page token for {self.endpoint} expired {self.restarts} times")
+        log.info(f"Page token expired for {self.endpoint} after page {self.position}, "
+                 f"replaying {len(self.confirmed)} confirmed pages")
+        self.position = 0
+        self.params = {}
+
+    def page(self, response_page, next_token):
+        """
+        Records a fetched page and the token for the next one
+        :param response_page: response page
+        :param next_token: Toast-Next-Page-Token of the response
+        :return: (response page, page digest, page index) to process,
+            or None for an unchanged page that was already processed
+        """
+        digest = page_digest(response_page)
+        replayed = self.position < len(self.confirmed)
+        if replayed:
+            metrics.add_endpoint(self.endpoint, refetched_pages=1)
+            unchanged = self.confirmed[self.position] == digest
+            self.confirmed[self.position] = digest
+        else:
+            unchanged = False
+            self.confirmed.append(digest)
+        self.position += 1
+        self.params = {"pageToken": next_token} if next_token else None
+        return None if unchanged else (response_page, digest, self.position - 1)
+
+def numbered_page(url, headers, params, page_num, stream=False):
+    """
+    Fetches one page of an endpoint paginated with a page number
+    :param url: endpoint URL
+    :param headers: request headers
+    :param params: request parameters, including pageSize
+    :param page_num: page number to fetch, starting at 1
+    :param stream: whether to return an iterator over the streamed response instead of the parsed page
+    :return: response page, or an empty list if the request failed
+    """
+    response_page, next_token = get_api_response(url, headers, params={**params, "page": page_num}, stream=stream)
+    return response_page if response_page is not None else []
+
+def prefetch(pages, depth):
+    """
+    Runs a page generator in a background thread, up to depth pages ahead of the consumer,
+    so the next page is fetched while the current one is being transformed and upserted.
+    :param pages: zero-argument callable returning a generator of pages
+    :param depth: maximum number of pages fetched ahead, 0 runs the generator in the calling thread
+    :return: generator of pages, in order
+    """
+    if depth <= 0:
+        return pages()
+    # a single task on a two-thread pool always runs in the background
+    return yield_in_order([pages], 2, buffer_size=depth)
+
+def prefetch_numbered_pages(fetch_page, depth, page_size):
+    """
+    Fetches pages of a page-numbered endpoint speculatively, up to depth pages in flight at once,
+    and yields them in page order. No new pages are requested once a short page shows up;
+    pages already in flight past it are discarded.
+    :param fetch_page: callable taking a page number and returning the page as a list
+    :param depth: number of pages in flight at once
+    :param page_size: number of items in a full page
+    :return: generator of pages, in order
+    """
+    executor = ThreadPoolExecutor(max_workers=depth)
+    in_flight = deque()
+    next_page = 1
+    try:
+        while True:
+            while len(in_flight) < depth:
+                in_flight.append(executor.submit(fetch_page, next_page))
+                next_page += 1
+            page = in_flight.popleft().result()
+            yield page
+            if len(page) < page_size:
+                return
+    finally:
+        for future in in_flight:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+async def process_config_async(base_url, headers, endpoint, table_name, rst_id, timerange, prefetch_pages=0,
+                               cache=None, cache_updates=None, *, client, emit):
+    """
+    Coroutine version of process_config for the async engine, the operations of each page are passed to emit.
+    Pages are requested one after another since each one needs the previous page's token, prefetch_pages is
+    accepted for the same signature: the next page is already requested while the consumer works through earlier ones.
+    :param client: aiohttp session
+    :param emit: coroutine function taking a list of operations
+    :return:
+    """
+    headers = {**headers, "Toast-Restaurant-External-ID": rst_id}
+    fetched_at = datetime.now(timezone.utc).isoformat("T", "milliseconds").replace("+00:00", "Z")
+    cache_key = f"{rst_id}{endpoint}"
+    timerange, previous_pages = cached_timerange(cache, cache_key, timerange)
+    page_hashes = []
+
+    param_string = "&".join(f"{key}={value}" for key, value in timerange.items())
+    url = base_url + endpoint + "?" + param_string
+    pagination = TokenPagination(endpoint)
+
     try:
-        for page_num in range(1, 1_000_000):  # Prevent infinite loops; max reasonable pages
-            params["page"] = page_num
-            response_page, next_token = get_api_response(base_url + endpoint, headers, params=params)
+        while pagination.params is not None:
+            try:
+                response_page, next_token = await async_get_api_response(client, url, headers, params=pagination.params,
+                                                                         restart_on_conflict=False)
+            except PageTokenExpired:
+                pagination.conflict()
+                continue
+            page = pagination.page(response_page or [], next_token)
+            if page is None:
+                continue
+            response_page, page_hash, page_index = page
             log.fine(f"restaurant {rst_id}: response_page has {len(response_page)} items for {endpoint}")
+            # a page that changed when it was replayed after an expired page token replaces its earlier hash
+            page_hashes[page_index:page_index + 1] = [page_hash]
+            if page_hash in previous_pages:
+                log.fine(f"restaurant {rst_id}: page unchanged for {endpoint}, skipping upserts")
+            else:
+                await emit(list(config_operations(table_name, rst_id, response_page)))
 
-            if not response_page:
-                break  # No more data
+        if cache is not None:
+            (cache if cache_updates is None else cache_updates)[cache_key] = {"last_modified": fetched_at,
+                                                                             "pages": page_hashes}
 
-            for order in response_page:
-                order["restaurant_id"] = rst_id
-                yield from process_payments(order)
-                yield from process_pricing_features(order)
+    except Exception as e:
+        # Return error response
+        exception_message = str(e)
+        stack_trace = traceback.format_exc()
+        detailed_message = f"Error Message: {exception_message}\nStack Trace:\n{stack_trace}"
+        raise RuntimeError(detailed_message)
+
+async def process_labor_async(base_url, headers, endpoint, table_name, rst_id, params=None, cache=None,
+                              cache_updates=None, *, client, emit):
+    """
+    Coroutine version of process_labor for the async engine, the operations are passed to emit.
+    :param client: aiohttp session
+    :param emit: coroutine function taking a list of operations
+    :return:
+    """
+    params = params or {}
+    headers = {**headers, "Toast-Restaurant-External-ID": rst_id}
+    fetched_at = datetime.now(timezone.utc).isoformat("T", "milliseconds").replace("+00:00", "Z")
+
+    try:
+        response_page, next_token = await async_get_api_response(client, base_url + endpoint, headers, params=params)
+        log.fine(f"restaurant {rst_id}: response_page has {len(response_page)} items for {endpoint}")
 
-                order = flatten_fields(fields_to_flatten, order)
+        if cache is not None and labor_response_unchanged(cache, f"{rst_id}{endpoint}", response_page, fetched_at,
+                                                          cache_updates):
+            log.fine(f"restaurant {rst_id}: response unchanged for {endpoint}, skipping upserts")
+            return
 
-                for field in fields_extract_ids:
-                    if order.get(field) and "guid" in order[field]:
-                        order[f"{field}_guid"] = order[field]["guid"]
-                        order.pop(field, None)
+        await emit(list(labor_operations(endpoint, table_name, rst_id, response_page)))
 
-                order.pop("checks", None)
-                order = stringify_lists(order)
-                order = replace_guid_with_id(order)
-                yield op.upsert(table=table_name, data=order)
+    except Exception as e:
+        # Return error response
+        exception_message = str(e)
+        stack_trace = traceback.format_exc()
+        detailed_message = f"Error Message: {exception_message}\nStack Trace:\n{stack_trace}"
+        raise RuntimeError(detailed_message)
+
+async def process_cash_async(base_url, headers, endpoint, table_name, rst_id, params, *, client, emit):
+    """
+    Coroutine version of process_cash for the async engine, the operations of each business date are passed to emit.
+    :param client: aiohttp session
+    :param emit: coroutine function taking a list of operations
+    :return:
+    """
+    headers = {**headers, "Toast-Restaurant-External-ID": rst_id}
+    try:
+        date_range = generate_business_dates(params["startDate"], params["endDate"])
 
-                if order.get("deleted") and "id" in order:
-                    yield op.delete(table=table_name, keys={"id": order["id"]})
+        for d in date_range:
+            response_page, next_token = await async_get_api_response(client, base_url + endpoint + "?businessDate=" + d,
+                                                                     headers)
+            await emit(list(cash_operations(table_name, rst_id, response_page)))
+
+    except Exception as e:
+        # Return error response
+        exception_message = str(e)
+        stack_trace = traceback.format_exc()
+        detailed_message = f"Error Message: {exception_message}\nStack Trace:\n{stack_trace}"
+        raise RuntimeError(detailed_message)
+
+async def process_orders_async(base_url, headers, endpoint, table_name, rst_id, params, prefetch_pages=0, *,
+                               client, emit):
+    """
+    Coroutine version of process_orders for the async engine, the operations of each page are passed to emit.
+    Up to prefetch_pages pages are requested at once, like prefetch_numbered_pages; requests past the first
+    short page are cancelled.
+    :param client: aiohttp session
+    :param emit: coroutine function taking a list of operations
+    :return:
+    """
+    headers = {**headers, "Toast-Restaurant-External-ID": rst_id}
+    params = {**params, "pageSize": 100}
+    in_flight = deque()
+    next_page = 1
+
+    try:
+        while True:
+            while len(in_flight) < max(1, prefetch_pages):
+                in_flight.append(asyncio.ensure_future(
+                    async_get_api_response(client, base_url + endpoint, headers, params={**params, "page": next_page})))
+                next_page += 1
+            response_page, next_token = await in_flight.popleft()
+            response_page = response_page or []
+
+            operations = []
+            for order in response_page:
+                operations.extend(order_operations(table_name, rst_id, order))
+            log.fine(f"restaurant {rst_id}: response_page has {len(response_page)} items for {endpoint}")
+            await emit(operations)
 
             if len(response_page) < params["pageSize"]:
                 break  # No more pages available
@@ -357,6 +1587,27 @@ def process_orders(base_url, headers, endpoint, table_name, rst_id, params):
         detailed_message = f"Error Message: {exception_message}\nStack Trace:\n{stack_trace}"
         raise RuntimeError(detailed_message)
 
+    finally:
+        for future in in_flight:
+            future.cancel()
+        await asyncio.gather(*in_flight, return_exceptions=True)
+
+# coroutine version of each endpoint function, used by restaurant_tasks with the async engine
+async_processors = {process_config: process_config_async,
+                    process_labor: process_labor_async,
+                    process_cash: process_cash_async,
+                    process_orders: process_orders_async}
+
+def async_task(task):
+    """
+    Swaps a task from restaurant_tasks for the coroutine version of its endpoint function, with the same arguments.
+    Tasks without a coroutine version, like process_restaurant, are returned unchanged.
+    :param task: partial of an endpoint function
+    :return: partial of a coroutine function, or the task itself
+    """
+    process = async_processors.get(task.func)
+    return partial(process, *task.args, **task.keywords) if process else task
+
 def process_payments(order):
     """
     This function processes payment information for an order.
@@ -373,17 +1624,15 @@ def process_payments(order):
         for check in order["checks"]:
             if "payments" in check:
                 for payment in check["payments"]:
-                    yield op.upsert(
-                        table="orders_check_payment",
-                        data={"orders_check_id": check["guid"],
-                              "payment_id": payment["guid"],
-                              "orders_guid": order["guid"]}
-                    )
-                    payment = flatten_fields(fields_to_flatten, payment)
+                    yield from upsert("orders_check_payment",
+                                      {"orders_check_id": check["guid"],
+                                       "payment_id": payment["guid"],
+                                       "orders_guid": order["guid"]})
+                    payment = flatten_fields(fields_to_flatten, payment, in_place=True)
                     payment["restaurant_id"] = order["restaurant_id"]
                     process_void_info(payment)
                     payment = replace_guid_with_id(payment)
-                    yield op.upsert(table="payment", data=payment)
+                    yield from upsert("payment", payment)
 
 def process_pricing_features(order):
     """
@@ -393,88 +1642,202 @@ def process_pricing_features(order):
     """
     if "pricingFeatures" in order and order["pricingFeatures"]:
         for feature in order["pricingFeatures"]:
-            yield op.upsert(
-                table="orders_pricing_feature",
-                data={"orders_id": order["guid"], "pricing_feature": feature}
-            )
+            yield from upsert("orders_pricing_feature", {"orders_id": order["guid"], "pricing_feature": feature})
         order.pop("pricingFeatures", None)  # Remove processed field
 
-def process_child (parent, table_name, id_field_name, id_field):
+# dictionary of connector tables and the child fields (lists) that get their own tables
+# e.g. {"table_name": [("childField01", "child_table_name_01"), ("childField02", "child_table_name_02")] }
+child_relationships = {
+    "orders_check": [
+        ("selections", "orders_check_selection"),
+        ("appliedDiscounts", "orders_check_applied_discount"),
+        ("appliedServiceCharges", "orders_check_applied_service_charge")],
+    "orders_check_applied_discount": [
+        ("comboItems", "orders_check_applied_discount_combo_item"),
+        ("triggers", "orders_check_applied_discount_trigger")],
+    "orders_check_applied_service_charge": [
+        ("appliedTax", "orders_check_applied_service_charge_applied_tax")],
+    "orders_check_selection": [
+        ("appliedTaxes", "orders_check_selection_applied_tax"),
+        ("modifiers", "orders_check_selection_modifier"),
+        ("appliedDiscounts", "orders_check_selection_applied_discount")],
+    "orders_check_selection_applied_discount": [
+        ("comboItems", "orders_check_selection_applied_discount_combo_item"),
+        ("triggers", "orders_check_selection_applied_discount_trigger")]}
+
+# child_fields_to_flatten is a mapping of fields to flatten from source data.
+# Keys represent table names, and values are lists of field names.
+# The dictionary in each field should be used to create new fields, prefixed by the original field name.
+# e.g. "info": {"id": 1, "type": "foo"}
+# would become {"info_id": 1, "info_type": "foo} and the "info" key will be popped
+child_fields_to_flatten = {
+    "break": ["breakType"],
+    "employee_wage_override": ["jobReference"],
+    "orders_check": ["customer", "createdDevice", "lastModifiedDevice"],
+    "orders_check_applied_discount": ["approver", "appliedDiscountReason", "discount"],
+    "orders_check_applied_discount_trigger": ["selection"],
+    "orders_check_applied_service_charge": ["serviceCharge"],
+    "orders_check_selection": ["salesCategory", "itemGroup", "item", "diningOption", "refundDetails", "voidReason"],
+    "orders_check_selection_applied_discount": ["approver", "appliedDiscountReason", "discount"],
+    "orders_check_selection_applied_tax": ["taxRate"],
+    "orders_check_selection_modifier": ["diningOption", "item", "itemGroup", "optionGroup", "salesCategory",
+                                        "preModifier", "voidReason"],
+    "orders_check_selection_applied_discount_trigger": ["selection"]}
+
+# fields that are popped from a child row without being flattened, besides its child lists
+child_fields_to_drop = {"orders_check": ["payments"]}
+
+# tables whose rows can arrive with a null guid and get a generated id instead
+child_tables_generate_id = ["orders_check_selection_applied_tax"]
+
+# dicts in these fields have unique enough names that they do not need the field prefix
+fields_to_not_prefix = ["refundDetails", "jobReference"]
+
+# ChildPlan is the precompiled transform for one child table:
+# children: tuples of (child field, child table, id field name for the child rows)
+# flatten: fields whose dictionaries are flattened into the row, in order
+# skip: fields not copied as-is into the output row (children, flattened and dropped fields)
+# generate_id: whether rows with a null guid get a generated id
+ChildPlan = namedtuple("ChildPlan", ["children", "flatten", "skip", "generate_id"])
+
+def compile_child_plan(table_name):
+    """
+    Builds the ChildPlan for a table from child_relationships, child_fields_to_flatten,
+    child_fields_to_drop and child_tables_generate_id
+    :param table_name: connector table name
+    :return: ChildPlan
+    """
+    children = tuple((child_key, child_table_name, table_name + "_id")
+                     for child_key, child_table_name in child_relationships.get(table_name, []))
+    flatten = tuple(child_fields_to_flatten.get(table_name, []))
+    skip = frozenset([child_key for child_key, _, _ in children] + list(flatten)
+                     + child_fields_to_drop.get(table_name, []) + ["guid"])
+    return ChildPlan(children, flatten, skip, table_name in child_tables_generate_id)
+
+# plans for every known child table, compiled once at import
+child_plans = {table_name: compile_child_plan(table_name)
+               for table_name in set(child_relationships) | set(child_fields_to_flatten)
+               | {child_table_name for relations in child_relationships.values() for _, child_table_name in relations}}
+
+# cache of flattened key names per (prefix, key) pair, see flat_key()
+flat_keys = {}
+
+def flat_key(prefix, key):
+    """
+    Returns the name of key once flattened under prefix, using the same rules as flatten_dict.
+    Names are computed once per (prefix, key) pair and interned.
+    :param prefix: name of the field being flattened
+    :param key: key within the field's dictionary
+    :return: the flattened key name
+    """
+    new_key = flat_keys.get((prefix, key))
+    if new_key is None:
+        if key.startswith(prefix):
+            new_key = key
+        elif key == "tipRefundAmount" and prefix == "refund":
+            new_key = "refund_tip_amount"
+        elif prefix in fields_to_not_prefix:
+            new_key = key
+        else:
+            new_key = f"{prefix}_{key}"
+        new_key = sys.intern(new_key)
+        flat_keys[(prefix, key)] = new_key
+    return new_key
+
+def flatten_into(row, dict_field, prefix):
+    """
+    Writes the flattened keys of dict_field into row, with guid renamed to id and lists stringified.
+    Same result as flatten_dict followed by stringify_lists, without copying row or dict_field.
+    :param row: output row
+    :param dict_field: the dictionary to flatten
+    :param prefix: the prefix for the keys of dict_field
+    """
+    has_guid = "guid" in dict_field
+    for key, value in dict_field.items():
+        if key == "guid":
+            key = "id"
+        elif key == "id" and has_guid:
+            continue
+        new_key = flat_key(prefix, key)
+        if isinstance(value, dict):
+            if value:
+                flatten_into(row, value, new_key)
+        elif isinstance(value, list):
+            row[new_key] = list_to_string(value)
+        else:
+            row[new_key] = value
+
+def apply_child_plan(plan, p):
+    """
+    Builds the output row for a child record in a single pass:
+    copies plain fields, stringifies lists, renames guid to id and flattens the plan's fields.
+    :param plan: ChildPlan for the record's table
+    :param p: child record
+    :return: new row dictionary, p is left unchanged
+    """
+    skip = plan.skip
+    row = {}
+    for key, value in p.items():
+        if key in skip:
+            continue
+        row[key] = list_to_string(value) if isinstance(value, list) else value
+    if "guid" in p:
+        row["id"] = p["guid"]
+
+    # flattened values win over plain fields of the same name, as with flatten_fields
+    for field in plan.flatten:
+        value = p.get(field)
+        if isinstance(value, dict):
+            flatten_into(row, value, field)
+        elif value is not None and field not in row:
+            row[field] = list_to_string(value) if isinstance(value, list) else value
+
+    # check for null guids, e.g. in appliedTaxes[]
+    if plan.generate_id and row.get("id") is None:
+        row["id"] = "gen-" + str(uuid.uuid4())
+    return row
+
+def process_child (parent, table_name, id_field_name, id_field, transform_seconds=None):
     """
     Iterates through records in parent list to generate child tables.
-    If child tables also contain child records
+    If child tables also contain child records, they are processed recursively.
+    Each table's transform comes from its precompiled plan in child_plans.
     :param parent: parent record (list) which contains children
     :param table_name: connector table name for parent record
     :param id_field_name: id field name in parent record to tie child to parent
     :param id_field: id field value in parent record
+    :param transform_seconds: Counter of transform time per table, shared by the recursive calls.
+        The outermost call makes it and adds it to the sync metrics once all rows are yielded
     :return:
     """
-
-    # dictionary of connector tables and the child fields (lists) that get their own tables
-    # e.g. {"table_name": [("childField01", "child_table_name_01"), ("childField02", "child_table_name_02")] }
-    relationships = {"orders_check": [
-            ("selections", "orders_check_selection"),
-            ("appliedDiscounts", "orders_check_applied_discount"),
-            ("appliedServiceCharges", "orders_check_applied_service_charge")],
-        "orders_check_applied_discount": [
-            ("comboItems", "orders_check_applied_discount_combo_item"),
-            ("triggers", "orders_check_applied_discount_trigger")],
-        "orders_check_applied_service_charge": [
-            ("appliedTax", "orders_check_applied_service_charge_applied_tax")],
-        "orders_check_selection": [
-            ("appliedTaxes", "orders_check_selection_applied_tax"),
-            ("modifiers", "orders_check_selection_modifier"),
-            ("appliedDiscounts", "orders_check_selection_applied_discount")],
-        "orders_check_selection_applied_discount":
-            [("comboItems", "orders_check_selection_applied_discount_combo_item"),
-             ("triggers", "orders_check_selection_applied_discount_trigger")]
-                     }
-
-    # fields_to_flatten is a mapping of fields to flatten from source data.
-    # Keys represent table names, and values are lists of field names.
-    # The dictionary in each field should be used to create new fields, prefixed by the original field name.
-    # e.g. "info": {"id": 1, "type": "foo"}
-    # would become {"info_id": 1, "info_type": "foo} and the "info" key will be popped
-    fields_to_flatten = {
-        "break": ["breakType"],
-        "employee_wage_override": ["jobReference"],
-        "orders_check": ["customer", "createdDevice", "lastModifiedDevice"],
-        "orders_check_applied_discount": ["approver", "appliedDiscountReason", "discount"],
-        "orders_check_applied_discount_trigger": ["selection"],
-        "orders_check_applied_service_charge": ["serviceCharge"],
-        "orders_check_selection": ["salesCategory", "itemGroup", "item", "diningOption", "refundDetails", "voidReason"],
-        "orders_check_selection_applied_discount": ["approver", "appliedDiscountReason", "discount"],
-        "orders_check_selection_applied_tax": ["taxRate"],
-        "orders_check_selection_modifier": ["diningOption", "item", "itemGroup", "optionGroup", "salesCategory"
-            , "preModifier", "voidReason" ],
-        "orders_check_selection_applied_discount_trigger": ["selection"]}
-
+    plan = child_plans.get(table_name) or compile_child_plan(table_name)
+    outermost = transform_seconds is None
+    if outermost:
+        transform_seconds = Counter()
+
+    # the records of this list are transformed together, so the transform is timed once per list rather than once per row
+    started = time.perf_counter()
+    rows = []
     for p in parent:
-        #log.fine(f"processing {table_name}")
         p[id_field_name] = id_field
-        if table_name in relationships:
-            for child_key, child_table_name in relationships[table_name]:
-                if len(p.get(child_key, [])) > 0:
-                    yield from process_child(
-                        p[child_key],
-                        child_table_name,
-                        table_name + "_id",
-                        p["guid"]
-                    )
-                p.pop(child_key, None)
-        if table_name in fields_to_flatten:
-            #log.fine(f"flattening fields in {table_name}")
-            p = flatten_fields(fields_to_flatten[table_name], p)
-        # check for null guids in appliedTaxes[]
-        if table_name == "orders_check_selection_applied_tax" and p.get("guid") is None:
-            p["guid"] = "gen-" + str(uuid.uuid4())
-        if table_name == "orders_check":
-            p.pop("payments", None)
-        p = stringify_lists(p)
-        p = replace_guid_with_id(p)
-        yield op.upsert(table=table_name, data=p)
-        if p.get("deleted") and "id" in p:
-            yield op.delete(table=table_name, keys={"id": p["id"]})
+        rows.append(apply_child_plan(plan, p))
+    transform_seconds[table_name] += time.perf_counter() - started
+
+    for p, row in zip(parent, rows):
+        for child_key, child_table_name, child_id_field_name in plan.children:
+            if p.get(child_key):
+                yield from process_child(p[child_key], child_table_name, child_id_field_name, p["guid"],
+                                         transform_seconds)
+        if pending_rows:
+            yield PendingRow("upsert", table_name, row)  # what upsert() would yield, without a generator per row
+        else:
+            yield from upsert(table_name, row)
+        if row.get("deleted") and "id" in row:
+            yield from delete(table_name, {"id": row["id"]})
+
+    if outermost:
+        for table, seconds in transform_seconds.items():
+            metrics.add_table(table, transform_seconds=seconds)
 
 def process_void_info(payment):
     """
@@ -513,9 +1876,49 @@ def process_void_info(payment):
         payment.pop("voidInfo", None)
 
 
+def configure_session(configuration, max_workers=1):
+    """
+    Creates the shared HTTP session used for all Toast requests.
+    Pool sizes can be tuned in the configuration:
+    - poolConnections: number of hosts to keep a connection pool for
+    - poolMaxsize: maximum number of keep-alive connections per host, defaults to at least max_workers
+    :param configuration: a dictionary that holds the configuration settings for the connector.
+    :param max_workers: number of concurrent workers sharing the session
+    :return: the shared session
+    """
+    global session
+    pool_connections = int(configuration.get("poolConnections", 10))
+    pool_maxsize = int(configuration.get("poolMaxsize", max(10, max_workers)))
+
+    new_session = rq.Session()
+    # pool_block makes workers wait for a free connection instead of opening extra ones past the per-host limit
+    adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, pool_block=True)
+    new_session.mount("https://", adapter)
+    new_session.mount("http://", adapter)
+
+    with session_lock:
+        if session is not None:
+            session.close()
+        session = new_session
+    log.fine(f"HTTP session configured with {pool_connections} host pools of {pool_maxsize} connections")
+    return session
+
+def get_session():
+    """
+    Returns the shared HTTP session, creating one with default pool sizes if update() has not configured it
+    :return: requests.Session
+    """
+    global session
+    with session_lock:
+        if session is None:
+            session = rq.Session()
+        return session
+
 def make_headers(conf, base_url, state, key):
     """
     Create authentication headers, reusing a cached token if possible.
+    The token is held by the shared token_manager, which keeps it fresh for the rest of the sync:
+    get_api_response replaces the Authorization header of these headers with the current token on every request.
 
     :param conf: Dictionary containing authentication details.
     :param base_url: Base URL of the API.
@@ -523,51 +1926,194 @@ def make_headers(conf, base_url, state, key):
     :param key: Encryption key (Fernet) used for token encryption/decryption.
     :return: Tuple (headers, updated_state)
     """
-    fernet = Fernet(key)
-    current_time = time.time()
+    token_manager.configure(conf, base_url, state, key)
+    return {"Authorization": f"Bearer {token_manager.token_for_request()}", "Accept": "application/json"}, state
 
-    # Check if a valid token exists and is not expiring in the next hour
-    if "encrypted_token" in state and "token_ttl" in state and state["token_ttl"] > current_time + 3600:
+class TokenManager:
+    """
+    Process-wide holder of the Toast access token, shared by every worker thread and coroutine.
+    Once less than refresh_before seconds of the token are left, a single background thread logs in again while
+    requests keep using the current token, and the new token is swapped in under the lock.
+    Requests only wait for a login when the token has expired or Toast rejected it with a 401.
+    After a failed background refresh, the next one waits refresh_backoff seconds, doubling with each failure in a row.
+    The token is stored encrypted in state so the next sync can reuse it. The Fernet object and the decrypted token
+    are kept between syncs in the same process, so a token already held is not decrypted again.
+    """
+
+    def __init__(self, refresh_before=3600, expiry_margin=60, refresh_backoff=30, max_refresh_backoff=600):
+        """
+        :param refresh_before: seconds before expiry at which the background refresh starts
+        :param expiry_margin: seconds before expiry at which the token is no longer sent
+        :param refresh_backoff: seconds to wait after a failed background refresh before starting another one
+        :param max_refresh_backoff: longest wait between background refreshes that keep failing
+        """
+        self.lock = threading.Lock()
+        self.login_lock = threading.Lock()  # one login at a time, whether in the background or not
+        self.refresh_before = refresh_before
+        self.expiry_margin = expiry_margin
+        self.key = None
+        self.fernet = None
+        self.login = None  # (base_url, login payload) of the configured client
+        self.state = None
+        self.token = None
+        self.encrypted_token = None
+        self.expires_at = 0.0
+        self.refreshing = False
+        self.refreshes = 0
+        self.refresh_backoff = refresh_backoff
+        self.max_refresh_backoff = max_refresh_backoff
+        self.failed_refreshes = 0  # background refreshes failed in a row
+        self.next_refresh_at = 0.0  # no background refresh is started before this time
+
+    def configure(self, conf, base_url, state, key):
+        """
+        Sets the client to log in as and the state the token is stored in, taking over a valid token from state.
+        Logs in if there is no valid token.
+        :param conf: Dictionary containing authentication details.
+        :param base_url: Base URL of the API.
+        :param state: connector state, holding encrypted_token and token_ttl
+        :param key: Encryption key (Fernet) used for token encryption/decryption.
+        """
+        payload = {
+            "clientId": conf.get("clientId"),
+            "clientSecret": conf.get("clientSecret"),
+            "userAccessType": conf.get("userAccessType")
+        }
+        with self.lock:
+            if key != self.key:
+                self.key, self.fernet = key, Fernet(key)
+                self.token, self.encrypted_token, self.expires_at = None, None, 0.0
+            if (base_url, payload) != self.login:
+                self.login = (base_url, payload)
+                self.token, self.encrypted_token, self.expires_at = None, None, 0.0
+            self.state = state
+
+            encrypted_token, token_ttl = state.get("encrypted_token"), state.get("token_ttl", 0)
+            if encrypted_token == self.encrypted_token and self.token:
+                log.info("encrypted_token in state is already held, reusing")
+            elif encrypted_token and token_ttl > max(self.expires_at, time.time() + self.expiry_margin):
+                try:
+                    self.token = self.fernet.decrypt(encrypted_token.encode()).decode()
+                    self.encrypted_token, self.expires_at = encrypted_token, token_ttl
+                    log.info("encrypted_token found in state, reusing")
+                except Exception as e:
+                    print(f"⚠️ Token decryption failed: {e}, re-authenticating...")
+            elif self.token:
+                self.store()  # the token held is newer than the one in state
+
+    def token_for_request(self):
+        """
+        Returns the token to send, starting a background refresh when it is close to expiry.
+        Blocks for a login only when there is no valid token.
+        :return: access token
+        """
+        with self.lock:
+            token = self.token
+            if token and time.time() < self.expires_at - self.expiry_margin:
+                if (time.time() > self.expires_at - self.refresh_before and not self.refreshing
+                        and time.time() >= self.next_refresh_at):
+                    self.refreshing = True
+                    threading.Thread(target=self.refresh_in_background, args=(token,), name="toast-token-refresh",
+                                     daemon=True).start()
+                return token
+        return self.refresh(token)
+
+    def refresh_in_background(self, token):
         try:
-            auth_token = fernet.decrypt(state["encrypted_token"].encode()).decode()
-            log.info("encrypted_token found with at least an hour left, reusing")
-            return {"Authorization": f"Bearer {auth_token}", "Accept": "application/json"}, state
+            self.refresh(token, background=True)
         except Exception as e:
-            print(f"⚠️ Token decryption failed: {e}, re-authenticating...")
-
-    # No valid token OR token expiring within 1 hour, request a new one
-    payload = {
-        "clientId": conf.get("clientId"),
-        "clientSecret": conf.get("clientSecret"),
-        "userAccessType": conf.get("userAccessType")
-    }
-
-    try:
-        log.info("encrypted_token not found in state or is expiring soon, requesting new token")
-        auth_response = rq.post(f"{base_url}/authentication/v1/authentication/login",
-                                json=payload, timeout=10)
-        auth_response.raise_for_status()
-        auth_page = auth_response.json()
-
-        # Extract token safely
-        auth_token = auth_page.get("token", {}).get("accessToken")
-        token_expiry = auth_page.get("token", {}).get("expiresIn", 3600)  # Default to 1 hour
-
-        if not auth_token:
-            raise ValueError("Authentication failed: accessToken missing in response")
-
-        # Encrypt and store the new token
+            # requests keep using the current token, and log in themselves once it expires
+            with self.lock:
+                self.failed_refreshes += 1
+                backoff = min(self.refresh_backoff * 2 ** (self.failed_refreshes - 1), self.max_refresh_backoff)
+                self.next_refresh_at = time.time() + backoff
+            log.warning(f"Background token refresh failed: {e}, retrying in {backoff:.0f} seconds")
+        finally:
+            with self.lock:
+                self.refreshing = False
+
+    def refresh(self, stale_token, background=False):
+        """
+        Logs in for a new token, unless another thread has already replaced stale_token
+        :param stale_token: the token the caller found expired, rejected or about to expire
+        :param background: whether this is the proactive refresh, which replaces a token that is still valid
+        :return: access token
+        """
+        with self.login_lock:
+            with self.lock:
+                if self.token and self.token != stale_token and time.time() < self.expires_at - self.expiry_margin:
+                    return self.token
+                base_url, payload = self.login
+
+            log.info("encrypted_token not found in state or is expiring soon, requesting new token" if not background
+                     else "token is expiring soon, refreshing it in the background")
+            try:
+                auth_response = get_session().post(f"{base_url}/authentication/v1/authentication/login",
+                                                   json=payload, timeout=10)
+                auth_response.raise_for_status()
+                auth_page = auth_response.json()
+            except rq.exceptions.RequestException as e:
+                raise RuntimeError(f"❌ Failed to authenticate: {e}")
+
+            # Extract token safely
+            auth_token = auth_page.get("token", {}).get("accessToken")
+            token_expiry = auth_page.get("token", {}).get("expiresIn", 3600)  # Default to 1 hour
+            if not auth_token:
+                raise ValueError("Authentication failed: accessToken missing in response")
+
+            with self.lock:
+                self.token, self.encrypted_token, self.expires_at = auth_token, None, time.time() + token_expiry
+                self.refreshes += 1
+                self.failed_refreshes, self.next_refresh_at = 0, 0.0
+                self.store()
+            return auth_token
+
+    def store(self):
+        """Encrypts the token into state, called with the lock held"""
         try:
-            encrypted_token = fernet.encrypt(auth_token.encode()).decode()
-            state["encrypted_token"] = encrypted_token
-            state["token_ttl"] = current_time + token_expiry  # Store expiry timestamp
+            if self.encrypted_token is None:
+                self.encrypted_token = self.fernet.encrypt(self.token.encode()).decode()
+            self.state["encrypted_token"] = self.encrypted_token
+            self.state["token_ttl"] = self.expires_at  # Store expiry timestamp
         except Exception as enc_error:
             print(f"⚠️ Token encryption failed: {enc_error}. Proceeding without storing.")
 
-        return {"Authorization": f"Bearer {auth_token}", "Accept": "application/json"}, state
-
-    except rq.exceptions.RequestException as e:
-        raise RuntimeError(f"❌ Failed to authenticate: {e}")
+    def authorize(self, headers):
+        """
+        Returns headers with the current token, for headers from make_headers.
+        Headers without an Authorization header are returned unchanged.
+        :param headers: request headers
+        :return: request headers
+        """
+        if "Authorization" not in headers or self.login is None:
+            return headers
+        return {**headers, "Authorization": f"Bearer {self.token_for_request()}"}
+
+    async def authorize_async(self, headers):
+        """
+        Coroutine version of authorize, which waits for a login in a worker thread instead of blocking the event loop
+        :param headers: request headers
+        :return: request headers
+        """
+        if self.token and time.time() < self.expires_at - self.expiry_margin:
+            return self.authorize(headers)
+        return await asyncio.to_thread(self.authorize, headers)
+
+    def rejected(self, headers):
+        """
+        Marks the token sent with headers as no longer valid after a 401, so the next request logs in again.
+        Concurrent 401s for the same token lead to a single login.
+        :param headers: request headers the 401 was returned for
+        :return: whether the headers carried a token from this manager, and the request can be retried right away
+        """
+        if "Authorization" not in headers or self.login is None:
+            return False
+        with self.lock:
+            if self.token and headers["Authorization"] == f"Bearer {self.token}":
+                self.expires_at = 0.0
+        return True
+
+token_manager = TokenManager()
 
 def is_older_than_30_days(date_to_check):
     """
@@ -587,7 +2133,8 @@ def is_older_than_30_days(date_to_check):
 def set_timeranges(state, configuration, start_timestamp):
     """
     Takes in current state and start timestamp of current sync.
-    from_ts is always either the end of the last sync or the initialSyncStart found in the config file.
+    An unfinished window of sync_items in state is returned unchanged.
+    Otherwise from_ts is either the end of the last sync or the initialSyncStart found in the config file.
     If from_ts is more than 30 days ago, then set a to_ts that is 30 days later than from_ts.
     Otherwise, to_ts is the time that this sync was triggered.
     :param state:
@@ -595,6 +2142,10 @@ def set_timeranges(state, configuration, start_timestamp):
     :param start_timestamp:
     :return: from_ts, to_ts
     """
+    # an unfinished window of sync_items is resumed as it was
+    if "window" in state:
+        return state["window"]["from"], state["window"]["to"]
+
     if 'to_ts' in state:
         from_ts = state['to_ts']
     else:
@@ -609,6 +2160,45 @@ def set_timeranges(state, configuration, start_timestamp):
 
     return from_ts, to_ts
 
+def page_digest(response_page):
+    """
+    Content hash of a response page, used to detect pages that have not changed since the last sync
+    :param response_page: parsed response page
+    :return: short hex digest
+    """
+    payload = json.dumps(response_page, sort_keys=True, separators=(",", ":")).encode()
+    return hashlib.blake2b(payload, digest_size=8).hexdigest()
+
+def timestamp_after(ts, other_ts):
+    """
+    Compares two ISO format timestamps, which may differ in precision and UTC notation
+    :return: whether ts is later than other_ts
+    """
+    return datetime.fromisoformat(ts.replace("Z", "+00:00")) > datetime.fromisoformat(other_ts.replace("Z", "+00:00"))
+
+def generate_shards(start_ts, end_ts):
+    """
+    Splits a time range into consecutive 30-day shards, the last one ending at end_ts
+    :param start_ts: ISO format datetime
+    :param end_ts: ISO format datetime later than start_ts
+    :return: list of (from_ts, to_ts) tuples
+    """
+    shard_start = datetime.fromisoformat(start_ts.replace("Z", "+00:00"))
+    end = datetime.fromisoformat(end_ts.replace("Z", "+00:00"))
+
+    shards = []
+    shard_from = start_ts
+    while shard_start < end:
+        shard_end = shard_start + timedelta(days=30)
+        if shard_end >= end:
+            shards.append((shard_from, end_ts))
+            break
+        shard_to = shard_end.isoformat(timespec="milliseconds").replace("+00:00", "Z")
+        shards.append((shard_from, shard_to))
+        shard_start, shard_from = shard_end, shard_to
+
+    return shards
+
 def generate_business_dates (start_ts, end_ts):
     """
     Takes in start_date and end_date, and generates a list of dates in YYYYMMDD format that include those dates
@@ -631,28 +2221,301 @@ def generate_business_dates (start_ts, end_ts):
 
     return date_list
 
+class RateLimiter:
+    """
+    Process-wide token bucket that paces outgoing Toast requests.
+    The bucket refills at requests_per_second and is adjusted from the X-Toast-RateLimit-Remaining and
+    X-Toast-RateLimit-Reset headers on every response, so the remaining quota is spread evenly until the reset.
+    Safe to share between worker threads. Throttling is recorded in throttled_seconds,
+    throttled_requests and rate_limited_responses.
+    """
+
+    def __init__(self, requests_per_second=20.0, burst=None):
+        self.lock = threading.Lock()
+        self.configure(requests_per_second, burst)
+
+    def configure(self, requests_per_second, burst=None):
+        """
+        Resets the bucket to a new base rate and clears the counters
+        :param requests_per_second: maximum sustained request rate
+        :param burst: bucket size, defaults to one second worth of requests
+        """
+        with self.lock:
+            self.max_rate = float(requests_per_second)
+            self.rate = self.max_rate
+            self.capacity = float(burst or max(1.0, self.max_rate))
+            self.tokens = self.capacity
+            self.updated_at = time.monotonic()
+            self.paused_until = 0.0
+            self.throttled_seconds = 0.0
+            self.throttled_requests = 0
+            self.rate_limited_responses = 0
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def acquire(self):
+        """
+        Blocks until a request may be sent, then takes a token from the bucket
+        :return: seconds spent waiting
+        """
+        waited = 0.0
+        while True:
+            wait_time = self.reserve(waited)
+            if not wait_time:
+                return waited
+            time.sleep(wait_time)
+            waited += wait_time
+
+    async def acquire_async(self):
+        """
+        Waits without blocking the event loop until a request may be sent, then takes a token from the bucket
+        :return: seconds spent waiting
+        """
+        waited = 0.0
+        while True:
+            wait_time = self.reserve(waited)
+            if not wait_time:
+                return waited
+            await asyncio.sleep(wait_time)
+            waited += wait_time
+
+    def reserve(self, waited):
+        """
+        Takes a token from the bucket if one is available
+        :param waited: seconds the caller has waited so far, recorded as throttling once the token is taken
+        :return: 0 if a token was taken, otherwise seconds to wait before trying again
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.refill(now)
+            if now >= self.paused_until and self.tokens >= 1:
+                self.tokens -= 1
+                if waited:
+                    self.throttled_seconds += waited
+                    self.throttled_requests += 1
+                return 0.0
+            return max(self.paused_until - now, (1 - self.tokens) / self.rate if self.rate > 0 else 1.0)
+
+    def update(self, response_headers):
+        """
+        Adapts the refill rate to the quota Toast reports on a response
+        :param response_headers: headers of the latest response
+        """
+        remaining = parse_int_header(response_headers, "X-Toast-RateLimit-Remaining")
+        reset = parse_int_header(response_headers, "X-Toast-RateLimit-Reset")
+        if remaining is None:
+            return
+
+        with self.lock:
+            now = time.monotonic()
+            self.refill(now)
+            seconds_to_reset = max(0.0, reset - time.time()) if reset is not None else None
+            if remaining <= 0:
+                # quota is used up, hold every worker until the window resets
+                self.paused_until = max(self.paused_until, now + (seconds_to_reset or 1.0))
+                self.tokens = 0.0
+            elif seconds_to_reset:
+                self.rate = min(self.max_rate, max(remaining / seconds_to_reset, 0.1))
+                self.tokens = min(self.tokens, float(remaining))
+            else:
+                self.rate = self.max_rate
+
+    def pause(self, seconds):
+        """
+        Holds all requests for the given number of seconds, used after a 429 response
+        :param seconds: time to wait before the next request
+        """
+        with self.lock:
+            self.rate_limited_responses += 1
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0.0
+
+    def stats(self):
+        """
+        :return: dictionary of throttling counters
+        """
+        with self.lock:
+            return {"throttled_seconds": round(self.throttled_seconds, 3),
+                    "throttled_requests": self.throttled_requests,
+                    "rate_limited_responses": self.rate_limited_responses,
+                    "current_rate": round(self.rate, 3)}
+
+# process-wide limiter shared by all workers, configured in update()
+rate_limiter = RateLimiter()
+
+class SyncMetrics:
+    """
+    Counters for one sync: requests, retries, 429s, bytes and time spent per endpoint,
+    and rows emitted and time spent per destination table. Safe to update from worker threads.
+    Time is split into waiting on the rate limiter, HTTP, JSON decoding, child row transforms and the SDK upsert call.
+    Amplification is requests per request that fetched a new page, the extra traffic caused by expired page tokens:
+    the 409s themselves and the pages fetched again after them.
+    """
+    endpoint_fields = ["requests", "retries", "rate_limited", "conflicts", "refetched_pages", "bytes", "throttle_seconds",
+                       "http_seconds", "decode_seconds"]
+    # computed from the endpoint fields in snapshot()
+    endpoint_columns = endpoint_fields + ["amplification"]
+    table_fields = ["upserts", "deletes", "transform_seconds", "upsert_seconds"]
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started_at = time.time()
+            self.endpoints = {}
+            self.tables = {}
+
+    def add_endpoint(self, endpoint, **values):
+        with self.lock:
+            self.endpoints.setdefault(endpoint, Counter()).update(values)
+
+    def add_table(self, table, **values):
+        with self.lock:
+            self.tables.setdefault(table, Counter()).update(values)
+
+    def snapshot(self):
+        """
+        :return: dictionary of all counters, with the sync duration and rate limiter counters
+        """
+        with self.lock:
+            return {"timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+                    "duration_seconds": round(time.time() - self.started_at, 3),
+                    "endpoints": {name: {**{f: round(c[f], 6) for f in self.endpoint_fields},
+                                         "amplification": amplification(c)}
+                                  for name, c in sorted(self.endpoints.items())},
+                    "tables": {name: {f: round(c[f], 6) for f in self.table_fields}
+                               for name, c in sorted(self.tables.items())},
+                    "rate_limiter": rate_limiter.stats()}
+
+    def summary(self):
+        """
+        :return: the counters formatted as two text tables, for the log
+        """
+        snapshot = self.snapshot()
+        lines = [f"sync metrics after {snapshot['duration_seconds']}s"]
+        for title, rows, fields in [("endpoint", snapshot["endpoints"], self.endpoint_columns),
+                                    ("table", snapshot["tables"], self.table_fields)]:
+            width = max([len(title)] + [len(name) for name in rows])
+            lines.append(f"{title:<{width}}  " + "  ".join(f"{f:>16}" for f in fields))
+            for name, counters in rows.items():
+                lines.append(f"{name:<{width}}  " + "  ".join(f"{format_metric(counters[f]):>16}" for f in fields))
+        lines.append(f"rate limiter: {snapshot['rate_limiter']}")
+        return "\n".join(lines)
+
+    def export(self, path):
+        """
+        Writes the counters to a file. A .prom path is overwritten with Prometheus text format,
+        for a node exporter textfile collector; any other path gets one JSON line appended per sync.
+        :param path: export file path
+        """
+        snapshot = self.snapshot()
+        if path.endswith(".prom"):
+            lines = [f"toast_sync_duration_seconds {snapshot['duration_seconds']}"]
+            for group, label, fields in [("endpoints", "endpoint", self.endpoint_columns),
+                                         ("tables", "table", self.table_fields)]:
+                for field in fields:
+                    lines.append(f"# TYPE toast_{label}_{field} gauge")
+                    for name, counters in snapshot[group].items():
+                        lines.append(f'toast_{label}_{field}{{{label}="{name}"}} {counters[field]}')
+            for name, value in snapshot["rate_limiter"].items():
+                lines.append(f"toast_rate_limiter_{name} {value}")
+            with open(path, "w") as f:
+                f.write("\n".join(lines) + "\n")
+        else:
+            with open(path, "a") as f:
+                f.write(json.dumps(snapshot) + "\n")
+
+def amplification(counters):
+    """
+    :param counters: endpoint counters
+    :return: requests divided by the requests that were not 409s or refetched pages, 1.0 without any
+    """
+    useful = counters["requests"] - counters["conflicts"] - counters["refetched_pages"]
+    return round(counters["requests"] / useful, 3) if useful > 0 else 1.0
+
+def format_metric(value):
+    return f"{value:.3f}" if isinstance(value, float) else str(value)
+
+# metrics for the running sync, reset at the start of update()
+metrics = SyncMetrics()
+
+def parse_int_header(response_headers, name):
+    """
+    Reads an integer header value
+    :param response_headers: response headers
+    :param name: header name
+    :return: header value as int, or None if missing or invalid
+    """
+    value = response_headers.get(name)
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        log.warning(f"Invalid {name} value: {value}")
+        return None
+
+def retry_wait_time(response_headers, retry_count):
+    """
+    Seconds to wait before retrying after a 429 response
+    :param response_headers: headers of the 429 response
+    :param retry_count: number of 429 responses so far for this request
+    :return: seconds to wait
+    """
+    retry_after = parse_int_header(response_headers, "Retry-After")
+    rate_limit_reset = parse_int_header(response_headers, "X-Toast-RateLimit-Reset")
+
+    if retry_after is not None:
+        return retry_after
+    if rate_limit_reset is not None:
+        return max(0, rate_limit_reset - int(time.time()))
+    # no hint from the server, back off exponentially instead of retrying immediately
+    return min(2 ** retry_count, 60)
+
 def get_api_response(endpoint_path, headers, **kwargs):
     """
     Sends an HTTP GET request to the provided URL with specified parameters.
 
-    - Retries if a 401 Unauthorized response occurs (up to a limit).
+    - Sends the current token from token_manager. After a 401 it logs in once for a new token, and retries up to a limit.
     - Skips the endpoint if a 403 Forbidden response is received.
+    - Paces requests with the shared rate limiter, which adapts to Toast's rate limit headers.
     - Handles rate-limiting (429) and retries accordingly.
     - Logs and returns API responses.
 
     :param endpoint_path: API URL
     :param headers: Request headers
-    :param kwargs: Additional request parameters
+    :param kwargs: Additional request parameters.
+        stream=True returns an iterator over the elements of the response's JSON array instead of the parsed page.
+        The body is read in full first, and the elements are parsed from it as the iterator is consumed.
+        restart_on_conflict=False raises PageTokenExpired for a 409, instead of retrying without the pageToken.
     :return: Tuple (response JSON, next_page_token) or (None, None) if failed
     """
     timerange_data = kwargs.get("data", {})
     params = copy.deepcopy(kwargs.get("params", {}))
+    stream = kwargs.get("stream", False)
+    restart_on_conflict = kwargs.get("restart_on_conflict", True)
 
     max_retries_401 = 3  # Limit retries for 401 errors
     retry_count_401 = 0
 
+    http = get_session()
+    retry_count_429 = 0
+    endpoint = urlsplit(endpoint_path).path
+    attempt = 0
+
     while True:
-        response = rq.get(endpoint_path, headers=headers, data=timerange_data, params=params)
+        request_headers = token_manager.authorize(headers)
+        throttle_seconds = rate_limiter.acquire()
+        started = time.perf_counter()
+        response = http.get(endpoint_path, headers=request_headers, data=timerange_data, params=params, stream=stream)
+        metrics.add_endpoint(endpoint, requests=1, retries=1 if attempt else 0,
+                             http_seconds=time.perf_counter() - started, throttle_seconds=throttle_seconds)
+        attempt += 1
+        rate_limiter.update(response.headers)
 
         # Handle 401 Unauthorized (retry up to max retries)
         if response.status_code == 401:
@@ -661,10 +2524,13 @@ def get_api_response(endpoint_path, headers, **kwargs):
                 return None, None
 
             retry_count_401 += 1
-            #reauth here?
 
             log.warning(f"401 Unauthorized - Retrying {retry_count_401}/{max_retries_401}")
-            time.sleep(2)
+            response.close()
+            # the first 401 of a request replaces a rejected token before the retry, any other is retried after a pause.
+            # An endpoint that keeps answering 401 then costs one login per request, not one per retry
+            if retry_count_401 > 1 or not token_manager.rejected(request_headers):
+                time.sleep(2)
             continue
 
         # Handle 403 Forbidden (Skip the endpoint)
@@ -673,30 +2539,24 @@ def get_api_response(endpoint_path, headers, **kwargs):
             raise PermissionError(f"403 Forbidden: Access denied to {endpoint_path}")
 
         # Handle 429 Too Many Requests
+        # the wait is applied to the shared rate limiter, so every worker backs off, not just this one
         if response.status_code == 429:
-            retry_after = response.headers.get("Retry-After")
-            rate_limit_reset = response.headers.get("X-Toast-RateLimit-Reset")
-
-            wait_time = None
-            if retry_after:
-                wait_time = int(retry_after)
-            elif rate_limit_reset:
-                try:
-                    reset_time = int(rate_limit_reset)
-                    wait_time = max(0, reset_time - int(time.time()))
-                except ValueError:
-                    log.warning(f"Invalid X-Toast-RateLimit-Reset value: {rate_limit_reset}")
-                    wait_time = 5  # Fallback wait time
-
-            if wait_time:
-                log.info(f"Rate limit exceeded. Retrying in {wait_time} seconds...")
-                time.sleep(wait_time)
-                continue  # Retry request
-
-        # Handle 409 Conflict: Retry without pageToken
+            retry_count_429 += 1
+            wait_time = retry_wait_time(response.headers, retry_count_429)
+            log.info(f"Rate limit exceeded. Retrying in {wait_time} seconds...")
+            metrics.add_endpoint(endpoint, rate_limited=1)
+            rate_limiter.pause(wait_time)
+            response.close()
+            continue  # Retry request
+
+        # Handle 409 Conflict: Retry without pageToken, unless the caller resumes pagination itself
         if response.status_code == 409:
+            if not restart_on_conflict and "pageToken" in params:
+                response.close()
+                raise PageTokenExpired(endpoint_path)
             params.pop("pageToken", None)
             log.info(f"Received 409 error, retrying {endpoint_path} without pageToken")
+            response.close()
             continue  # Retry without pageToken
 
         # Handle 400 Bad Request
@@ -706,26 +2566,235 @@ def get_api_response(endpoint_path, headers, **kwargs):
 
         response.raise_for_status()  # Raise error for unexpected HTTP issues
 
-        response_page = response.json()
+        if stream:
+            # the body is read before any element is parsed, so the connection goes back to the pool now.
+            # A caller held up by backpressure would otherwise keep it while other workers wait for a connection
+            response.content
+            response_page = iter_json_array(response, endpoint=endpoint)
+        else:
+            started = time.perf_counter()
+            response_page = response.json()
+            metrics.add_endpoint(endpoint, bytes=len(response.content), decode_seconds=time.perf_counter() - started)
         response_headers = response.headers
         next_page_token = response_headers.get("Toast-Next-Page-Token")
 
         return response_page, next_page_token  # Return successful response
 
-def stringify_lists(d):
+async def async_get_api_response(client, endpoint_path, headers, params=None, restart_on_conflict=True):
+    """
+    Coroutine version of get_api_response for the async engine, with the same handling of
+    401, 403, 429, 409 and 400 responses. Waits for the shared rate limiter without blocking the event loop.
+    :param client: aiohttp session
+    :param endpoint_path: API URL
+    :param headers: Request headers
+    :param params: Query parameters, added to any already in the URL
+    :param restart_on_conflict: False raises PageTokenExpired for a 409, instead of retrying without the pageToken
+    :return: Tuple (response JSON, next_page_token) or (None, None) if failed
+    """
+    params = dict(params or {})
+
+    max_retries_401 = 3  # Limit retries for 401 errors
+    retry_count_401 = 0
+    retry_count_429 = 0
+    endpoint = urlsplit(endpoint_path).path
+    attempt = 0
+
+    while True:
+        request_headers = await token_manager.authorize_async(headers)
+        throttle_seconds = await rate_limiter.acquire_async()
+        started = time.perf_counter()
+        async with client.get(endpoint_path, headers=request_headers, params=params) as response:
+            body = await response.read()
+        metrics.add_endpoint(endpoint, requests=1, retries=1 if attempt else 0,
+                             http_seconds=time.perf_counter() - started, throttle_seconds=throttle_seconds)
+        attempt += 1
+        rate_limiter.update(response.headers)
+
+        if response.status == 401:
+            if retry_count_401 >= max_retries_401:  # Fail after max retries
+                log.severe(f"401 Unauthorized - Max retries reached for {endpoint_path}")
+                return None, None
+            retry_count_401 += 1
+            log.warning(f"401 Unauthorized - Retrying {retry_count_401}/{max_retries_401}")
+            if retry_count_401 > 1 or not token_manager.rejected(request_headers):
+                await asyncio.sleep(2)
+            continue
+
+        if response.status == 403:
+            log.info(f"403 Forbidden - Skipping {endpoint_path}")
+            raise PermissionError(f"403 Forbidden: Access denied to {endpoint_path}")
+
+        if response.status == 429:
+            retry_count_429 += 1
+            wait_time = retry_wait_time(response.headers, retry_count_429)
+            log.info(f"Rate limit exceeded. Retrying in {wait_time} seconds...")
+            metrics.add_endpoint(endpoint, rate_limited=1)
+            rate_limiter.pause(wait_time)
+            continue
+
+        if response.status == 409:
+            if not restart_on_conflict and "pageToken" in params:
+                raise PageTokenExpired(endpoint_path)
+            params.pop("pageToken", None)
+            log.info(f"Received 409 error, retrying {endpoint_path} without pageToken")
+            continue
+
+        if response.status == 400:
+            log.info(f"Bad request: {json.loads(body).get('message')}")
+            return None, None
+
+        response.raise_for_status()  # Raise error for unexpected HTTP issues
+
+        started = time.perf_counter()
+        response_page = json.loads(body)
+        metrics.add_endpoint(endpoint, bytes=len(body), decode_seconds=time.perf_counter() - started)
+        return response_page, response.headers.get("Toast-Next-Page-Token")
+
+def iter_json_array(response, chunk_size=65536, endpoint=None):
+    """
+    Incrementally parses a JSON array from a response and yields one element at a time,
+    so only the current element is held in memory besides the body.
+    An empty body yields nothing.
+    :param response: response of a request made with stream=True, whose body may already have been read
+    :param chunk_size: number of bytes read from the response at a time
+    :param endpoint: endpoint to record body size and decode time for in the sync metrics
+    :return: generator of array elements
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder(response.encoding or "utf-8")()
+    chunks = response.iter_content(chunk_size=chunk_size)
+    buffer = ""
+    pos = 0
+    exhausted = False
+    started = False
+    body_bytes = 0
+    decode_seconds = 0.0
+
+    def read_more():
+        nonlocal buffer, pos, exhausted, body_bytes
+        chunk = next(chunks, None)
+        if chunk is None:
+            exhausted = True
+            buffer = buffer[pos:] + text_decoder.decode(b"", final=True)
+        else:
+            body_bytes += len(chunk)
+            buffer = buffer[pos:] + text_decoder.decode(chunk)
+        pos = 0
+
+    try:
+        while True:
+            # skip whitespace and separators until the next token, reading more of the body if needed
+            while True:
+                while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+                    pos += 1
+                if pos < len(buffer) or exhausted:
+                    break
+                read_more()
+
+            if pos >= len(buffer):
+                if started:
+                    raise ValueError("Unexpected end of JSON array in response")
+                return
+
+            if not started:
+                if buffer[pos] != "[":
+                    raise ValueError(f"Expected a JSON array in response, found {buffer[pos:pos + 20]!r}")
+                started = True
+                pos += 1
+                continue
+
+            if buffer[pos] == "]":
+                return
+
+            decode_started = time.perf_counter()
+            try:
+                item, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                if exhausted:
+                    raise
+                read_more()  # element is not complete yet
+                continue
+            finally:
+                decode_seconds += time.perf_counter() - decode_started
+            if end == len(buffer) and not exhausted:
+                # a scalar may continue in the next chunk, only trust elements followed by a separator
+                read_more()
+                continue
+            pos = end
+            yield item
+    finally:
+        response.close()
+        if endpoint:
+            metrics.add_endpoint(endpoint, bytes=body_bytes, decode_seconds=decode_seconds)
+
+def stringify_lists(d, in_place=False):
     """
-    The stringify_lists function changes lists to strings
+    The stringify_lists function changes lists to strings, in the format set by the listFormat setting
     :param d: any dictionary
+    :param in_place: change d itself instead of building a new dictionary, for rows nothing else refers to
     :return: the dictionary with lists represented as strings
     """
+    to_string = list_to_string
+    if in_place:
+        for key, value in d.items():
+            if isinstance(value, list):
+                d[key] = to_string(value)  # replacing values does not resize d, so this is safe while iterating
+        return d
+
     new_dict = {}
     for key, value in d.items():
         if isinstance(value, list):
-            new_dict[key] = str(value)
+            new_dict[key] = to_string(value)
         else:
             new_dict[key] = value
     return new_dict
 
+# converts a list value to the string written to the destination, str() or json_list depending on listFormat.
+# Set in update()
+list_to_string = str
+
+# connector_multiprocessing.py and examples/toast_example/connector.py deploy on their own and carry copies of
+# json_list_cache, encode_json and json_list. This is the canonical version, keep the code of the copies identical.
+# compact JSON of short lists of strings, e.g. tags and feature flags repeated on every row
+json_list_cache = {}
+json_list_cache_size = 4096
+json_list_cache_length = 8
+json_encoder = json.JSONEncoder(separators=(",", ":"), ensure_ascii=False)
+
+def encode_json(value):
+    """
+    Encodes a value as compact JSON, with orjson if it is installed
+    :param value: any JSON value
+    :return: JSON string
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(value).decode()
+        except TypeError:
+            pass  # e.g. integers over 64 bits, which the json module handles
+    return json_encoder.encode(value)
+
+def json_list(value):
+    """
+    Converts a list to compact JSON, the listFormat=json replacement for str()
+    Short lists of strings are cached, since the same few values repeat across rows
+    :param value: list
+    :return: JSON string
+    """
+    if not value:
+        return "[]"
+    if len(value) <= json_list_cache_length:
+        key = tuple(value)
+        # only strings, so that e.g. [1] and [True], which are equal as keys, are not confused
+        if all(type(item) is str for item in key):
+            encoded = json_list_cache.get(key)
+            if encoded is None:
+                if len(json_list_cache) >= json_list_cache_size:
+                    json_list_cache.clear()
+                encoded = json_list_cache[key] = encode_json(value)
+            return encoded
+    return encode_json(value)
+
 def flatten_dict (parent_row: dict, dict_field: dict, prefix: str):
     """
     Flattens a field containing a dictionary into a series of fields prefixed with the original field name
@@ -735,22 +2804,12 @@ def flatten_dict (parent_row: dict, dict_field: dict, prefix: str):
     :param prefix: the prefix to add to the name of keys in dict_field to make new keys in parent_row
     :return: parent_row with dict_field flattened into multiple fields
     """
-    # dicts in these fields have unique enough names that they do not need the field prefix
-    fields_to_not_prefix = ["refundDetails", "jobReference"]
-
     if not dict_field:  # Quick exit for empty dictionaries
         return parent_row
 
     dict_field = replace_guid_with_id(dict_field)
     for key, value in dict_field.items():
-        if key.startswith(prefix):
-            new_key = key  # Keep it unchanged
-        elif key == "tipRefundAmount" and prefix == "refund":
-            new_key = "refund_tip_amount"
-        elif prefix in fields_to_not_prefix:
-            new_key = key  # Keep it unchanged for exempted fields
-        else:
-            new_key = f"{prefix}_{key}"  # Build the new flattened key
+        new_key = flat_key(prefix, key)  # interned, so each (prefix, key) name is only built once
 
         if isinstance(value, dict):  # If the value is another dictionary, recurse
             flatten_dict(parent_row, value, new_key)
@@ -764,14 +2823,16 @@ def replace_guid_with_id(d: dict):
         d["id"] = d.pop("guid")
     return d
 
-def flatten_fields(fields: list, row: dict):
+def flatten_fields(fields: list, row: dict, in_place=False):
     """
     Takes in a list of fields to flatten within a row, calls flatten_dict() if any of those fields are present
     :param fields: a list of strings which could be keys in "row"
     :param row: a dictionary "row" that could have values that are dictionaries
+    :param in_place: change row itself instead of a copy, for rows nothing else refers to
     :return: dictionary with dictionary values flattened, if their keys are in "fields". The original keys are removed.
     """
-    row = {**row}  # Ensures row modifications don't affect the original dictionary
+    if not in_place:
+        row = {**row}  # Ensures row modifications don't affect the original dictionary
     row = replace_guid_with_id(row)
     for field in fields:
         value = row.get(field)  # Avoids multiple dictionary lookups
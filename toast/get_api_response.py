@@ -5,7 +5,7 @@ from connector import get_api_response  # Replace 'your_module' with the actual
 
 class TestGetApiResponse(unittest.TestCase):
 
-    @patch("requests.get")
+    @patch("requests.Session.get")
     def test_successful_response(self, mock_get):
         """Test successful API response"""
         mock_response = MagicMock()
@@ -19,7 +19,7 @@ class TestGetApiResponse(unittest.TestCase):
         self.assertEqual(response, {"data": "test"})
         self.assertEqual(next_token, "next_token")
 
-    @patch("requests.get")
+    @patch("requests.Session.get")
     def test_401_retry_then_fail(self, mock_get):
         """Test 401 Unauthorized - retry up to max retries, then fail"""
         mock_response = MagicMock()
@@ -32,7 +32,7 @@ class TestGetApiResponse(unittest.TestCase):
         self.assertIsNone(next_token)
         self.assertEqual(mock_get.call_count, 4)  # Expect 4 calls (1 initial + 3 retries)
 
-    @patch("requests.get")
+    @patch("requests.Session.get")
     def test_403_forbidden(self, mock_get):
         """Test 403 Forbidden - should raise PermissionError"""
         mock_response = MagicMock()
@@ -42,7 +42,7 @@ class TestGetApiResponse(unittest.TestCase):
         with self.assertRaises(PermissionError):
             get_api_response("http://example.com/api", headers={})
 
-    @patch("requests.get")
+    @patch("requests.Session.get")
     def test_429_too_many_requests(self, mock_get):
         """Test 429 Too Many Requests - should retry after wait time"""
         mock_response_429 = MagicMock()
@@ -63,7 +63,7 @@ class TestGetApiResponse(unittest.TestCase):
         self.assertIsNone(next_token)
         self.assertEqual(mock_get.call_count, 2)  # Should retry once
 
-    @patch("requests.get")
+    @patch("requests.Session.get")
     def test_409_conflict(self, mock_get):
         """Test 409 Conflict - should retry without pageToken"""
         mock_response_409 = MagicMock()
@@ -82,7 +82,7 @@ class TestGetApiResponse(unittest.TestCase):
         self.assertIsNone(next_token)
         self.assertEqual(mock_get.call_count, 2)  # Should retry once
 
-    @patch("requests.get")
+    @patch("requests.Session.get")
     def test_400_bad_request(self, mock_get):
         """Test 400 Bad Request - should log and return None"""
         mock_response = MagicMock()
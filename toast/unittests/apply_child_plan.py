@@ -0,0 +1,110 @@
+import unittest
+import copy
+from unittest.mock import patch
+
+from connector import process_child, flatten_fields, stringify_lists, replace_guid_with_id
+from connector import child_relationships, child_fields_to_flatten
+
+def legacy_process_child(parent, table_name, id_field_name, id_field, relationships, fields_to_flatten):
+    """Copy of process_child before the tables were compiled into plans, for comparison."""
+    for p in parent:
+        p[id_field_name] = id_field
+        if table_name in relationships:
+            for child_key, child_table_name in relationships[table_name]:
+                if len(p.get(child_key, [])) > 0:
+                    yield from legacy_process_child(p[child_key], child_table_name, table_name + "_id", p["guid"],
+                                                    relationships, fields_to_flatten)
+                p.pop(child_key, None)
+        if table_name in fields_to_flatten:
+            p = flatten_fields(fields_to_flatten[table_name], p)
+        if table_name == "orders_check":
+            p.pop("payments", None)
+        p = stringify_lists(p)
+        p = replace_guid_with_id(p)
+        yield {"table": table_name, "data": p}
+
+class MockOp:
+    """Mocked operations that return what would be sent to the destination."""
+    @staticmethod
+    def upsert(table, data):
+        return {"table": table, "data": data}
+
+    @staticmethod
+    def delete(table, keys):
+        return {"table": table, "delete": keys}
+
+CHECKS = [{
+    "guid": "check-1",
+    "entityType": "Check",
+    "deleted": False,
+    "customer": {"guid": "customer-1", "firstName": "Pat", "phones": ["555", "556"]},
+    "createdDevice": {"id": "device-1"},
+    "lastModifiedDevice": None,
+    "payments": [{"guid": "payment-1"}],
+    "appliedDiscounts": [],
+    "selections": [{
+        "guid": "selection-1",
+        "item": {"guid": "item-1", "entityType": "MenuItem", "multiLocationId": "100"},
+        "itemGroup": {"guid": "group-1", "entityType": "MenuGroup"},
+        "salesCategory": None,
+        "refundDetails": {"refundAmount": 1.5, "refundTransaction": {"guid": "refund-1"}},
+        "voidReason": {},
+        "tags": ["a", "b"],
+        "appliedTaxes": [{"guid": "tax-1", "taxRate": {"guid": "rate-1", "entityType": "TaxRate"}, "rate": 0.07}],
+        "modifiers": [{"guid": "modifier-1", "item": {"guid": "item-2"}, "modifiers": [],
+                       "preModifier": {"guid": "pre-1", "name": "Extra"}}],
+        "appliedDiscounts": [{"guid": "discount-1", "discount": {"guid": "d-1"},
+                              "appliedDiscountReason": {"name": "comp", "discountReason": {"guid": "reason-1"}},
+                              "triggers": [{"selection": {"guid": "selection-1"}, "quantity": 1.0}],
+                              "comboItems": []}],
+    }],
+    "appliedServiceCharges": [{"guid": "charge-1", "serviceCharge": {"guid": "sc-1", "entityType": "ServiceCharge"},
+                               "appliedTax": [{"guid": "charge-tax-1", "rate": 0.07}]}],
+}]
+
+@patch("connector.op", MockOp)
+class TestApplyChildPlan(unittest.TestCase):
+
+    def test_matches_legacy_transform(self):
+        """Compiled plans produce the same rows as the generic flatten/stringify passes."""
+        expected = list(legacy_process_child(copy.deepcopy(CHECKS), "orders_check", "orders_id", "order-1",
+                                             child_relationships, child_fields_to_flatten))
+        results = list(process_child(copy.deepcopy(CHECKS), "orders_check", "orders_id", "order-1"))
+        self.assertEqual(results, expected)
+
+    def test_flattened_fields(self):
+        """Nested dictionaries are flattened with prefixes and their guids renamed to id."""
+        results = {r["table"]: r["data"] for r in process_child(copy.deepcopy(CHECKS), "orders_check", "orders_id", "order-1")}
+        selection = results["orders_check_selection"]
+        self.assertEqual(selection["item_id"], "item-1")
+        self.assertEqual(selection["item_multiLocationId"], "100")
+        self.assertEqual(selection["refundAmount"], 1.5)
+        self.assertEqual(selection["refundTransaction_id"], "refund-1")
+        self.assertEqual(selection["tags"], "['a', 'b']")
+        self.assertNotIn("voidReason", selection)
+        self.assertNotIn("modifiers", selection)
+        self.assertEqual(results["orders_check"]["customer_phones"], "['555', '556']")
+        self.assertNotIn("payments", results["orders_check"])
+
+    def test_job_reference_not_prefixed(self):
+        """jobReference keys are flattened without a prefix, as in flatten_dict."""
+        overrides = [{"guid": "override-1", "wage": 15.0, "jobReference": {"guid": "job-1", "externalId": "j"}}]
+        results = list(process_child(overrides, "employee_wage_override", "employee_id", "employee-1"))
+        self.assertEqual(results[0]["data"], {"wage": 15.0, "employee_id": "employee-1", "id": "job-1", "externalId": "j"})
+
+    def test_null_tax_guid_generated(self):
+        """Applied taxes without a guid get a generated id, others keep theirs."""
+        taxes = [{"guid": None, "rate": 0.07}, {"guid": "tax-2", "rate": 0.01}]
+        results = list(process_child(taxes, "orders_check_selection_applied_tax", "orders_check_selection_id", "s-1"))
+        self.assertTrue(results[0]["data"]["id"].startswith("gen-"))
+        self.assertEqual(results[1]["data"]["id"], "tax-2")
+
+    def test_input_not_modified(self):
+        """Child lists stay on the source records."""
+        checks = copy.deepcopy(CHECKS)
+        list(process_child(checks, "orders_check", "orders_id", "order-1"))
+        self.assertIn("selections", checks[0])
+        self.assertIn("payments", checks[0])
+
+if __name__ == '__main__':
+    unittest.main()
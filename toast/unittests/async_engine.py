@@ -0,0 +1,109 @@
+import unittest
+import json
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+from unittest.mock import patch
+
+import connector
+from connector import restaurant_tasks, run_tasks, read_settings
+
+class MockOp:
+    """Mocked operations that record what would be sent to the destination."""
+    @staticmethod
+    def upsert(table, data):
+        return ("upsert", table, data)
+
+    @staticmethod
+    def delete(table, keys):
+        return ("delete", table, keys)
+
+def make_order(i):
+    return {"guid": f"order-{i}", "deleted": i % 50 == 0, "server": {"guid": "s", "entityType": "x"},
+            "checks": [{"guid": f"check-{i}", "payments": [{"guid": f"payment-{i}", "amount": 1.5}]}]}
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Serves small fixed responses for every endpoint used by restaurant_tasks."""
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    failing_path = None
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        headers = {}
+        if url.path == self.failing_path:
+            return self.reply(500, {"message": "boom"})
+        if url.path == "/orders/v2/ordersBulk":
+            page = int(query["page"][0])
+            body = [make_order(i) for i in range((page - 1) * 100, min(page * 100, 130))]
+        elif url.path.startswith("/config/"):
+            token = query.get("pageToken", [None])[0]
+            body = [{"guid": f"{url.path}-{token}", "menu": {"guid": "m"}, "tags": [1, 2]}]
+            if token is None:
+                headers["Toast-Next-Page-Token"] = "2"
+        elif url.path.startswith("/labor/"):
+            body = [{"guid": f"{url.path}-1", "breaks": [{"guid": "b"}], "jobReferences": [{"guid": "j"}]}]
+        else:
+            body = [{"guid": f"{url.path}-{query['businessDate'][0]}"}]
+        self.reply(200, body, headers)
+
+    def reply(self, status, body, headers=None):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+@patch("connector.op", MockOp)
+class TestAsyncEngine(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.base_url = f"http://127.0.0.1:{cls.server.server_port}"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+
+    def setUp(self):
+        StubHandler.failing_path = None
+        connector.configure_session({})
+        connector.rate_limiter.configure(10000)
+
+    def run_engine(self, configuration):
+        settings = read_settings(configuration)
+        restaurants = [{"restaurantGuid": f"r{i}", "restaurantName": f"R{i}"} for i in range(3)]
+        timerange = {"startDate": "2024-01-01T00:00:00.000Z", "endDate": "2024-01-03T00:00:00.000Z"}
+        tasks = []
+        for index, r in enumerate(restaurants):
+            tasks.extend(restaurant_tasks(self.base_url, {}, r, index, len(restaurants), True,
+                                          {"lastModified": timerange["startDate"]}, timerange,
+                                          {"modifiedStartDate": timerange["startDate"],
+                                           "modifiedEndDate": timerange["endDate"]},
+                                          settings, cache=None))
+        return list(run_tasks(tasks, settings))
+
+    def test_matches_thread_engine(self):
+        """The async engine emits the same operations in the same order as a serial sync."""
+        expected = self.run_engine({})
+        self.assertGreater(len(expected), 1000)
+        self.assertEqual(self.run_engine({"engine": "async", "maxConcurrency": "50"}), expected)
+        self.assertEqual(self.run_engine({"engine": "async", "maxConcurrency": "2", "prefetchPages": "3"}), expected)
+
+    def test_error_is_raised(self):
+        """An endpoint failing on the event loop fails the sync in the calling thread."""
+        StubHandler.failing_path = "/labor/v1/shifts"
+        with self.assertRaises(RuntimeError):
+            self.run_engine({"engine": "async"})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+import unittest
+from unittest.mock import patch
+
+from connector import batch_by_table, PendingRow
+
+class MockOp:
+    """Mocked operations that record what would be sent to the destination."""
+    @staticmethod
+    def upsert(table, data):
+        return ("upsert", table, data["id"])
+
+    @staticmethod
+    def delete(table, keys):
+        return ("delete", table, keys["id"])
+
+def order_tree_rows(orders):
+    """Rows interleaved the way process_orders yields them, ending with a checkpoint."""
+    for i in range(orders):
+        yield PendingRow("upsert", "orders_check", {"id": f"check-{i}"})
+        yield PendingRow("upsert", "payment", {"id": f"payment-{i}"})
+        yield PendingRow("upsert", "orders", {"id": f"order-{i}"})
+        if i % 3 == 0:
+            yield PendingRow("delete", "orders", {"id": f"order-{i}"})
+    yield "checkpoint"
+
+def runs(operations):
+    """Number of contiguous runs of rows for the same table."""
+    tables = [o[1] for o in operations if o != "checkpoint"]
+    return sum(1 for i, table in enumerate(tables) if i == 0 or tables[i - 1] != table)
+
+@patch("connector.op", MockOp)
+class TestBatchByTable(unittest.TestCase):
+
+    def test_groups_tables_and_keeps_row_order(self):
+        """Rows come out as one run per table, in their original order within the table."""
+        operations = list(batch_by_table(order_tree_rows(20), 1000, 10 ** 6))
+        self.assertEqual(runs(operations), 3)
+        self.assertEqual(operations[-1], "checkpoint")
+        orders = [o for o in operations if o[1] == "orders"]
+        self.assertEqual(orders[:3], [("upsert", "orders", "order-0"), ("delete", "orders", "order-0"),
+                                      ("upsert", "orders", "order-1")])
+        self.assertEqual(len(operations), 20 * 3 + 7 + 1)
+
+    def test_flushes_before_checkpoint(self):
+        """Every row buffered before a checkpoint is sent before it."""
+        def stream():
+            yield from order_tree_rows(5)
+            yield from order_tree_rows(5)
+        operations = list(batch_by_table(stream(), 1000, 10 ** 6))
+        first_checkpoint = operations.index("checkpoint")
+        self.assertEqual(first_checkpoint, 5 * 3 + 2)
+        self.assertEqual(operations[-1], "checkpoint")
+
+    def test_memory_stays_bounded(self):
+        """No more than max_rows rows are held back at any point."""
+        consumed = 0
+        def counted():
+            nonlocal consumed
+            for item in order_tree_rows(500):
+                consumed += 1
+                yield item
+        sent = 0
+        for operation in batch_by_table(counted(), 50, 10 ** 6):
+            if operation != "checkpoint":
+                sent += 1
+            self.assertLessEqual(consumed - sent, 51)
+
+    def test_byte_budget(self):
+        """A byte budget smaller than the row budget also triggers flushes."""
+        rows = [PendingRow("upsert", "menu", {"id": str(i), "name": "x" * 1000}) for i in range(10)]
+        gen = batch_by_table(iter(rows), 1000, 2500)
+        self.assertEqual(next(gen), ("upsert", "menu", "0"))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+import unittest
+from unittest.mock import patch
+
+from connector import process_config, process_labor
+
+class MockOp:
+    """Mocked operations that return what would be sent to the destination."""
+    @staticmethod
+    def upsert(table, data):
+        return {"table": table, "data": data}
+
+    @staticmethod
+    def delete(table, keys):
+        return {"table": table, "delete": keys}
+
+MENUS = [{"guid": "menu-1", "name": "Lunch"}, {"guid": "menu-2", "name": "Dinner"}]
+
+@patch("connector.op", MockOp)
+class TestConfigCache(unittest.TestCase):
+
+    @patch("connector.get_api_response", return_value=(MENUS, None))
+    def test_unchanged_page_skipped(self, mock_response):
+        """The same page on the next sync is fetched but not upserted again."""
+        cache = {}
+        first = list(process_config("https://toast", {}, "/config/v2/menus", "menu", "r-1",
+                                    {"lastModified": "2024-01-01T00:00:00.000Z"}, cache=cache))
+        second = list(process_config("https://toast", {}, "/config/v2/menus", "menu", "r-1",
+                                     {"lastModified": "2024-01-01T00:00:00.000Z"}, cache=cache))
+        self.assertEqual(len(first), 2)
+        self.assertEqual(second, [])
+        self.assertEqual(mock_response.call_count, 2)
+
+    @patch("connector.get_api_response")
+    def test_changed_page_upserted(self, mock_response):
+        """A page with different content is upserted."""
+        cache = {}
+        mock_response.return_value = (MENUS, None)
+        list(process_config("https://toast", {}, "/config/v2/menus", "menu", "r-1",
+                            {"lastModified": "2024-01-01T00:00:00.000Z"}, cache=cache))
+        mock_response.return_value = ([{"guid": "menu-1", "name": "Brunch"}], None)
+        results = list(process_config("https://toast", {}, "/config/v2/menus", "menu", "r-1",
+                                      {"lastModified": "2024-01-01T00:00:00.000Z"}, cache=cache))
+        self.assertEqual(results[0]["data"]["name"], "Brunch")
+
+    @patch("connector.get_api_response", return_value=([], None))
+    def test_high_water_mark(self, mock_response):
+        """lastModified starts from the endpoint's last fetch when that is later than the timerange."""
+        cache = {"r-1/config/v2/menus": {"last_modified": "2024-05-01T00:00:00.000Z", "pages": []}}
+        list(process_config("https://toast", {}, "/config/v2/menus", "menu", "r-1",
+                            {"lastModified": "2024-01-01T00:00:00Z"}, cache=cache))
+        self.assertIn("lastModified=2024-05-01T00:00:00.000Z", mock_response.call_args[0][0])
+        self.assertGreater(cache["r-1/config/v2/menus"]["last_modified"], "2024-05-01")
+
+    @patch("connector.get_api_response", return_value=(MENUS, None))
+    def test_without_cache(self, mock_response):
+        """Without a cache every page is upserted."""
+        for _ in range(2):
+            self.assertEqual(len(list(process_config("https://toast", {}, "/config/v2/menus", "menu", "r-1",
+                                                     {"lastModified": "2024-01-01T00:00:00.000Z"}))), 2)
+
+    @patch("connector.get_api_response", return_value=([{"guid": "job-1", "title": "Server"}], None))
+    def test_labor_unchanged_skipped(self, mock_response):
+        """Jobs and employees are skipped when the response is unchanged."""
+        cache = {}
+        first = list(process_labor("https://toast", {}, "/labor/v1/jobs", "job", "r-1", cache=cache))
+        second = list(process_labor("https://toast", {}, "/labor/v1/jobs", "job", "r-1", cache=cache))
+        self.assertEqual(len(first), 1)
+        self.assertEqual(second, [])
+
+if __name__ == '__main__':
+    unittest.main()
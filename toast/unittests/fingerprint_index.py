@@ -0,0 +1,98 @@
+import unittest
+import os
+import tempfile
+from unittest.mock import patch
+
+import connector
+from connector import upsert, open_fingerprint_index, commit_fingerprint_index, close_fingerprint_index
+
+class MockOp:
+    """Mocked operations that return what would be sent to the destination."""
+    @staticmethod
+    def upsert(table, data):
+        return {"table": table, "data": data}
+
+    @staticmethod
+    def checkpoint(state):
+        return {"checkpoint": dict(state)}
+
+TABLES = [{"table": "payment", "primary_key": ["id"]},
+          {"table": "orders_check_payment", "primary_key": ["orders_check_id", "payment_id", "orders_guid"]},
+          {"table": "no_key"}]
+
+ROWS = [("payment", {"id": "p-1", "amount": 10.0}),
+        ("payment", {"id": "p-2", "amount": 5.0}),
+        ("orders_check_payment", {"orders_check_id": "c-1", "payment_id": "p-1", "orders_guid": "o-1"}),
+        ("no_key", {"value": 1})]
+
+@patch("connector.op", MockOp)
+class TestFingerprintIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "fingerprints.sqlite")
+
+    def tearDown(self):
+        close_fingerprint_index()
+        self.directory.cleanup()
+
+    def run_sync(self, state, rows):
+        open_fingerprint_index(self.path, TABLES, state)
+        results = [r for table, data in rows for r in upsert(table, data)]
+        results += list(commit_fingerprint_index(state))
+        suppressed = dict(connector.fingerprint_index.suppressed)
+        close_fingerprint_index()
+        return [r for r in results if "table" in r], suppressed
+
+    def test_unchanged_rows_suppressed(self):
+        """Rows delivered by the previous sync are not upserted again."""
+        state = {}
+        first, _ = self.run_sync(state, ROWS)
+        second, suppressed = self.run_sync(state, ROWS)
+        self.assertEqual(len(first), 4)
+        self.assertEqual(second, [{"table": "no_key", "data": {"value": 1}}])
+        self.assertEqual(suppressed, {"payment": 2, "orders_check_payment": 1})
+
+    def test_changed_row_upserted(self):
+        """A row whose content changed is upserted."""
+        state = {}
+        self.run_sync(state, ROWS)
+        changed = [("payment", {"id": "p-1", "amount": 12.0}), ("payment", {"id": "p-2", "amount": 5.0})]
+        results, suppressed = self.run_sync(state, changed)
+        self.assertEqual(results, [{"table": "payment", "data": {"id": "p-1", "amount": 12.0}}])
+
+    def test_cleared_state_discards_index(self):
+        """After a re-sync clears the state, every row is upserted again."""
+        self.run_sync({}, ROWS)
+        results, suppressed = self.run_sync({}, ROWS)
+        self.assertEqual(len(results), 4)
+
+    def test_uncommitted_sync_not_recorded(self):
+        """Rows from a sync that failed before its checkpoint are upserted again next time."""
+        state = {}
+        self.run_sync(state, [])
+        open_fingerprint_index(self.path, TABLES, state)
+        list(upsert("payment", {"id": "p-1", "amount": 10.0}))
+        close_fingerprint_index()
+        results, suppressed = self.run_sync(state, ROWS[:1])
+        self.assertEqual(len(results), 1)
+
+    def test_pending_rows_checked_when_sent(self):
+        """PendingRows are checked against the index by send_rows and batch_by_table, not when they are made."""
+        state = {}
+        self.run_sync(state, ROWS)
+        for send in [connector.send_rows, lambda rows: connector.batch_by_table(rows, 2, 1 << 20)]:
+            open_fingerprint_index(self.path, TABLES, state)
+            with patch("connector.pending_rows", True):
+                rows = [r for table, data in ROWS for r in upsert(table, data)]
+            self.assertEqual(len(rows), 4)
+            self.assertEqual(connector.fingerprint_index.suppressed, {})
+            self.assertEqual(list(send(iter(rows))), [{"table": "no_key", "data": {"value": 1}}])
+            close_fingerprint_index()
+
+    def test_disabled(self):
+        """Without an index every row is upserted."""
+        self.assertEqual(list(upsert("payment", {"id": "p-1"})), [{"table": "payment", "data": {"id": "p-1"}}])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,37 @@
+import unittest
+import copy
+
+from connector import flatten_fields, stringify_lists
+
+PAYMENT = {"guid": "p1", "amount": 12.5, "tags": ["a", None],
+           "refund": {"refundAmount": 1.0, "tipRefundAmount": 0.5},
+           "server": {"guid": "s1", "entityType": "RestaurantUser", "nested": {"guid": "n1", "codes": [1, 2]}},
+           "cashDrawer": None, "otherPayment": {}}
+FIELDS = ["cashDrawer", "otherPayment", "refund", "server"]
+
+class TestInPlaceTransforms(unittest.TestCase):
+
+    def test_flatten_fields_in_place_matches_copy(self):
+        """In place gives the same row as the copying mode, and returns the row it was given."""
+        expected = flatten_fields(FIELDS, copy.deepcopy(PAYMENT))
+        row = copy.deepcopy(PAYMENT)
+        result = flatten_fields(FIELDS, row, in_place=True)
+        self.assertIs(result, row)
+        self.assertEqual(result, expected)
+        self.assertEqual(result["refund_tip_amount"], 0.5)
+        self.assertEqual(result["server_nested_id"], "n1")
+
+    def test_flatten_fields_copy_leaves_row(self):
+        """The default mode does not add or remove keys of the row it was given."""
+        row = copy.deepcopy(PAYMENT)
+        flatten_fields(FIELDS, row)
+        self.assertEqual(set(row), set(PAYMENT))
+
+    def test_stringify_lists_in_place(self):
+        row = {"a": [1, 2], "b": "x", "c": None}
+        result = stringify_lists(row, in_place=True)
+        self.assertIs(result, row)
+        self.assertEqual(result, stringify_lists({"a": [1, 2], "b": "x", "c": None}))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+import unittest
+import json
+from unittest.mock import MagicMock
+
+from connector import iter_json_array
+
+def make_response(body: bytes, chunk_size: int):
+    """Mocked streamed response that returns body in chunks of chunk_size bytes."""
+    response = MagicMock()
+    response.encoding = "utf-8"
+    response.iter_content.return_value = (body[i:i + chunk_size] for i in range(0, len(body), chunk_size))
+    return response
+
+ORDERS = [{"guid": f"order-{i}", "name": "Crème brûlée ☕", "checks": [{"guid": "c", "amount": 12.5, "tags": [1, 2, None]}]}
+          for i in range(25)]
+
+class TestIterJsonArray(unittest.TestCase):
+
+    def test_matches_json_loads(self):
+        """Elements come out the same as json.loads for every chunk size."""
+        body = json.dumps(ORDERS, ensure_ascii=False).encode("utf-8")
+        for chunk_size in (1, 3, 7, 64, 4096):
+            response = make_response(body, chunk_size)
+            self.assertEqual(list(iter_json_array(response)), ORDERS)
+            response.close.assert_called()
+
+    def test_whitespace_and_scalars(self):
+        """Pretty-printed arrays and numbers split across chunks parse correctly."""
+        body = b' [\n  12345 ,\n  "abc",\n  true,  null, 1.5e3\n]\n'
+        self.assertEqual(list(iter_json_array(make_response(body, 2))), [12345, "abc", True, None, 1500.0])
+
+    def test_empty(self):
+        """Empty arrays and empty bodies yield nothing."""
+        self.assertEqual(list(iter_json_array(make_response(b"[]", 1))), [])
+        self.assertEqual(list(iter_json_array(make_response(b"", 1))), [])
+
+    def test_yields_before_body_is_read(self):
+        """The first element is available before the rest of the body has been read."""
+        body = json.dumps(ORDERS).encode("utf-8")
+        chunks_read = []
+
+        def chunks(chunk_size):
+            for i in range(0, len(body), chunk_size):
+                chunks_read.append(i)
+                yield body[i:i + chunk_size]
+
+        response = MagicMock()
+        response.encoding = None
+        response.iter_content.side_effect = chunks
+        first = next(iter_json_array(response, chunk_size=256))
+        self.assertEqual(first, ORDERS[0])
+        self.assertLess(len(chunks_read) * 256, len(body))
+
+    def test_truncated_body(self):
+        """A body cut off in the middle of an element raises an error."""
+        body = json.dumps(ORDERS).encode("utf-8")[:-40]
+        with self.assertRaises(ValueError):
+            list(iter_json_array(make_response(body, 50)))
+
+    def test_not_an_array(self):
+        """A JSON object instead of an array raises an error."""
+        with self.assertRaises(ValueError):
+            list(iter_json_array(make_response(b'{"message": "error"}', 5)))
+
+if __name__ == '__main__':
+    unittest.main()
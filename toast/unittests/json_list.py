@@ -0,0 +1,53 @@
+import unittest
+import json
+from unittest.mock import patch
+
+import connector
+from connector import json_list, stringify_lists, apply_child_plan, compile_child_plan
+
+ROW = {"guid": "o1", "tags": ["a", None, "é"], "amounts": [1, 2.5, True], "nested": [{"guid": "x", "codes": []}],
+       "empty": [], "name": "order"}
+
+class TestJsonList(unittest.TestCase):
+
+    def setUp(self):
+        connector.json_list_cache.clear()
+
+    def test_default_is_str(self):
+        """Without listFormat=json, lists are written as before."""
+        self.assertEqual(stringify_lists(ROW)["tags"], "['a', None, 'é']")
+
+    def test_valid_compact_json(self):
+        with patch("connector.list_to_string", json_list):
+            row = stringify_lists(ROW)
+        self.assertEqual(row["tags"], '["a",null,"é"]')
+        self.assertEqual(row["empty"], "[]")
+        self.assertEqual(row["name"], "order")
+        for key in ["tags", "amounts", "nested"]:
+            self.assertEqual(json.loads(row[key]), ROW[key])
+
+    def test_cache_keeps_types_apart(self):
+        """Lists that are equal as dictionary keys but encode differently are not confused."""
+        self.assertEqual(json_list([1]), "[1]")
+        self.assertEqual(json_list([True]), "[true]")
+        self.assertEqual(json_list(["1"]), '["1"]')
+        self.assertEqual(json_list(["1"]), '["1"]')
+        self.assertEqual(list(connector.json_list_cache), [("1",)])
+
+    def test_without_orjson(self):
+        """The json module fallback gives the same strings, including for integers orjson cannot encode."""
+        values = [ROW["tags"], ROW["amounts"], ROW["nested"], [2 ** 70, {"a": 1}]]
+        expected = [json_list(value) for value in values]
+        connector.json_list_cache.clear()
+        with patch("connector.orjson", None):
+            self.assertEqual([json_list(value) for value in values], expected)
+        self.assertEqual(json.loads(expected[-1]), [2 ** 70, {"a": 1}])
+
+    def test_child_rows(self):
+        """Child rows built by apply_child_plan use the same format."""
+        with patch("connector.list_to_string", json_list):
+            row = apply_child_plan(compile_child_plan("selection"), {"guid": "s1", "tags": ["x"]})
+        self.assertEqual(row["tags"], '["x"]')
+
+if __name__ == '__main__':
+    unittest.main()
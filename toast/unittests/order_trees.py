@@ -0,0 +1,41 @@
+import unittest
+from collections import Counter
+from unittest.mock import patch
+
+import connector
+from benchmarks.order_trees import OrderShape, generate_orders, rows_per_order
+
+class MockOp:
+    """Mocked operations that record which table each row goes to."""
+    @staticmethod
+    def upsert(table, data):
+        return table
+
+    @staticmethod
+    def delete(table, keys):
+        return table
+
+@patch("connector.op", MockOp)
+class TestOrderTrees(unittest.TestCase):
+
+    def test_same_seed_same_orders(self):
+        """Orders depend only on the shape and the seed."""
+        shape = OrderShape(selections=10, modifier_depth=3)
+        self.assertEqual(generate_orders(5, shape, seed=7), generate_orders(5, shape, seed=7))
+        self.assertNotEqual(generate_orders(5, shape, seed=7), generate_orders(5, shape, seed=8))
+
+    def test_every_child_table_written(self):
+        """Generated orders reach every table process_child writes, with the expected number of rows."""
+        for shape in [OrderShape(), OrderShape(checks=1, selections=30, modifier_depth=4, discount_depth=3)]:
+            tables = Counter()
+            for order in generate_orders(3, shape, seed=1):
+                tables.update(connector.order_operations("orders", "restaurant", order))
+            expected_tables = {"orders", "payment", "orders_check_payment", "orders_pricing_feature"}
+            for parent, children in connector.child_relationships.items():
+                expected_tables.add(parent)
+                expected_tables.update(child_table for _, child_table in children)
+            self.assertEqual(set(tables), expected_tables)
+            self.assertEqual(sum(tables.values()), 3 * (rows_per_order(shape) + 1))
+
+if __name__ == '__main__':
+    unittest.main()
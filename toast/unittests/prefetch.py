@@ -0,0 +1,72 @@
+import unittest
+import time
+import threading
+
+from connector import prefetch, prefetch_numbered_pages
+
+class TestPrefetch(unittest.TestCase):
+
+    def test_pages_in_order(self):
+        """Pages come out in order with and without prefetching."""
+        def pages():
+            for i in range(10):
+                yield [i]
+        self.assertEqual(list(prefetch(pages, 0)), [[i] for i in range(10)])
+        self.assertEqual(list(prefetch(pages, 3)), [[i] for i in range(10)])
+
+    def test_fetches_while_consumer_works(self):
+        """The next page is fetched while the consumer is still processing the current one."""
+        fetched = []
+
+        def pages():
+            for i in range(3):
+                fetched.append(i)
+                yield [i]
+
+        gen = prefetch(pages, 1)
+        next(gen)
+        time.sleep(0.1)
+        self.assertGreaterEqual(len(fetched), 2)
+        gen.close()
+
+class TestPrefetchNumberedPages(unittest.TestCase):
+
+    def test_stops_at_short_page(self):
+        """Pages are yielded in order and the short page is the last one."""
+        sizes = {1: 3, 2: 3, 3: 3, 4: 1}
+        fetch_page = lambda page_num: [page_num] * sizes.get(page_num, 0)
+        pages = list(prefetch_numbered_pages(fetch_page, 3, 3))
+        self.assertEqual(pages, [[1, 1, 1], [2, 2, 2], [3, 3, 3], [4]])
+
+    def test_pages_fetched_concurrently(self):
+        """Up to depth pages are in flight at once."""
+        lock = threading.Lock()
+        active = []
+        peak = []
+
+        def fetch_page(page_num):
+            with lock:
+                active.append(page_num)
+                peak.append(len(active))
+            time.sleep(0.05)
+            with lock:
+                active.remove(page_num)
+            return [page_num] * 2 if page_num < 6 else []
+
+        pages = list(prefetch_numbered_pages(fetch_page, 4, 2))
+        self.assertEqual(pages[-1], [])
+        self.assertEqual(len(pages), 6)
+        self.assertEqual(max(peak), 4)
+
+    def test_error_raised(self):
+        """A failed page fetch raises in the consumer."""
+        def fetch_page(page_num):
+            if page_num == 2:
+                raise RuntimeError("page failed")
+            return [page_num]
+
+        with self.assertRaises(RuntimeError):
+            list(prefetch_numbered_pages(fetch_page, 2, 1))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+import unittest
+import time
+import threading
+from unittest.mock import patch
+
+from connector import RateLimiter
+
+class TestRateLimiter(unittest.TestCase):
+
+    def test_burst_does_not_wait(self):
+        """Requests within the bucket size go out without throttling."""
+        limiter = RateLimiter(requests_per_second=5)
+        for _ in range(5):
+            limiter.acquire()
+        self.assertEqual(limiter.stats()["throttled_requests"], 0)
+
+    def test_paces_after_burst(self):
+        """Once the bucket is empty requests are spaced at the refill rate."""
+        limiter = RateLimiter(requests_per_second=50)
+        start = time.monotonic()
+        for _ in range(60):
+            limiter.acquire()
+        elapsed = time.monotonic() - start
+        self.assertGreaterEqual(elapsed, 0.15)
+        self.assertGreater(limiter.stats()["throttled_requests"], 0)
+        self.assertGreater(limiter.stats()["throttled_seconds"], 0)
+
+    def test_remaining_quota_lowers_rate(self):
+        """Remaining quota is spread evenly over the time left until the reset."""
+        limiter = RateLimiter(requests_per_second=20)
+        limiter.update({"X-Toast-RateLimit-Remaining": "10", "X-Toast-RateLimit-Reset": str(int(time.time()) + 100)})
+        self.assertLess(limiter.stats()["current_rate"], 1)
+
+    def test_exhausted_quota_pauses_until_reset(self):
+        """A remaining count of zero holds requests until the reset time."""
+        limiter = RateLimiter(requests_per_second=20)
+        limiter.update({"X-Toast-RateLimit-Remaining": "0", "X-Toast-RateLimit-Reset": str(int(time.time()) + 30)})
+        with patch("time.sleep") as mock_sleep:
+            mock_sleep.side_effect = lambda seconds: setattr(limiter, "paused_until", 0.0)
+            limiter.acquire()
+        self.assertGreater(mock_sleep.call_args_list[0][0][0], 25)
+
+    def test_missing_headers_keep_rate(self):
+        """Responses without rate limit headers leave the limiter unchanged."""
+        limiter = RateLimiter(requests_per_second=20)
+        limiter.update({})
+        self.assertEqual(limiter.stats()["current_rate"], 20)
+
+    def test_pause_is_shared_between_threads(self):
+        """A pause after a 429 delays requests on every thread and is counted."""
+        limiter = RateLimiter(requests_per_second=100)
+        limiter.pause(0.2)
+        start = time.monotonic()
+        threads = [threading.Thread(target=limiter.acquire) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertGreaterEqual(time.monotonic() - start, 0.19)
+        self.assertEqual(limiter.stats()["rate_limited_responses"], 1)
+        self.assertEqual(limiter.stats()["throttled_requests"], 4)
+
+if __name__ == '__main__':
+    unittest.main()
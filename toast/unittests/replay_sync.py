@@ -0,0 +1,316 @@
+import unittest
+import os
+import copy
+import tempfile
+import threading
+from datetime import datetime, timezone, timedelta
+from unittest.mock import patch
+
+from cryptography.fernet import Fernet
+
+import connector
+from benchmarks.replay import ReplayServer, SyntheticToast, Faults
+
+class MockOp:
+    """Mocked operations that record what would be sent to the destination."""
+    @staticmethod
+    def upsert(table, data):
+        return ("upsert", table, data.get("id"))
+
+    @staticmethod
+    def delete(table, keys):
+        return ("delete", table, keys["id"])
+
+    @staticmethod
+    def checkpoint(state):
+        return ("checkpoint", copy.deepcopy(state))
+
+# synthetic guids include the requested range, so every sync in these tests starts from the same time
+initial_sync_start = (datetime.now(timezone.utc) - timedelta(days=2)).isoformat(timespec="milliseconds").replace("+00:00", "Z")
+
+class FailingToast(SyntheticToast):
+    """SyntheticToast that answers the (restaurant, path) pairs in fail with a 500, and records every request."""
+    def __init__(self, fail, **kwargs):
+        super().__init__(**kwargs)
+        self.fail = set(fail)
+        self.requests = []
+        self.business_dates = []  # (restaurant, businessDate) of ordersBulk requests
+
+    fail_query = None  # (restaurant, path?key=value) to fail, for requests told apart by a query parameter
+
+    def handle(self, method, path, query, headers, body):
+        restaurant = headers.get("Toast-Restaurant-External-ID", "")
+        self.requests.append((restaurant, path))
+        if path == "/orders/v2/ordersBulk" and "businessDate" in query:
+            self.business_dates.append((restaurant, query["businessDate"]))
+        if (restaurant, path) in self.fail or any((restaurant, f"{path}?{key}={value}") == self.fail_query
+                                                  for key, value in query.items()):
+            return 500, {}, b"{}"
+        return super().handle(method, path, query, headers, body)
+
+class ModifiedToast(FailingToast):
+    """FailingToast whose config endpoints return items only when lastModified is before modified_at, as Toast does."""
+    def __init__(self, modified_at, **kwargs):
+        super().__init__(set(), **kwargs)
+        self.modified_at = modified_at
+
+    def config(self, restaurant, path, query):
+        if query.get("lastModified", "") > self.modified_at:
+            return 200, {}, b"[]"
+        return super().config(restaurant, path, query)
+
+def configuration(domain, **settings):
+    return {"domain": domain, "key": Fernet.generate_key().decode(), "clientId": "replay", "clientSecret": "replay",
+            "userAccessType": "TOAST_MACHINE_CLIENT", "requestsPerSecond": "1000",
+            "initialSyncStart": initial_sync_start, **settings}
+
+def completed_units(completed, restaurant, days=None):
+    """Names of the units that a first-pass window records as completed for a restaurant."""
+    orders = [f"orders:{day}" for day in days] if days else ["orders"]
+    units = (["restaurant"] + [unit for unit, _ in connector.first_pass_units("", {}, "", {}, connector.read_settings({}))]
+             + ["cash_entry", "cash_deposit"] + orders + ["shift", "time_entry"])
+    return units[:completed.get(restaurant, 0)]
+
+@patch("connector.op", MockOp)
+class TestReplaySync(unittest.TestCase):
+
+    def sync(self, faults=None, **settings):
+        source = SyntheticToast(restaurants=2, orders_per_day=60, config_pages=3)
+        with ReplayServer(source, faults) as server:
+            return list(connector.update(configuration(server.base_url, **settings), {})), server.stats
+
+    def test_full_sync(self):
+        """A full update() against the replay server upserts every table and ends with a checkpoint."""
+        operations, stats = self.sync()
+        tables = {table for kind, table, *_ in operations if kind == "upsert"}
+        self.assertTrue({"restaurant", "orders", "orders_check", "payment", "menu", "employee", "shift",
+                         "cash_entry"} <= tables)
+        self.assertEqual(operations[-1][0], "checkpoint")
+        self.assertIn("to_ts", operations[-1][1])
+        self.assertGreater(stats["requests"], 50)
+
+    def test_faults_do_not_lose_rows(self):
+        """Injected 429 and 409 responses are retried, and the same rows reach the destination."""
+        expected, _ = self.sync()
+        operations, stats = self.sync(Faults(rate_limit_every=10, conflict_every=5), maxConcurrency="4")
+        self.assertGreater(stats["errors_injected"], 0)
+        self.assertEqual({o for o in operations if o[0] != "checkpoint"},
+                         {o for o in expected if o[0] != "checkpoint"})
+        # config pages already processed before an expired page token are not upserted again
+        menus = [o for o in operations if o[:2] == ("upsert", "menu")]
+        self.assertEqual(len(menus), len([o for o in expected if o[:2] == ("upsert", "menu")]))
+
+    def test_batching_same_rows(self):
+        """Batching by table changes the order of rows between checkpoints, but not which rows are written."""
+        expected, _ = self.sync()
+        operations, _ = self.sync(batchRows="500")
+        self.assertEqual(sorted(o for o in operations if o[0] != "checkpoint"),
+                         sorted(o for o in expected if o[0] != "checkpoint"))
+        self.assertEqual(operations[-1][0], "checkpoint")
+
+    def test_operations_made_by_consumer(self):
+        """Tasks on worker threads and the event loop hand rows over, the SDK operations and fingerprint checks
+        are made by the consumer."""
+        threads = set()
+        unchanged = connector.FingerprintIndex.unchanged
+
+        class ThreadOp(MockOp):
+            @staticmethod
+            def upsert(table, data):
+                threads.add(threading.current_thread())
+                return MockOp.upsert(table, data)
+
+        def record_thread(index, table, data):
+            threads.add(threading.current_thread())
+            return unchanged(index, table, data)
+
+        expected, _ = self.sync()
+        with patch("connector.op", ThreadOp), patch("connector.FingerprintIndex.unchanged", record_thread), \
+                tempfile.TemporaryDirectory() as directory:
+            for settings in [{"maxConcurrency": "4"}, {"engine": "async", "maxConcurrency": "4"}]:
+                path = os.path.join(directory, f"{settings.get('engine', 'threads')}.sqlite")
+                operations, _ = self.sync(fingerprintIndexPath=path, **settings)
+                self.assertEqual([o for o in operations if o[0] != "checkpoint"],
+                                 [o for o in expected if o[0] != "checkpoint"])
+        self.assertEqual(threads, {threading.current_thread()})
+
+    def test_backfill_fetches_config(self):
+        """A backfill fetches the config endpoints, jobs and employees once, from the start of the backfill."""
+        start = (datetime.now(timezone.utc) - timedelta(days=40)).isoformat(timespec="milliseconds").replace("+00:00", "Z")
+        source = FailingToast(set(), restaurants=2, orders_per_day=5, config_pages=3)
+        queries = []
+        handle = source.handle
+
+        def record_query(method, path, query, headers, body):
+            if path == "/config/v2/menus":
+                queries.append(query.get("lastModified"))
+            return handle(method, path, query, headers, body)
+
+        source.handle = record_query
+        with ReplayServer(source) as server:
+            config = configuration(server.base_url, initialSyncStart=start, backfillConcurrency="2")
+            operations = list(connector.update(config, {}))
+
+        checkpoints = [o[1] for o in operations if o[0] == "checkpoint"]
+        self.assertIn("first_pass", checkpoints[-2]["backfill"]["completed"])
+        self.assertEqual(queries, [start] * 2 * source.config_pages)
+        upserts = [o for o in operations if o[0] == "upsert"]
+        self.assertEqual(len([o for o in upserts if o[1] == "menu"]), 2 * 3 * source.config_items)
+        self.assertTrue({"job", "employee", "orders"} <= {o[1] for o in upserts})
+
+        # a resumed backfill that already completed the first pass does not fetch it again,
+        # config is then fetched from the end of the backfill by the sync that follows it
+        queries.clear()
+        state = {"backfill": dict(checkpoints[-2]["backfill"], completed=["first_pass"])}
+        with ReplayServer(source) as server:
+            list(connector.update(configuration(server.base_url, initialSyncStart=start), state))
+        self.assertNotIn(start, queries)
+
+    def test_config_cache_resume(self):
+        """
+        Cache entries are saved only with the checkpoint of their endpoint, so a sync interrupted in the middle of
+        a window still delivers every config row when it resumes.
+        """
+        modified_at = (datetime.now(timezone.utc) - timedelta(days=1)).isoformat(timespec="milliseconds").replace("+00:00", "Z")
+        config_tables = {"menu", "menu_group", "menu_item", "dining_option", "discounts", "tables", "job", "employee"}
+        endpoint_units = {task.args[2]: unit for unit, task in
+                          connector.first_pass_units("", {}, "", {}, connector.read_settings({}))}
+
+        def config_rows(operations):
+            return {o for o in operations if o[0] == "upsert" and o[1] in config_tables}
+
+        for engine in ["threads", "async"]:
+            with self.subTest(engine=engine):
+                self.resume_with_config_cache(modified_at, engine, config_rows, endpoint_units)
+
+    def resume_with_config_cache(self, modified_at, engine, config_rows, endpoint_units):
+        """Stops a sync after its 4th checkpoint and resumes it, for test_config_cache_resume."""
+        with ReplayServer(ModifiedToast(modified_at, restaurants=2, orders_per_day=20, config_pages=3)) as server:
+            config = configuration(server.base_url, engine=engine, maxConcurrency="8", configCache="true",
+                                   checkpointSeconds="0")
+            expected = config_rows(connector.update(config, {}))
+
+            operations = []
+            sync = connector.update(config, {})
+            for operation in sync:
+                operations.append(operation)
+                if len([o for o in operations if o[0] == "checkpoint"]) == 4:
+                    break
+            sync.close()
+            checkpoints = [o[1] for o in operations if o[0] == "checkpoint"]
+            for checkpoint in checkpoints:
+                completed = checkpoint["window"]["completed"]
+                for key in checkpoint.get("config_cache", {}):
+                    restaurant, endpoint = key.split("/", 1)
+                    self.assertIn(endpoint_units["/" + endpoint], completed_units(completed, restaurant))
+
+            resumed = list(connector.update(config, checkpoints[-1]))
+
+        self.assertEqual(len(expected), 2 * (6 * 3 * 20 + 2 * 10))
+        self.assertLessEqual(expected, config_rows(operations + resumed))
+
+    def test_checkpoints_throttled(self):
+        """Completed endpoints are checkpointed at most every checkpointSeconds, the end of each window always is."""
+        every_unit, _ = self.sync(checkpointSeconds="0")
+        throttled, _ = self.sync(checkpointSeconds="3600")
+        windows = [o for o in every_unit if o[0] == "checkpoint" and "window" not in o[1]]
+        self.assertEqual(len([o for o in every_unit if o[0] == "checkpoint"]), len(windows) + 2 * 19)
+        checkpoints = [o[1] for o in throttled if o[0] == "checkpoint"]
+        self.assertEqual(len(checkpoints), len(windows))
+        self.assertFalse(any("window" in checkpoint for checkpoint in checkpoints))
+
+    def test_config_cache_off_by_default(self):
+        """Without configCache, no config cache is kept in the state."""
+        operations, _ = self.sync()
+        self.assertNotIn("config_cache", operations[-1][1])
+
+    def test_small_pool_does_not_deadlock(self):
+        """Workers held up by backpressure do not keep a connection, so a pool smaller than the workers still syncs."""
+        source = SyntheticToast(restaurants=4, orders_per_day=150, config_pages=1)
+        operations = []
+        with ReplayServer(source) as server:
+            config = configuration(server.base_url, maxConcurrency="4", poolMaxsize="1")
+            sync = threading.Thread(target=lambda: operations.extend(connector.update(config, {})), daemon=True)
+            sync.start()
+            sync.join(60)
+            self.assertFalse(sync.is_alive(), "sync did not finish")
+        self.assertEqual(operations[-1][0], "checkpoint")
+        self.assertEqual(len({o for o in operations if o[:2] == ("upsert", "orders")}), 4 * 150 * 3)
+
+    def test_resume_fetches_unfinished_units(self):
+        """After a failure, the next sync fetches only the restaurant endpoints that did not complete."""
+        expected, _ = self.sync()
+        source = FailingToast({("restaurant-1", "/orders/v2/ordersBulk")}, restaurants=2, orders_per_day=60,
+                              config_pages=3)
+        with ReplayServer(source) as server:
+            config = configuration(server.base_url, checkpointSeconds="0")
+            operations = []
+            with self.assertRaises(RuntimeError):
+                for operation in connector.update(config, {}):
+                    operations.append(operation)
+            state = [o for o in operations if o[0] == "checkpoint"][-1][1]
+            self.assertNotIn("to_ts", state)
+            self.assertIn("orders", completed_units(state["window"]["completed"], "restaurant-0"))
+            self.assertIn("menu", completed_units(state["window"]["completed"], "restaurant-1"))
+
+            source.fail.clear()
+            source.requests.clear()
+            resumed = list(connector.update(config, state))
+
+        # the resumed window ends where the failed sync started, a new window up to now follows it
+        restaurant_lists = [i for i, request in enumerate(source.requests) if request[1] == "/partners/v1/restaurants"]
+        resumed_window = source.requests[:restaurant_lists[1]]
+        self.assertNotIn(("restaurant-0", "/orders/v2/ordersBulk"), resumed_window)
+        self.assertNotIn(("restaurant-1", "/config/v2/menus"), resumed_window)
+        self.assertIn(("restaurant-1", "/orders/v2/ordersBulk"), resumed_window)
+        self.assertIn("to_ts", resumed[-1][1])
+        self.assertNotIn("window", resumed[-1][1])
+        self.assertLessEqual({o for o in expected if o[0] != "checkpoint"},
+                             {o for o in operations + resumed if o[0] != "checkpoint"})
+
+    def test_orders_by_business_date(self):
+        """
+        Each business date is its own unit, and a resumed sync fetches only the days that did not complete,
+        with the ordersByBusinessDate value its window started with.
+        """
+        days = connector.generate_business_dates(initial_sync_start, datetime.now(timezone.utc).isoformat())
+        failing_day = ("restaurant-0", f"/orders/v2/ordersBulk?businessDate={days[1]}")
+        source = FailingToast(set(), restaurants=2, orders_per_day=60, config_pages=3)
+        source.fail_query = failing_day
+        with ReplayServer(source) as server:
+            config = configuration(server.base_url, ordersByBusinessDate="true", maxConcurrency="4",
+                                   checkpointSeconds="0")
+            operations = []
+            with self.assertRaises(RuntimeError):
+                for operation in connector.update(config, {}):
+                    operations.append(operation)
+            completed = [o for o in operations if o[0] == "checkpoint"][-1][1]["window"]["completed"]
+            self.assertIn(f"orders:{days[0]}", completed_units(completed, "restaurant-0", days))
+            self.assertNotIn(f"orders:{days[1]}", completed_units(completed, "restaurant-0", days))
+
+            unfinished = {(restaurant, day) for restaurant in ["restaurant-0", "restaurant-1"] for day in days
+                          if f"orders:{day}" not in completed_units(completed, restaurant, days)}
+
+            source.fail_query = None
+            source.business_dates.clear()
+            state = [o for o in operations if o[0] == "checkpoint"][-1][1]
+            resumed = list(connector.update(dict(config, ordersByBusinessDate="false"), state))
+
+        # the resumed window fetches the days that had not completed, the new window up to now fetches a range
+        self.assertIn(("restaurant-0", days[1]), unfinished)
+        self.assertLess(len(unfinished), 2 * len(days))
+        self.assertEqual(sorted(source.business_dates), sorted(unfinished))
+        self.assertNotIn("window", resumed[-1][1])
+        window_end = next(i for i, o in enumerate(resumed) if o[0] == "checkpoint" and "window" not in o[1])
+        orders = {o for o in operations + resumed[:window_end] if o[:2] == ("upsert", "orders")}
+        self.assertEqual(len(orders), 2 * 60 * len(days))
+
+    def test_resume_async_engine(self):
+        """The async engine records completed endpoints the same way."""
+        operations, _ = self.sync(engine="async", maxConcurrency="8", checkpointSeconds="0")
+        completed = [o[1]["window"]["completed"] for o in operations if o[0] == "checkpoint" and "window" in o[1]]
+        self.assertEqual(completed[-1]["restaurant-1"], 19)
+        self.assertEqual(operations[-1][1].get("window"), None)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+import unittest
+import copy
+from unittest.mock import patch
+
+from connector import sync_backfill, generate_shards, read_settings
+
+class MockOp:
+    """Mocked operations that record what would be sent to the destination."""
+    @staticmethod
+    def upsert(table, data):
+        return {"table": table, "data": data}
+
+    @staticmethod
+    def checkpoint(state):
+        return {"checkpoint": copy.deepcopy(state)}
+
+def process_shard(base_url, headers, restaurants, ts_from, ts_to, settings):
+    """Mocked process_shard that emits one row per shard."""
+    yield {"table": "orders", "data": {"shard": ts_from}}
+
+class TestGenerateShards(unittest.TestCase):
+
+    def test_shards_cover_range(self):
+        """Shards are contiguous 30-day windows and the last one ends at the end of the range."""
+        shards = generate_shards("2024-01-01T00:00:00.000Z", "2024-04-15T00:00:00.000Z")
+        self.assertEqual(len(shards), 4)
+        self.assertEqual(shards[0][0], "2024-01-01T00:00:00.000Z")
+        self.assertEqual(shards[-1][1], "2024-04-15T00:00:00.000Z")
+        for (_, previous_to), (next_from, _) in zip(shards, shards[1:]):
+            self.assertEqual(previous_to, next_from)
+
+    def test_empty_range(self):
+        """A range with no length has no shards."""
+        self.assertEqual(generate_shards("2024-01-01T00:00:00.000Z", "2024-01-01T00:00:00.000Z"), [])
+
+@patch("connector.op", MockOp)
+@patch("connector.process_shard", side_effect=process_shard)
+@patch("connector.get_api_response", return_value=([], None))
+class TestSyncBackfill(unittest.TestCase):
+
+    def test_every_shard_checkpointed(self, mock_response, mock_shard):
+        """Each shard is recorded as completed after its rows, then to_ts moves to the end of the range."""
+        state = {}
+        results = list(sync_backfill("https://toast", {}, "2024-01-01T00:00:00.000Z",
+                                     "2024-04-15T00:00:00.000Z", state,
+                                     read_settings({"backfillConcurrency": "2"})))
+        rows = [r for r in results if "table" in r]
+        checkpoints = [r["checkpoint"] for r in results if "checkpoint" in r]
+
+        self.assertEqual(len(rows), 4)
+        self.assertEqual(len(checkpoints), 5)
+        self.assertEqual(len(checkpoints[3]["backfill"]["completed"]), 4)
+        self.assertEqual(checkpoints[-1], {"to_ts": "2024-04-15T00:00:00.000Z"})
+        self.assertEqual(state, {"to_ts": "2024-04-15T00:00:00.000Z"})
+
+    def test_resume_skips_completed_shards(self, mock_response, mock_shard):
+        """A resumed backfill only processes shards that were not completed."""
+        shards = generate_shards("2024-01-01T00:00:00.000Z", "2024-04-15T00:00:00.000Z")
+        state = {"backfill": {"start": "2024-01-01T00:00:00.000Z", "end": "2024-04-15T00:00:00.000Z",
+                              "completed": [shards[0][0], shards[2][0]]}}
+        results = list(sync_backfill("https://toast", {}, "2024-06-01T00:00:00.000Z",
+                                     "2024-07-01T00:00:00.000Z", state,
+                                     read_settings({"backfillConcurrency": "3"})))
+        rows = sorted(r["data"]["shard"] for r in results if "table" in r)
+
+        self.assertEqual(rows, [shards[1][0], shards[3][0]])
+        self.assertEqual(state, {"to_ts": "2024-04-15T00:00:00.000Z"})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+import unittest
+import os
+import json
+import tempfile
+import threading
+from unittest.mock import patch, MagicMock
+
+import connector
+from connector import SyncMetrics, iter_json_array
+
+def make_response(status_code, body, headers=None):
+    """Mocked non-streamed response with a JSON body."""
+    response = MagicMock()
+    response.status_code = status_code
+    response.headers = headers or {}
+    response.content = json.dumps(body).encode()
+    response.json.return_value = body
+    return response
+
+class TestSyncMetrics(unittest.TestCase):
+
+    def setUp(self):
+        connector.metrics.reset()
+        connector.configure_session({})
+        connector.rate_limiter.configure(1000)
+
+    def test_counters_from_threads(self):
+        """Updates from several worker threads are all counted."""
+        metrics = SyncMetrics()
+        def work():
+            for _ in range(1000):
+                metrics.add_table("orders", upserts=1)
+                metrics.add_endpoint("/orders/v2/ordersBulk", requests=1, http_seconds=0.001)
+        threads = [threading.Thread(target=work) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot["tables"]["orders"]["upserts"], 4000)
+        self.assertEqual(snapshot["endpoints"]["/orders/v2/ordersBulk"]["requests"], 4000)
+        self.assertAlmostEqual(snapshot["endpoints"]["/orders/v2/ordersBulk"]["http_seconds"], 4.0, places=3)
+
+    @patch("time.sleep")
+    @patch("requests.Session.get")
+    def test_get_api_response_records_endpoint(self, mock_get, mock_sleep):
+        """Requests, retries, 429s and body size are recorded per endpoint path, without the query string."""
+        mock_get.side_effect = [make_response(429, {}, {"Retry-After": "0"}),
+                                make_response(200, [{"guid": "a"}])]
+        connector.get_api_response("https://toast.test/labor/v1/jobs?restaurantIds=1", {})
+        counters = connector.metrics.snapshot()["endpoints"]["/labor/v1/jobs"]
+        self.assertEqual(counters["requests"], 2)
+        self.assertEqual(counters["retries"], 1)
+        self.assertEqual(counters["rate_limited"], 1)
+        self.assertEqual(counters["bytes"], len(json.dumps([{"guid": "a"}])))
+
+    def test_streamed_body_recorded(self):
+        """A streamed page records its size once it has been parsed."""
+        body = json.dumps([{"guid": str(i)} for i in range(10)]).encode()
+        response = MagicMock()
+        response.encoding = "utf-8"
+        response.iter_content.return_value = iter([body[:20], body[20:]])
+        self.assertEqual(len(list(iter_json_array(response, endpoint="/orders/v2/ordersBulk"))), 10)
+        self.assertEqual(connector.metrics.snapshot()["endpoints"]["/orders/v2/ordersBulk"]["bytes"], len(body))
+
+    def test_upserts_and_deletes_counted(self):
+        """Rows emitted through the upsert and delete helpers are counted per table."""
+        list(connector.process_child([{"guid": "1", "deleted": True}], "orders_check", "orders_id", "o1"))
+        counters = connector.metrics.snapshot()["tables"]["orders_check"]
+        self.assertEqual(counters["upserts"], 1)
+        self.assertEqual(counters["deletes"], 1)
+        self.assertGreater(counters["transform_seconds"], 0)
+
+    def test_sent_rows_counted(self):
+        """PendingRows sent by send_rows and batch_by_table are counted per table, before the checkpoint after them."""
+        rows = [connector.PendingRow("upsert", "orders", {"id": "1"}), connector.PendingRow("delete", "orders", {"id": "2"}),
+                connector.PendingRow("upsert", "payment", {"id": "3"}), "checkpoint"]
+        for send in [connector.send_rows, lambda operations: connector.batch_by_table(operations, 100, 1 << 20)]:
+            connector.metrics.reset()
+            with patch("connector.op") as op:
+                for operation in send(iter(rows)):
+                    if operation == "checkpoint":
+                        tables = connector.metrics.snapshot()["tables"]
+            self.assertEqual(op.upsert.call_count, 2)
+            self.assertEqual((tables["orders"]["upserts"], tables["orders"]["deletes"]), (1, 1))
+            self.assertEqual(tables["payment"]["upserts"], 1)
+
+    def test_export_formats(self):
+        """A .prom path gets Prometheus text, any other path gets one JSON line per export."""
+        connector.metrics.add_endpoint("/config/v2/menus", requests=3)
+        with tempfile.TemporaryDirectory() as tmp:
+            prom_path = os.path.join(tmp, "toast.prom")
+            connector.metrics.export(prom_path)
+            with open(prom_path) as f:
+                self.assertIn('toast_endpoint_requests{endpoint="/config/v2/menus"} 3', f.read())
+
+            json_path = os.path.join(tmp, "toast_metrics.jsonl")
+            connector.metrics.export(json_path)
+            connector.metrics.export(json_path)
+            with open(json_path) as f:
+                lines = f.read().splitlines()
+            self.assertEqual(len(lines), 2)
+            self.assertEqual(json.loads(lines[0])["endpoints"]["/config/v2/menus"]["requests"], 3)
+
+    def test_summary_lists_endpoints_and_tables(self):
+        connector.metrics.add_endpoint("/config/v2/menus", requests=3, http_seconds=0.25)
+        connector.metrics.add_table("menus", upserts=7)
+        summary = connector.metrics.summary()
+        self.assertIn("/config/v2/menus", summary)
+        self.assertIn("menus", summary)
+        self.assertIn("0.250", summary)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,163 @@
+import unittest
+import time
+import threading
+from unittest.mock import patch, MagicMock
+
+import requests
+from cryptography.fernet import Fernet
+
+from connector import TokenManager, get_api_response
+
+CONF = {"clientId": "id", "clientSecret": "secret", "userAccessType": "TOAST_MACHINE_CLIENT"}
+
+class FakeLogin:
+    """Session whose login returns a new token every time, valid for expires_in seconds."""
+    def __init__(self, expires_in=86400, delay=0.0):
+        self.expires_in = expires_in
+        self.delay = delay
+        self.logins = 0
+        self.lock = threading.Lock()
+
+    def post(self, url, json=None, timeout=None):
+        time.sleep(self.delay)
+        with self.lock:
+            self.logins += 1
+            token = f"token-{self.logins}"
+        response = MagicMock()
+        response.json.return_value = {"token": {"accessToken": token, "expiresIn": self.expires_in}}
+        return response
+
+class FailingLogin(FakeLogin):
+    """FakeLogin whose logins fail while failing is set."""
+    failing = False
+    attempts = 0
+
+    def post(self, url, json=None, timeout=None):
+        self.attempts += 1
+        if self.failing:
+            raise requests.exceptions.ConnectionError("login unavailable")
+        return super().post(url, json=json, timeout=timeout)
+
+class TestTokenManager(unittest.TestCase):
+
+    def setUp(self):
+        self.key = Fernet.generate_key().decode()
+
+    def configured(self, login, state, **kwargs):
+        manager = TokenManager(**kwargs)
+        with patch("connector.get_session", return_value=login):
+            manager.configure(CONF, "https://toast", state, self.key)
+            manager.token_for_request()
+        return manager
+
+    def test_reuses_token_without_decrypting_again(self):
+        login, state = FakeLogin(), {}
+        manager = self.configured(login, state)
+        self.assertEqual(login.logins, 1)
+        self.assertIn("encrypted_token", state)
+
+        # a fresh manager, as in a new process, decrypts the token from state instead of logging in
+        other = TokenManager()
+        with patch("connector.get_session", return_value=login):
+            other.configure(CONF, "https://toast", dict(state), self.key)
+            self.assertEqual(other.token_for_request(), "token-1")
+        self.assertEqual(login.logins, 1)
+
+        # the same manager in a later sync does not decrypt the token it already holds
+        with patch.object(manager.fernet, "decrypt", side_effect=AssertionError("decrypted again")):
+            manager.configure(CONF, "https://toast", dict(state), self.key)
+            self.assertEqual(manager.token_for_request(), "token-1")
+
+    def test_proactive_refresh_in_background(self):
+        """Close to expiry, requests keep the current token while one background login replaces it."""
+        login, state = FakeLogin(expires_in=300, delay=0.2), {}
+        manager = self.configured(login, state, refresh_before=600)
+        with patch("connector.get_session", return_value=login):
+            tokens = []
+            threads = [threading.Thread(target=lambda: tokens.append(manager.token_for_request())) for _ in range(20)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(set(tokens), {"token-1"})  # nobody waited for the login
+            for _ in range(100):
+                if manager.refreshes == 2 and not manager.refreshing:
+                    break
+                time.sleep(0.05)
+        self.assertEqual(login.logins, 2)
+        self.assertEqual(manager.token, "token-2")
+        self.assertEqual(state["encrypted_token"], manager.encrypted_token)
+
+    def wait_for_refresh(self, manager):
+        for _ in range(100):
+            if not manager.refreshing:
+                return
+            time.sleep(0.05)
+
+    def test_failed_background_refresh_backs_off(self):
+        """After a failed background refresh, requests do not start another one until the backoff has passed."""
+        login, state = FailingLogin(expires_in=300), {}
+        manager = self.configured(login, state, refresh_before=600, refresh_backoff=60)
+        login.failing = True
+        with patch("connector.get_session", return_value=login):
+            for failures in [1, 2]:
+                manager.token_for_request()
+                self.wait_for_refresh(manager)
+                for _ in range(10):
+                    self.assertEqual(manager.token_for_request(), "token-1")
+                self.assertEqual(login.attempts, 1 + failures)
+                self.assertAlmostEqual(manager.next_refresh_at - time.time(), 60 * failures, delta=5)
+                manager.next_refresh_at = 0.0  # as if the backoff had passed
+
+            login.failing = False
+            manager.token_for_request()
+            self.wait_for_refresh(manager)
+        self.assertEqual(manager.token, "token-2")
+        self.assertEqual(manager.failed_refreshes, 0)
+
+    def test_rejected_token_is_replaced_once(self):
+        login = FakeLogin()
+        manager = self.configured(login, {})
+        headers = manager.authorize({"Authorization": "Bearer old", "Accept": "application/json"})
+        with patch("connector.get_session", return_value=login):
+            for _ in range(5):
+                self.assertTrue(manager.rejected(headers))
+            threads = [threading.Thread(target=manager.token_for_request) for _ in range(10)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(login.logins, 2)
+        self.assertEqual(manager.authorize(headers)["Authorization"], "Bearer token-2")
+
+    def test_get_api_response_retries_with_new_token(self):
+        """A 401 is retried right away with a new token instead of sleeping with the rejected one."""
+        login = FakeLogin()
+        manager = self.configured(login, {})
+        ok = MagicMock(status_code=200, headers={})
+        ok.json.return_value = [{"guid": "1"}]
+        login.get = MagicMock(side_effect=[MagicMock(status_code=401, headers={}), ok])
+
+        with patch("connector.token_manager", manager), patch("connector.get_session", return_value=login), \
+                patch("time.sleep") as sleep:
+            page, _ = get_api_response("https://toast/api", {"Authorization": "Bearer stale"})
+        self.assertEqual(page, [{"guid": "1"}])
+        sent = [call.kwargs["headers"]["Authorization"] for call in login.get.call_args_list]
+        self.assertEqual(sent, ["Bearer token-1", "Bearer token-2"])
+        self.assertFalse([call for call in sleep.call_args_list if call.args[0] >= 1])  # the rate limiter may pace
+
+    def test_repeated_401_logs_in_once(self):
+        """A request that keeps getting 401s replaces the token once, and pauses before its other retries."""
+        login = FakeLogin()
+        manager = self.configured(login, {})
+        login.get = MagicMock(return_value=MagicMock(status_code=401, headers={}))
+
+        with patch("connector.token_manager", manager), patch("connector.get_session", return_value=login), \
+                patch("time.sleep") as sleep:
+            self.assertEqual(get_api_response("https://toast/api", {"Authorization": "Bearer stale"}), (None, None))
+        self.assertEqual(login.get.call_count, 4)
+        self.assertEqual(login.logins, 2)
+        self.assertEqual(len([call for call in sleep.call_args_list if call.args[0] == 2]), 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+import unittest
+import asyncio
+from unittest.mock import patch
+
+import connector
+from connector import token_pages, PageTokenExpired
+
+PAGES = {None: ([{"guid": "a"}], "t1"), "t1": ([{"guid": "b"}], "t2"), "t2": ([{"guid": "c"}], None)}
+
+def responses(expire, changed=False):
+    """
+    Mocked get_api_response serving PAGES, answering the page tokens in expire once with a 409
+    :param changed: page token whose page changes after the first time it is served
+    """
+    expire = set(expire)
+    served = set()
+    def get_api_response(url, headers, params=None, restart_on_conflict=True):
+        page_token = params.get("pageToken")
+        if page_token in expire:
+            expire.discard(page_token)
+            raise PageTokenExpired(url)
+        page, next_token = PAGES[page_token]
+        if page_token == changed and page_token in served:
+            page = page + [{"guid": "new"}]
+        served.add(page_token)
+        return page, next_token
+    return get_api_response
+
+class TestTokenPagination(unittest.TestCase):
+
+    def setUp(self):
+        connector.metrics.reset()
+
+    def pages(self, **kwargs):
+        with patch("connector.get_api_response", side_effect=responses(**kwargs)) as get:
+            pages = [page for page, digest, index in token_pages("https://toast/config/v2/menus?lastModified=x", {})]
+        return pages, get.call_count
+
+    def test_without_conflicts(self):
+        pages, requests = self.pages(expire=[])
+        self.assertEqual(pages, [[{"guid": "a"}], [{"guid": "b"}], [{"guid": "c"}]])
+        self.assertEqual(requests, 3)
+
+    def test_expired_token_replays_confirmed_pages(self):
+        """After a 409 the confirmed pages are fetched again but not processed again."""
+        pages, requests = self.pages(expire=["t2"])
+        self.assertEqual(pages, [[{"guid": "a"}], [{"guid": "b"}], [{"guid": "c"}]])
+        self.assertEqual(requests, 6)
+        counters = connector.metrics.snapshot()["endpoints"]["/config/v2/menus"]
+        self.assertEqual(counters["conflicts"], 1)
+        self.assertEqual(counters["refetched_pages"], 2)
+
+    def test_changed_page_is_processed_again(self):
+        pages, _ = self.pages(expire=["t2"], changed="t1")
+        self.assertEqual(pages, [[{"guid": "a"}], [{"guid": "b"}], [{"guid": "b"}, {"guid": "new"}], [{"guid": "c"}]])
+
+    def test_changed_page_replaces_its_cached_hash(self):
+        """The config cache keeps one hash per page, the changed page's new one, whichever engine fetched it."""
+        cache = {}
+        with patch("connector.get_api_response", side_effect=responses(expire=["t2"], changed="t1")):
+            list(connector.process_config("https://toast", {}, "/config/v2/menus", "menu", "r1", {"lastModified": "x"},
+                                          cache=cache))
+        expected = [connector.page_digest(page) for page in
+                    [[{"guid": "a"}], [{"guid": "b"}, {"guid": "new"}], [{"guid": "c"}]]]
+        self.assertEqual(cache["r1/config/v2/menus"]["pages"], expected)
+
+        async def get_api_response(client, url, headers, params=None, restart_on_conflict=True):
+            return serve(url, headers, params, restart_on_conflict)
+
+        async def emit(operations):
+            pass
+
+        cache = {}
+        serve = responses(expire=["t2"], changed="t1")
+        with patch("connector.async_get_api_response", side_effect=get_api_response):
+            asyncio.run(connector.process_config_async("https://toast", {}, "/config/v2/menus", "menu", "r1",
+                                                       {"lastModified": "x"}, cache=cache, client=None, emit=emit))
+        self.assertEqual(cache["r1/config/v2/menus"]["pages"], expected)
+
+    def test_gives_up_after_max_restarts(self):
+        with patch("connector.get_api_response", side_effect=PageTokenExpired("url")):
+            with self.assertRaises(RuntimeError):
+                list(token_pages("https://toast/config/v2/menus", {}))
+
+    def test_amplification(self):
+        metrics = connector.SyncMetrics()
+        metrics.add_endpoint("/config/v2/menus", requests=6, conflicts=1, refetched_pages=2)
+        metrics.add_endpoint("/labor/v1/jobs", requests=2)
+        endpoints = metrics.snapshot()["endpoints"]
+        self.assertEqual(endpoints["/config/v2/menus"]["amplification"], 2.0)
+        self.assertEqual(endpoints["/labor/v1/jobs"]["amplification"], 1.0)
+        self.assertIn("amplification", metrics.summary())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+import unittest
+import time
+import random
+
+from connector import yield_in_order
+
+def make_task(name, count, delay=0.0):
+    """Returns a zero-argument task that yields count items, sleeping a little before each one."""
+    def task():
+        for i in range(count):
+            time.sleep(delay * random.random())
+            yield (name, i)
+    return task
+
+def failing_task():
+    yield "before failure"
+    raise RuntimeError("endpoint failed")
+
+class TestYieldInOrder(unittest.TestCase):
+
+    def test_serial_matches_task_order(self):
+        """With a single worker the tasks run one after another."""
+        tasks = [make_task("a", 3), make_task("b", 2)]
+        expected = [("a", 0), ("a", 1), ("a", 2), ("b", 0), ("b", 1)]
+        self.assertEqual(list(yield_in_order(tasks, 1)), expected)
+
+    def test_parallel_matches_serial_order(self):
+        """Tasks finishing out of order are still yielded in task order."""
+        tasks = [make_task(name, 20, delay=0.002) for name in "abcdefgh"]
+        expected = list(yield_in_order([make_task(name, 20) for name in "abcdefgh"], 1))
+        self.assertEqual(list(yield_in_order(tasks, 4)), expected)
+
+    def test_small_buffer(self):
+        """Workers blocked on a full buffer do not lose or reorder items."""
+        tasks = [make_task(name, 50) for name in "abc"]
+        expected = [(name, i) for name in "abc" for i in range(50)]
+        self.assertEqual(list(yield_in_order(tasks, 3, buffer_size=2)), expected)
+
+    def test_error_is_raised_in_order(self):
+        """Items before a failing task are yielded, then its exception is raised."""
+        tasks = [make_task("a", 2), failing_task, make_task("c", 2)]
+        results = []
+        with self.assertRaises(RuntimeError):
+            for item in yield_in_order(tasks, 3):
+                results.append(item)
+        self.assertEqual(results, [("a", 0), ("a", 1), "before failure"])
+
+    def test_consumer_stops_early(self):
+        """Closing the generator early shuts the worker pool down."""
+        tasks = [make_task(name, 100) for name in "abcd"]
+        gen = yield_in_order(tasks, 2, buffer_size=5)
+        self.assertEqual(next(gen), ("a", 0))
+        gen.close()
+
+if __name__ == '__main__':
+    unittest.main()